@@ -0,0 +1,98 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+# 各スクリプトは app/ 直下のモジュールを直接importしているので、検索パスに追加する
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+# 取得元の名前と、main()を持つモジュールの対応
+SOURCES = {
+    'reddit': 'fetch_reddit',
+    'tumblr': 'fetch_tumblr',
+    'semantic_scholar': 'fetch_semantic_scholar',
+    'cinii': 'fetch_cinii',
+    'astronomy': 'openai_ask_astronomy',
+    'tweets': 'fetch_tweets',
+    'sky_forecast': 'sky_forecast',
+}
+
+# 取得元ごとのタイムアウト(秒)の既定値
+DEFAULT_TIMEOUT = float(os.getenv("RUN_SOURCE_TIMEOUT", "1800"))
+
+# 1つの取得元を実行し、(状態, 経過時間, エラー) を返す
+def run_source(name):
+    started = time.monotonic()
+    try:
+        module = importlib.import_module(SOURCES[name])
+        module.main()
+        return 'ok', time.monotonic() - started, None
+    except SystemExit as e:
+        if e.code in (None, 0):
+            return 'ok', time.monotonic() - started, None
+        return 'failed', time.monotonic() - started, f"exit code {e.code}"
+    except Exception as e:
+        return 'failed', time.monotonic() - started, repr(e)
+
+# 選択した取得元を1つのプロセスで並列に実行する
+# HTTPの接続プールやAPIクライアントはモジュール間で共有される
+def run(sources, timeouts):
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=len(sources))
+    started = time.monotonic()
+    futures = {name: executor.submit(run_source, name) for name in sources}
+    for name, future in futures.items():
+        deadline = started + timeouts.get(name, DEFAULT_TIMEOUT)
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            results[name] = ('timeout', time.monotonic() - started, None)
+    executor.shutdown(wait=False)
+    return results, time.monotonic() - started
+
+def print_summary(results, total):
+    print()
+    print(f"{'source':<20}{'status':<10}{'seconds':>10}")
+    for name, (status, elapsed, error) in results.items():
+        print(f"{name:<20}{status:<10}{elapsed:>10.1f}" + (f"  {error}" if error else ""))
+    print(f"{'total':<20}{'':<10}{total:>10.1f}")
+
+# "reddit=600,tumblr=300" の形式のタイムアウト指定を読み込む
+def parse_timeouts(value):
+    timeouts = {}
+    for item in filter(None, (value or "").split(',')):
+        name, _, seconds = item.partition('=')
+        timeouts[name.strip()] = float(seconds)
+    return timeouts
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m app')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    run_parser = subparsers.add_parser('run', help='複数の取得元を1つのプロセスで並列に実行する')
+    run_parser.add_argument('--sources', default=','.join(SOURCES),
+                            help=f"カンマ区切りの取得元 ({', '.join(SOURCES)})")
+    run_parser.add_argument('--timeout', default='',
+                            help='取得元ごとのタイムアウト(秒)。例: reddit=600,tumblr=300')
+    args = parser.parse_args(argv)
+
+    sources = [name.strip() for name in args.sources.split(',') if name.strip()]
+    unknown = [name for name in sources if name not in SOURCES]
+    if unknown:
+        parser.error(f"unknown sources: {', '.join(unknown)}")
+
+    results, total = run(sources, parse_timeouts(args.timeout))
+    print_summary(results, total)
+
+    exit_code = 0 if all(status == 'ok' for status, _, _ in results.values()) else 1
+    if any(status == 'timeout' for status, _, _ in results.values()):
+        # タイムアウトしたスレッドの終了は待たずにプロセスを終える(atexitは実行されないので計測結果はここで書き出す)
+        import instrumentation
+        instrumentation.write_report()
+        sys.stdout.flush()
+        os._exit(exit_code)
+    return exit_code
+
+if __name__ == '__main__':
+    sys.exit(main())
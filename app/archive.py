@@ -0,0 +1,337 @@
+import os
+import sys
+import json
+import gzip
+import uuid
+import shutil
+import argparse
+from datetime import datetime, date, timedelta, timezone
+from pathlib import Path
+
+# 収集したレコードを、取得元・日付ごとに分けたParquetファイルとして保存する
+#   data/archive/<source>/day=YYYY-MM-DD/part-*.parquet
+# 分析では必要な列と期間のファイルだけを読み込める(query)
+# Actionsのキャッシュは消えることがあるので、日数が経った日付は1ファイルにまとめてGoogle Driveへ移す(upload)
+# Driveへ移した日付はARCHIVE_REMOTE_DIRに取り戻せて(fetch)、queryは手元とあわせて全期間を読み込む
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "1") == "1"
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", "data/archive")
+# この件数が溜まるたびにファイルに書き出す
+ARCHIVE_BATCH_ROWS = int(os.getenv("ARCHIVE_BATCH_ROWS", "50000"))
+ARCHIVE_COMPRESSION = os.getenv("ARCHIVE_COMPRESSION", "zstd")
+# このサイズより小さいファイルが同じ日付に複数あればcompactで1つにまとめる
+ARCHIVE_COMPACT_BYTES = int(os.getenv("ARCHIVE_COMPACT_BYTES", str(64 * 1024 * 1024)))
+# この日数より前の日付は、それ以上レコードが増えないものとしてGoogle Driveへアップロードし、手元から消す
+ARCHIVE_UPLOAD_AFTER_DAYS = int(os.getenv("ARCHIVE_UPLOAD_AFTER_DAYS", "3"))
+# Google Driveへ移した日付の置き場(uploadの対象にはしない)
+ARCHIVE_REMOTE_DIR = os.getenv("ARCHIVE_REMOTE_DIR", "data/archive_remote")
+
+PARTITION_FIELD = 'day'
+
+def _schemas():
+    timestamp = pa.timestamp('s', tz='UTC')
+    return {
+        'reddit': pa.schema([
+            ('type', pa.string()),
+            ('id', pa.string()),
+            ('submission_id', pa.string()),
+            ('title', pa.string()),
+            ('selftext', pa.string()),
+            ('body', pa.string()),
+            ('url', pa.string()),
+            ('created_utc', timestamp),
+        ]),
+        'tumblr': pa.schema([
+            ('id', pa.int64()),
+            ('blog_name', pa.string()),
+            ('post_url', pa.string()),
+            ('type', pa.string()),
+            ('timestamp', timestamp),
+            ('date', pa.string()),
+            ('tags', pa.list_(pa.string())),
+            ('note_count', pa.int64()),
+            ('summary', pa.string()),
+        ]),
+        'tweets': pa.schema([
+            ('id', pa.int64()),
+            ('author_id', pa.int64()),
+            ('text', pa.string()),
+            ('created_at', timestamp),
+            ('query', pa.string()),
+        ]),
+    }
+
+SCHEMAS = _schemas() if pa is not None else {}
+# 日付で分ける基準になる列
+TIME_COLUMNS = {'reddit': 'created_utc', 'tumblr': 'timestamp', 'tweets': 'created_at'}
+
+def _require_pyarrow():
+    if pa is None:
+        raise ValueError("アーカイブを使うには 'pyarrow' パッケージをインストールしてください。")
+
+# UNIX時刻・'YYYY-MM-DD HH:MM:SS'(UTC)・ISO 8601の文字列をUTCのdatetimeにする
+def to_datetime(value):
+    if value is None or isinstance(value, datetime):
+        return value
+    if isinstance(value, (int, float)):
+        return datetime.fromtimestamp(value, tz=timezone.utc)
+    parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+# スキーマに合わせてレコードの値を変換する(スキーマにない項目は捨てる)
+def to_row(record, schema):
+    row = {}
+    for field in schema:
+        value = record.get(field.name)
+        if value is not None:
+            if pa.types.is_timestamp(field.type):
+                value = to_datetime(value)
+            elif pa.types.is_integer(field.type):
+                value = int(value)
+        row[field.name] = value
+    return row
+
+def _day(value):
+    if isinstance(value, datetime):
+        return value.strftime('%Y-%m-%d')
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+def _write_table(table, directory):
+    directory.mkdir(parents=True, exist_ok=True)
+    path = directory / f"part-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:8]}.parquet"
+    # 書き込み途中のファイルは読み込まれないように.で始まる名前にしておく
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    pq.write_table(table, tmp_path, compression=ARCHIVE_COMPRESSION)
+    os.replace(tmp_path, path)
+    return path
+
+# レコードを日付ごとに溜めて、一定件数ごとにParquetファイルに書き出すライター
+# pyarrowがない場合やARCHIVE_ENABLED=0の場合は何もしない
+class ArchiveWriter:
+    def __init__(self, source, root=ARCHIVE_DIR, batch_rows=ARCHIVE_BATCH_ROWS,
+                 enabled=ARCHIVE_ENABLED):
+        self.enabled = enabled and pa is not None
+        if enabled and pa is None:
+            print("pyarrow is not installed, skipping the archive.")
+        self.source = source
+        self.directory = Path(root) / source
+        self.batch_rows = batch_rows
+        self.schema = SCHEMAS.get(source)
+        self.time_column = TIME_COLUMNS.get(source)
+        self.paths = []
+        self.record_count = 0
+        self._rows = {}
+        self._pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def write(self, record):
+        if not self.enabled:
+            return
+        row = to_row(record, self.schema)
+        # 時刻がないレコードは書き込んだ日に入れる
+        day = _day(row[self.time_column] or datetime.now(timezone.utc))
+        self._rows.setdefault(day, []).append(row)
+        self._pending += 1
+        self.record_count += 1
+        if self._pending >= self.batch_rows:
+            self.flush()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        return self.record_count
+
+    # レコードを書き込みながらそのまま返す(JsonlWriterと同じレコードを保存する場合に使う)
+    def tee(self, records):
+        for record in records:
+            self.write(record)
+            yield record
+
+    def flush(self):
+        for day, rows in self._rows.items():
+            table = pa.Table.from_pylist(rows, schema=self.schema)
+            path = _write_table(table, self.directory / f"{PARTITION_FIELD}={day}")
+            self.paths.append(path)
+        self._rows = {}
+        self._pending = 0
+
+    def close(self):
+        if self.enabled:
+            self.flush()
+
+def _partitioning():
+    return ds.partitioning(pa.schema([(PARTITION_FIELD, pa.string())]), flavor='hive')
+
+# 必要な列と期間(start〜endの日付、両端を含む)だけを読み込む
+# 手元のアーカイブ(root)と、Google Driveから取り戻した日付(remote_root)をあわせて読む
+# 日付はディレクトリ名で、filter(pyarrowの式)は各ファイルの統計情報で読み飛ばせる部分を判定する
+#   query('tumblr', columns=['id', 'tags', 'note_count'], start='2024-01-01',
+#         filter=pyarrow.dataset.field('note_count') > 10)
+def query(source, columns=None, start=None, end=None, filter=None, root=ARCHIVE_DIR, remote_root=ARCHIVE_REMOTE_DIR):
+    _require_pyarrow()
+    schema = SCHEMAS[source].append(pa.field(PARTITION_FIELD, pa.string()))
+    directories = [Path(path) / source for path in (root, remote_root) if path and (Path(path) / source).exists()]
+    if not directories:
+        table = schema.empty_table()
+        return table.select(columns) if columns else table
+    dataset = ds.dataset([ds.dataset(directory, format='parquet', schema=schema, partitioning=_partitioning())
+                          for directory in directories])
+    expression = filter
+    for bound, op in ((start, 'ge'), (end, 'le')):
+        if bound is None:
+            continue
+        field = ds.field(PARTITION_FIELD)
+        condition = field >= _day(bound) if op == 'ge' else field <= _day(bound)
+        expression = condition if expression is None else expression & condition
+    return dataset.to_table(columns=columns, filter=expression)
+
+# 同じ日付のファイルを1つにまとめて、まとめたファイルのパスを返す
+# 同じIDのレコードは後から書いたものを残し、時刻順に並べ替えて統計情報が効きやすくする
+def _merge(source, partition, paths):
+    table = pa.concat_tables([pq.read_table(path, schema=SCHEMAS[source]) for path in paths])
+    latest = {}
+    for index, record_id in enumerate(table.column('id').to_pylist()):
+        latest[record_id] = index
+    table = table.take(sorted(latest.values()))
+    table = table.sort_by(TIME_COLUMNS[source])
+    merged = _write_table(table, partition)
+    for path in paths:
+        path.unlink()
+    print(f"Compacted {len(paths)} files into {table.num_rows} rows in {partition}")
+    return merged
+
+# 日付ごとに、小さなファイルを1つにまとめる
+def compact(source, root=ARCHIVE_DIR, target_bytes=ARCHIVE_COMPACT_BYTES):
+    _require_pyarrow()
+    directory = Path(root) / source
+    compacted = 0
+    for partition in sorted(directory.glob(f"{PARTITION_FIELD}=*")):
+        small = [path for path in sorted(partition.glob('*.parquet')) if path.stat().st_size < target_bytes]
+        if len(small) < 2:
+            continue
+        _merge(source, partition, small)
+        compacted += len(small)
+    return compacted
+
+# after_days日より前の日付を1ファイルにまとめてGoogle Driveへアップロードし、remote_rootへ移す
+# Drive上のファイル名は <source>_<YYYY-MM-DD>_part-*.parquet(後から同じ日付のレコードが増えた場合は別のファイルになる)
+# アップロードに失敗した日付は手元に残るので、次回の実行でまたアップロードされる
+def upload(source, drive_service, folder_id, root=ARCHIVE_DIR, after_days=ARCHIVE_UPLOAD_AFTER_DAYS,
+           remote_root=ARCHIVE_REMOTE_DIR):
+    from drive_uploader import upload_file
+
+    _require_pyarrow()
+    directory = Path(root) / source
+    cutoff = (datetime.now(timezone.utc).date() - timedelta(days=after_days)).isoformat()
+    uploaded = 0
+    for partition in sorted(directory.glob(f"{PARTITION_FIELD}=*")):
+        day = partition.name.split('=', 1)[1]
+        if day >= cutoff:
+            continue
+        paths = sorted(partition.glob('*.parquet'))
+        if len(paths) > 1:
+            paths = [_merge(source, partition, paths)]
+        remote_partition = Path(remote_root) / source / partition.name
+        for path in paths:
+            upload_file(drive_service, path, folder_id, name=f"{source}_{day}_{path.name}")
+            remote_partition.mkdir(parents=True, exist_ok=True)
+            shutil.move(path, remote_partition / path.name)
+            uploaded += 1
+        shutil.rmtree(partition)
+    return uploaded
+
+# Google Driveへ移した日付(start〜end、両端を含む)をremote_rootへダウンロードして、queryで読めるようにする
+# 既にダウンロード済みのファイルは飛ばすので、キャッシュが消えたときに繰り返し実行すればよい
+def fetch(source, drive_service, folder_id, start=None, end=None, remote_root=ARCHIVE_REMOTE_DIR):
+    from drive_uploader import download_file, list_files
+
+    fetched = 0
+    for item in list_files(drive_service, folder_id, prefix=f"{source}_"):
+        day, _, name = item['name'][len(source) + 1:].partition('_')
+        if not name or (start and day < start) or (end and day > end):
+            continue
+        path = Path(remote_root) / source / f"{PARTITION_FIELD}={day}" / name
+        if path.exists():
+            continue
+        download_file(drive_service, item['id'], path)
+        fetched += 1
+    return fetched
+
+# 既存のJSON(配列)・JSONL(.gz)ファイルを読み込んでレコードを返す(過去の取得結果の取り込み用)
+def read_records(path):
+    path = Path(path)
+    opener = gzip.open if path.suffix == '.gz' else open
+    with opener(path, 'rt', encoding='utf-8') as f:
+        if '.jsonl' in path.suffixes:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            data = json.load(f)
+            yield from (data if isinstance(data, list) else data.get('data', []))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='取得したデータのParquetアーカイブ')
+    commands = parser.add_subparsers(dest='command', required=True)
+    import_parser = commands.add_parser('import', help='JSON/JSONLファイルを取り込む')
+    import_parser.add_argument('source', choices=sorted(TIME_COLUMNS))
+    import_parser.add_argument('files', nargs='+')
+    compact_parser = commands.add_parser('compact', help='小さなファイルをまとめる')
+    compact_parser.add_argument('sources', nargs='*', default=sorted(TIME_COLUMNS))
+    upload_parser = commands.add_parser('upload', help='古い日付をGoogle Driveへ移す')
+    upload_parser.add_argument('sources', nargs='*', default=sorted(TIME_COLUMNS))
+    fetch_parser = commands.add_parser('fetch', help='Google Driveへ移した日付を取り戻す')
+    fetch_parser.add_argument('sources', nargs='*', default=sorted(TIME_COLUMNS))
+    fetch_parser.add_argument('--start', help='YYYY-MM-DD')
+    fetch_parser.add_argument('--end', help='YYYY-MM-DD')
+    query_parser = commands.add_parser('query', help='列と期間を指定して読み込む')
+    query_parser.add_argument('source', choices=sorted(TIME_COLUMNS))
+    query_parser.add_argument('--columns', help='カンマ区切りの列名')
+    query_parser.add_argument('--start', help='YYYY-MM-DD')
+    query_parser.add_argument('--end', help='YYYY-MM-DD')
+    args = parser.parse_args(argv)
+
+    _require_pyarrow()
+    if args.command == 'import':
+        with ArchiveWriter(args.source, enabled=True) as writer:
+            for path in args.files:
+                writer.write_all(read_records(path))
+        print(f"Archived {writer.record_count} records into {len(writer.paths)} files.")
+    elif args.command == 'compact':
+        for source in args.sources:
+            compact(source)
+    elif args.command in ('upload', 'fetch'):
+        from drive_uploader import create_drive_service
+
+        folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
+        if not folder_id:
+            raise ValueError("環境変数 'GOOGLE_DRIVE_FOLDER_ID' が設定されていません。")
+        drive_service = create_drive_service()
+        for source in args.sources:
+            if args.command == 'upload':
+                print(f"Uploaded {upload(source, drive_service, folder_id)} {source} archive files.")
+            else:
+                fetched = fetch(source, drive_service, folder_id, start=args.start, end=args.end)
+                print(f"Fetched {fetched} {source} archive files.")
+    else:
+        columns = args.columns.split(',') if args.columns else None
+        table = query(args.source, columns=columns, start=args.start, end=args.end)
+        print(f"{table.num_rows} rows")
+        for row in table.slice(0, 20).to_pylist():
+            print(json.dumps(row, ensure_ascii=False, default=str))
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,118 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+import instrumentation
+
+# キャッシュの保存先と上限(環境変数で変更可能)
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "data/cache/llm_cache.sqlite3")
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "50000"))
+LLM_CACHE_TTL_DAYS = float(os.getenv("LLM_CACHE_TTL_DAYS", "90"))
+
+# 入力内容からキャッシュキー(SHA-256)を作成
+def make_key(*parts):
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+# SQLiteを使った内容アドレス型のキャッシュ
+# 件数上限を超えたら最終アクセスが古いものから削除し(LRU)、TTLを過ぎたものは無効にする
+class SQLiteCache:
+    def __init__(self, path, max_entries=None, ttl=None):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._lock = threading.Lock()
+        # 複数スレッドから使うので接続は共有し、ロックで直列化する
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY,"
+            " value TEXT NOT NULL,"
+            " created_at REAL NOT NULL,"
+            " accessed_at REAL NOT NULL,"
+            " expires_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.commit()
+
+    # キーに対応する値を取得する(なければNone)
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] <= now):
+                if row is not None:
+                    self._conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    self._conn.commit()
+                self.misses += 1
+                instrumentation.incr('cache_misses_total', cache=self.path.stem)
+                return None
+            self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            self.hits += 1
+        instrumentation.incr('cache_hits_total', cache=self.path.stem)
+        return json.loads(row[0])
+
+    # 値を保存する(ttlを省略した場合はキャッシュ全体の設定を使う)
+    def set(self, key, value, ttl=None, expires_at=None):
+        now = time.time()
+        if expires_at is None:
+            ttl = self.ttl if ttl is None else ttl
+            expires_at = now + ttl if ttl else None
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO cache (key, value, created_at, accessed_at, expires_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value, ensure_ascii=False), now, now, expires_at))
+            # 削除処理は全件を走査するので、書き込み100回ごとにまとめて行う
+            self._writes += 1
+            if self._writes % 100 == 1:
+                self._evict(now)
+            self._conn.commit()
+
+    # 期限切れと上限超過分を削除する
+    def _evict(self, now):
+        self._conn.execute("DELETE FROM cache WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        if self.max_entries:
+            self._conn.execute(
+                "DELETE FROM cache WHERE key IN ("
+                " SELECT key FROM cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,))
+
+    # 保存されている値をすべて返す(記録したレスポンスの検証用)
+    def values(self, include_expired=False):
+        with self._lock:
+            rows = self._conn.execute("SELECT value, expires_at FROM cache ORDER BY created_at").fetchall()
+        now = time.time()
+        return [json.loads(value) for value, expires_at in rows
+                if include_expired or expires_at is None or expires_at > now]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_llm_cache = None
+_llm_cache_lock = threading.Lock()
+
+# 要約処理で共有するLLMキャッシュを取得
+def get_llm_cache():
+    global _llm_cache
+    with _llm_cache_lock:
+        if _llm_cache is None:
+            _llm_cache = SQLiteCache(
+                LLM_CACHE_PATH,
+                max_entries=LLM_CACHE_MAX_ENTRIES,
+                ttl=LLM_CACHE_TTL_DAYS * 24 * 60 * 60)
+        return _llm_cache
@@ -0,0 +1,70 @@
+import os
+import json
+import threading
+from datetime import datetime, timedelta
+from pathlib import Path
+
+# チェックポイントの保存先
+CHECKPOINT_PATH = os.getenv("CHECKPOINT_PATH", "data/state/checkpoints.json")
+# 長期間止まっていた場合でも、さかのぼって取得するのはこの日数まで
+CHECKPOINT_MAX_LOOKBACK_DAYS = float(os.getenv("CHECKPOINT_MAX_LOOKBACK_DAYS", "30"))
+
+# 同じファイルを使うストアのsave()を順番に行うためのロック
+_save_lock = threading.Lock()
+
+# 取得元とキーワードごとに、取得済みの最新のID・時刻(ハイウォーターマーク)を保存する
+# 値は処理が成功してからsave()で書き込むので、失敗した場合は前回のチェックポイントから再開できる
+# python -m app runでは取得元ごとに別のストアを使うので、save()は自分が更新した値だけをファイルに反映する
+class CheckpointStore:
+    def __init__(self, path=CHECKPOINT_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._data = self._load()
+        self._changed = set()
+
+    def _load(self):
+        if not self.path.exists():
+            return {}
+        with self.path.open(encoding='utf-8') as f:
+            return json.load(f)
+
+    def get(self, source, key, default=None):
+        with self._lock:
+            entry = self._data.get(source, {}).get(key)
+        return entry['value'] if entry else default
+
+    def set(self, source, key, value):
+        with self._lock:
+            self._data.setdefault(source, {})[key] = {
+                'value': value,
+                'updated_at': datetime.now().isoformat(timespec='seconds'),
+            }
+            self._changed.add((source, key))
+
+    # 今の値より新しい場合だけ更新する
+    def advance(self, source, key, value, newer=None):
+        newer = newer or (lambda a, b: a > b)
+        current = self.get(source, key)
+        if current is None or newer(value, current):
+            self.set(source, key, value)
+
+    # ファイルを読み直し、このストアで更新した値だけを書き戻す(他の取得元が先に保存した値は消さない)
+    # 一時ファイルに書いてから置き換えるので、書き込み途中で落ちても壊れない
+    def save(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with _save_lock, self._lock:
+            data = self._load()
+            for source, key in self._changed:
+                data.setdefault(source, {})[key] = self._data[source][key]
+            with tmp_path.open('w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, self.path)
+            self._changed.clear()
+
+# チェックポイント(UNIX時刻)と既定の開始時刻から、取得を開始する時刻を決める
+def resume_timestamp(checkpoint, default_start):
+    if checkpoint is None:
+        return default_start
+    oldest = (datetime.now() - timedelta(days=CHECKPOINT_MAX_LOOKBACK_DAYS)).timestamp()
+    return max(checkpoint, oldest)
@@ -0,0 +1,129 @@
+import queue
+import atexit
+import threading
+from urllib.parse import urlsplit
+import http_client
+
+# Discordのメッセージの上限
+MAX_EMBED_DESCRIPTION_LENGTH = 4096
+MAX_EMBEDS_PER_MESSAGE = 10
+MAX_EMBED_TOTAL_LENGTH = 6000
+# 1つのメッセージを送信する回数の上限(429で送り直す分を含む)
+MAX_SEND_ATTEMPTS = 5
+
+SEPARATOR = "\n\n"
+
+# 上限を超えるテキストを、段落・行・空白の順に区切りの良い位置で分割する
+def split_text(text, limit):
+    if len(text) <= limit:
+        return [text]
+    for separator in ("\n\n", "\n", " "):
+        position = text.rfind(separator, 0, limit + 1)
+        if position > 0:
+            head = text[:position]
+            tail = text[position + len(separator):]
+            return [head] + split_text(tail, limit)
+    # 区切りが見つからない場合は文字単位で分割する
+    return [text[:limit]] + split_text(text[limit:], limit)
+
+# テキストのブロックを、できるだけ少ないメッセージ(1メッセージあたり最大10個のembed)に詰める
+def pack_messages(blocks):
+    pieces = []
+    for block in blocks:
+        if block:
+            pieces.extend(split_text(block, MAX_EMBED_DESCRIPTION_LENGTH))
+
+    payloads = []
+    embeds = []
+    description = ""
+    total = 0  # 確定済みのembedの文字数の合計
+
+    def close_embed():
+        nonlocal description, total
+        if description:
+            embeds.append({"description": description})
+            total += len(description)
+            description = ""
+
+    def close_message():
+        nonlocal embeds, total
+        close_embed()
+        if embeds:
+            payloads.append({"embeds": embeds})
+        embeds = []
+        total = 0
+
+    for piece in pieces:
+        candidate = description + SEPARATOR + piece if description else piece
+        if len(candidate) <= MAX_EMBED_DESCRIPTION_LENGTH and total + len(candidate) <= MAX_EMBED_TOTAL_LENGTH:
+            description = candidate
+            continue
+        # 今のembedには入らないので、新しいembed(必要なら新しいメッセージ)に入れる
+        close_embed()
+        if len(embeds) >= MAX_EMBEDS_PER_MESSAGE or total + len(piece) > MAX_EMBED_TOTAL_LENGTH:
+            close_message()
+        description = piece
+    close_message()
+    return payloads
+
+# Discord Webhookへの通知をキューに溜めて、バックグラウンドでまとめて送信する
+# 送信できなかったメッセージの数はfailed_countに数える(Webhook URLが未設定で捨てたものを含む)
+class DiscordNotifier:
+    def __init__(self, webhook_url):
+        self.webhook_url = webhook_url
+        self.sent_count = 0
+        self.failed_count = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+        # レート制限はWebhookごとに管理する
+        self._bucket_key = "discord:" + urlsplit(webhook_url or "").path
+
+    # テキストを1つのブロックとして送信キューに入れる
+    def send(self, text):
+        self.send_blocks([text])
+
+    # 複数のブロックを詰めて送信キューに入れる(上限を超えるブロックだけ区切りの良い位置で分割する)
+    def send_blocks(self, blocks):
+        if not self.webhook_url:
+            print("Discord Webhook URL is not set.")
+            self.failed_count += len(pack_messages(blocks))
+            return
+        for payload in pack_messages(blocks):
+            self._queue.put(payload)
+        self._ensure_worker()
+
+    # キューが空になるまで待ち、これまでのメッセージがすべて送信できたかを返す
+    def flush(self):
+        if self._thread is not None:
+            self._queue.join()
+        return self.failed_count == 0
+
+    def _ensure_worker(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker, daemon=True)
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _worker(self):
+        while True:
+            payload = self._queue.get()
+            try:
+                self._post(payload)
+            except Exception as e:
+                print(f"Failed to send notification: {e}")
+                self.failed_count += 1
+            finally:
+                self._queue.task_done()
+
+    # 429はhttp_clientがRetry-Afterに従って送り直す(5xxは二重投稿を避けるため送り直さない)
+    def _post(self, payload):
+        response = http_client.post(self.webhook_url, json=payload, throttle_key=self._bucket_key,
+                                    retries=MAX_SEND_ATTEMPTS - 1)
+        if response.status_code not in (200, 204):
+            print(f"Failed to send notification: {response.status_code}")
+            print(f"Response content: {response.content.decode('utf-8')}")
+            self.failed_count += 1
+        else:
+            self.sent_count += 1
@@ -0,0 +1,105 @@
+import os
+import json
+import threading
+from pathlib import Path
+from google.auth.credentials import AnonymousCredentials
+from google.oauth2 import service_account
+from googleapiclient.discovery import build
+from googleapiclient.http import MediaFileUpload, MediaIoBaseDownload
+import instrumentation
+
+SCOPES = ['https://www.googleapis.com/auth/drive.file']
+
+# 1チャンクのサイズ(256KBの倍数である必要がある)と、チャンクごとのリトライ回数
+DRIVE_UPLOAD_CHUNK_SIZE = int(os.getenv('DRIVE_UPLOAD_CHUNK_SIZE', str(8 * 1024 * 1024)))
+DRIVE_UPLOAD_RETRIES = int(os.getenv('DRIVE_UPLOAD_RETRIES', '5'))
+# APIのエンドポイントを差し替える場合(ベンチマーク用のローカルのスタンドイン)に設定する
+DRIVE_API_ENDPOINT = os.getenv('DRIVE_API_ENDPOINT')
+
+# スレッドごとに作成したクライアント
+_services = threading.local()
+
+# Google Drive APIクライアントを作成
+# 認証情報はサービスアカウントのJSONファイルのパスとJSON文字列のどちらでもよい
+# クライアントが使うhttplib2はスレッドセーフではないので、python -m app runで並列に動く取得元が
+# 同じクライアントでアップロードしないように、スレッドごとに作成して使い回す
+def create_drive_service(credentials_value=None):
+    cache = getattr(_services, 'cache', None)
+    if cache is None:
+        cache = _services.cache = {}
+    if credentials_value not in cache:
+        cache[credentials_value] = _build_drive_service(credentials_value)
+    return cache[credentials_value]
+
+def _build_drive_service(credentials_value):
+    # スタンドインは認証しないので、認証情報なしで接続する
+    if DRIVE_API_ENDPOINT:
+        return build('drive', 'v3', credentials=AnonymousCredentials(), cache_discovery=False,
+                     client_options={'api_endpoint': DRIVE_API_ENDPOINT})
+    credentials_value = credentials_value or os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    if not credentials_value:
+        raise ValueError("環境変数 'GOOGLE_APPLICATION_CREDENTIALS' が設定されていません。")
+    if os.path.exists(credentials_value):
+        credentials = service_account.Credentials.from_service_account_file(
+            credentials_value, scopes=SCOPES)
+    else:
+        credentials = service_account.Credentials.from_service_account_info(
+            json.loads(credentials_value), scopes=SCOPES)
+    return build('drive', 'v3', credentials=credentials, cache_discovery=False)
+
+# アップロードのリクエストを作成する
+# api_endpointを差し替えても、アップロード先のURLはhttpsのままになるので、スタンドインのスキームに合わせる
+def _create_request(service, file_metadata, media):
+    request = service.files().create(body=file_metadata, media_body=media, fields='id')
+    if DRIVE_API_ENDPOINT and DRIVE_API_ENDPOINT.startswith('http://'):
+        request.uri = request.uri.replace('https://', 'http://', 1)
+    return request
+
+# チャンクごとに送信する(各チャンクは失敗時にnum_retries回までリトライされる)
+@instrumentation.span('drive.upload')
+def _execute_resumable(request):
+    response = None
+    while response is None:
+        status, response = request.next_chunk(num_retries=DRIVE_UPLOAD_RETRIES)
+        instrumentation.incr('drive_upload_chunks_total')
+        if status:
+            print(f"Uploaded {status.resumable_progress} bytes")
+    print(f"File ID: {response.get('id')}")
+    return response
+
+# ローカルのファイルをGoogle Driveへアップロード(nameを省略した場合はファイル名のまま)
+def upload_file(service, file_path, folder_id, mimetype=None, name=None):
+    file_metadata = {'name': name or os.path.basename(file_path), 'parents': [folder_id]}
+    media = MediaFileUpload(str(file_path), mimetype=mimetype, chunksize=DRIVE_UPLOAD_CHUNK_SIZE, resumable=True)
+    instrumentation.incr('drive_upload_bytes_total', os.path.getsize(file_path))
+    request = _create_request(service, file_metadata, media)
+    return _execute_resumable(request)
+
+# フォルダ内で名前がprefixで始まるファイルの一覧を返す({'id', 'name'} のリスト)
+def list_files(service, folder_id, prefix=''):
+    query = f"'{folder_id}' in parents and trashed = false"
+    if prefix:
+        query += f" and name contains '{prefix}'"
+    files = []
+    page_token = None
+    while True:
+        response = service.files().list(q=query, fields='nextPageToken, files(id, name)',
+                                        pageSize=1000, pageToken=page_token).execute()
+        files.extend(item for item in response.get('files', []) if item['name'].startswith(prefix))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return files
+
+# Google Driveのファイルをチャンクごとにダウンロードする(書き終わってから置き換えるので途中のファイルは残らない)
+@instrumentation.span('drive.download')
+def download_file(service, file_id, path):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open('wb') as f:
+        downloader = MediaIoBaseDownload(f, service.files().get_media(fileId=file_id), chunksize=DRIVE_UPLOAD_CHUNK_SIZE)
+        done = False
+        while not done:
+            _, done = downloader.next_chunk(num_retries=DRIVE_UPLOAD_RETRIES)
+    os.replace(tmp_path, path)
+    return path
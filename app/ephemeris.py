@@ -0,0 +1,281 @@
+import os
+import sys
+import json
+import math
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# 月のフェーズ・輝面比・出没時刻と、地平線より上にある星座をローカルで計算する
+# 太陽と月の位置は略算式(太陽は0.01度、月は0.3度程度の精度)を使う
+
+# 星座の中心の赤経(時)・赤緯(度)
+CONSTELLATION_CENTERS = {
+    'Andromeda': (0.81, 37.4), 'Antlia': (10.27, -32.5), 'Apus': (16.14, -75.3), 'Aquarius': (22.29, -10.8),
+    'Aquila': (19.67, 3.4), 'Ara': (17.37, -56.6), 'Aries': (2.64, 20.8), 'Auriga': (6.04, 42.0),
+    'Bootes': (14.71, 31.2), 'Caelum': (4.70, -38.0), 'Camelopardalis': (8.86, 69.4), 'Cancer': (8.65, 19.8),
+    'Canes Venatici': (13.12, 40.1), 'Canis Major': (6.83, -22.1), 'Canis Minor': (7.65, 6.4),
+    'Capricornus': (21.05, -18.0), 'Carina': (8.70, -63.2), 'Cassiopeia': (1.32, 62.2), 'Centaurus': (13.07, -47.3),
+    'Cepheus': (2.54, 71.0), 'Cetus': (1.67, -7.2), 'Chamaeleon': (10.69, -79.2), 'Circinus': (14.58, -63.0),
+    'Columba': (5.86, -35.1), 'Coma Berenices': (12.79, 23.3), 'Corona Australis': (18.65, -41.1),
+    'Corona Borealis': (15.84, 32.6), 'Corvus': (12.44, -18.4), 'Crater': (11.40, -15.9), 'Crux': (12.45, -60.2),
+    'Cygnus': (20.59, 44.5), 'Delphinus': (20.69, 11.7), 'Dorado': (5.24, -59.4), 'Draco': (15.14, 67.0),
+    'Equuleus': (21.19, 7.8), 'Eridanus': (3.30, -28.8), 'Fornax': (2.80, -31.6), 'Gemini': (7.07, 22.6),
+    'Grus': (22.46, -46.4), 'Hercules': (17.39, 27.5), 'Horologium': (3.28, -53.3), 'Hydra': (11.61, -14.5),
+    'Hydrus': (2.34, -69.9), 'Indus': (21.97, -59.7), 'Lacerta': (22.46, 46.0), 'Leo': (10.67, 13.1),
+    'Leo Minor': (10.25, 32.1), 'Lepus': (5.57, -19.0), 'Libra': (15.20, -15.2), 'Lupus': (15.22, -42.7),
+    'Lynx': (7.99, 47.5), 'Lyra': (18.85, 36.7), 'Mensa': (5.42, -77.5), 'Microscopium': (20.96, -36.3),
+    'Monoceros': (7.06, 0.3), 'Musca': (12.59, -70.2), 'Norma': (15.90, -51.4), 'Octans': (23.00, -82.2),
+    'Ophiuchus': (17.39, -7.9), 'Orion': (5.58, 5.9), 'Pavo': (19.61, -65.8), 'Pegasus': (22.70, 19.5),
+    'Perseus': (3.18, 45.0), 'Phoenix': (0.93, -48.6), 'Pictor': (5.71, -53.5), 'Pisces': (0.48, 13.7),
+    'Piscis Austrinus': (22.28, -30.6), 'Puppis': (7.26, -31.2), 'Pyxis': (8.95, -27.4), 'Reticulum': (3.92, -60.0),
+    'Sagitta': (19.65, 18.9), 'Sagittarius': (19.10, -28.5), 'Scorpius': (16.89, -27.0), 'Sculptor': (0.44, -32.1),
+    'Scutum': (18.67, -9.9), 'Serpens': (16.95, 6.1), 'Sextans': (10.27, -2.6), 'Taurus': (4.70, 14.9),
+    'Telescopium': (19.32, -51.0), 'Triangulum': (2.18, 31.5), 'Triangulum Australe': (16.08, -65.4),
+    'Tucana': (23.78, -65.8), 'Ursa Major': (11.31, 50.7), 'Ursa Minor': (15.00, 77.7), 'Vela': (9.58, -47.2),
+    'Virgo': (13.41, -4.2), 'Volans': (7.80, -69.8), 'Vulpecula': (20.23, 24.4),
+}
+
+# 星座の中心がこの高度(度)以上なら「観測できる」とみなす
+MIN_CONSTELLATION_ALTITUDE = float(os.getenv("MIN_CONSTELLATION_ALTITUDE", "15"))
+# 星座を評価する現地時刻(時)
+OBSERVATION_HOUR = int(os.getenv("OBSERVATION_HOUR", "21"))
+# プロンプトに含める星座の数(高度が高い順、rawには全件を残す)
+MAX_CONSTELLATIONS = int(os.getenv("MAX_CONSTELLATIONS", "8"))
+
+# 出没を判定する高度(大気差と視半径を考慮した値)
+SUN_HORIZON = -0.833
+MOON_HORIZON = 0.125
+# 月の平均の地平視差(度)
+MOON_PARALLAX = 0.9507
+
+# 離角(月と太陽の黄経差)を45度ずつに分けたときのフェーズ名(AstronomyAPIと同じ表記)
+PHASE_NAMES = ['New Moon', 'Waxing Crescent', 'First Quarter', 'Waxing Gibbous',
+               'Full Moon', 'Waning Gibbous', 'Last Quarter', 'Waning Crescent']
+
+# 引数にnumpyの配列があればnumpy、なければmathの関数を使う
+# 以下の計算はスカラーでも配列(sky_forecastの地点×時刻の格子)でも同じ式で行える
+def _xp(*values):
+    for value in values:
+        if type(value).__module__ == 'numpy':
+            return sys.modules['numpy']
+    return math
+
+def _clip(xp, value):
+    return max(-1.0, min(1.0, value)) if xp is math else xp.clip(value, -1.0, 1.0)
+
+# J2000.0からの日数(datetimeかUNIX時刻、またはUNIX時刻の配列)
+def days_since_j2000(when):
+    unix_time = when.timestamp() if isinstance(when, datetime) else when
+    return unix_time / 86400.0 + 2440587.5 - 2451545.0
+
+def _equatorial(longitude, latitude, d):
+    xp = _xp(longitude, latitude, d)
+    e = xp.radians(23.439 - 0.00000036 * d)
+    x = xp.cos(latitude) * xp.cos(longitude)
+    y = xp.cos(e) * xp.cos(latitude) * xp.sin(longitude) - xp.sin(e) * xp.sin(latitude)
+    z = xp.sin(e) * xp.cos(latitude) * xp.sin(longitude) + xp.cos(e) * xp.sin(latitude)
+    return xp.atan2(y, x), xp.asin(z)
+
+# 太陽の黄経と赤経・赤緯(ラジアン)
+def sun_position(d):
+    xp = _xp(d)
+    g = xp.radians(357.529 + 0.98560028 * d)
+    longitude = xp.radians(280.459 + 0.98564736 * d + 1.915 * xp.sin(g) + 0.020 * xp.sin(2 * g))
+    ra, dec = _equatorial(longitude, 0.0, d)
+    return longitude, ra, dec
+
+# 月の黄経・黄緯と赤経・赤緯(ラジアン)
+def moon_position(d):
+    xp = _xp(d)
+    t = d / 36525.0
+    def s(a, b):
+        return xp.sin(xp.radians(a + b * t))
+    longitude = xp.radians(218.32 + 481267.881 * t
+                           + 6.29 * s(134.9, 477198.85) - 1.27 * s(259.2, -413335.38)
+                           + 0.66 * s(235.7, 890534.23) + 0.21 * s(269.9, 954397.70)
+                           - 0.19 * s(357.5, 35999.05) - 0.11 * s(186.6, 966404.05))
+    latitude = xp.radians(5.13 * s(93.3, 483202.03) + 0.28 * s(228.2, 960400.87)
+                          - 0.28 * s(318.3, 6003.18) - 0.17 * s(217.6, -407332.20))
+    ra, dec = _equatorial(longitude, latitude, d)
+    return longitude, latitude, ra, dec
+
+# 赤経・赤緯から、地点での高度と方位(度、方位は北から東回り)を求める
+def horizontal(lat, lon, d, ra, dec):
+    xp = _xp(lat, lon, d, ra, dec)
+    hour_angle = xp.radians(280.46061837 + 360.98564736629 * d + lon) - ra
+    lat = xp.radians(lat)
+    sin_alt = xp.sin(lat) * xp.sin(dec) + xp.cos(lat) * xp.cos(dec) * xp.cos(hour_angle)
+    altitude = xp.asin(_clip(xp, sin_alt))
+    azimuth = xp.atan2(-xp.sin(hour_angle) * xp.cos(dec),
+                       xp.sin(dec) * xp.cos(lat) - xp.cos(dec) * xp.sin(lat) * xp.cos(hour_angle))
+    return xp.degrees(altitude), xp.degrees(azimuth) % 360
+
+# 月の輝面比(0〜1)。太陽と月の離角から求める
+def moon_illumination(sun_longitude, moon_longitude, moon_latitude):
+    xp = _xp(sun_longitude, moon_longitude, moon_latitude)
+    elongation = xp.acos(xp.cos(moon_latitude) * xp.cos(moon_longitude - sun_longitude))
+    return (1 - xp.cos(elongation)) / 2
+
+# 地心からの月の高度(度)を、地表から見た高度に直す(視差の分だけ下げる)
+# 出没の判定(MOON_HORIZON)は地心からの高度を前提にしているので、高度を表示・比較するときだけ使う
+def topocentric_moon_altitude(altitude):
+    xp = _xp(altitude)
+    altitude = xp.radians(altitude)
+    return xp.degrees(altitude - xp.asin(math.sin(math.radians(MOON_PARALLAX)) * xp.cos(altitude)))
+
+def sun_altitude(lat, lon, when):
+    d = days_since_j2000(when)
+    _, ra, dec = sun_position(d)
+    return horizontal(lat, lon, d, ra, dec)[0]
+
+def moon_altitude(lat, lon, when):
+    d = days_since_j2000(when)
+    _, _, ra, dec = moon_position(d)
+    return horizontal(lat, lon, d, ra, dec)[0]
+
+def moon_topocentric_altitude(lat, lon, when):
+    return topocentric_moon_altitude(moon_altitude(lat, lon, when))
+
+# 月のフェーズ名・輝面比・月齢の目安(日)
+def moon_phase(when):
+    d = days_since_j2000(when)
+    sun_longitude, _, _ = sun_position(d)
+    moon_longitude, moon_latitude, _, _ = moon_position(d)
+    difference = (math.degrees(moon_longitude - sun_longitude)) % 360
+    return {
+        'phase': PHASE_NAMES[int(((difference + 22.5) % 360) // 45)],
+        'illumination': round(moon_illumination(sun_longitude, moon_longitude, moon_latitude), 4),
+        'age_days': round(difference / 360 * 29.530588, 2),
+        'angle': round(difference, 2),
+    }
+
+# 1日の中で高度がhorizonをまたぐ時刻を探す(10分ごとに調べてから二分法で絞り込む)
+def rise_set(altitude_at, start, horizon, step_minutes=10):
+    rise = set_ = None
+    step = timedelta(minutes=step_minutes)
+    previous_time = start
+    previous = altitude_at(start) - horizon
+    for i in range(1, 24 * 60 // step_minutes + 1):
+        current_time = start + step * i
+        current = altitude_at(current_time) - horizon
+        if (previous < 0) != (current < 0):
+            low, high = previous_time, current_time
+            for _ in range(12):
+                middle = low + (high - low) / 2
+                if (altitude_at(middle) - horizon < 0) == (previous < 0):
+                    low = middle
+                else:
+                    high = middle
+            if previous < 0 and rise is None:
+                rise = high
+            elif previous >= 0 and set_ is None:
+                set_ = high
+        previous_time, previous = current_time, current
+    return rise, set_
+
+# 地平線より上にある星座(中心の高度が高い順)
+def visible_constellations(lat, lon, when, min_altitude=MIN_CONSTELLATION_ALTITUDE):
+    d = days_since_j2000(when)
+    visible = []
+    for name, (ra_hours, dec) in CONSTELLATION_CENTERS.items():
+        altitude, azimuth = horizontal(lat, lon, d, math.radians(ra_hours * 15), math.radians(dec))
+        if altitude >= min_altitude:
+            visible.append({'name': name, 'altitude': round(altitude, 1), 'azimuth': round(azimuth, 1)})
+    return sorted(visible, key=lambda item: -item['altitude'])
+
+def _format(when, tz):
+    return when.astimezone(tz).isoformat(timespec='minutes') if when else None
+
+# fetch_astronomy.get_astronomy_dataと同じ形で、月のフェーズと観測できる星座を返す
+# constellationsの意味はAPIと異なり、太陽・月・惑星がある星座ではなく、OBSERVATION_HOUR時に
+# 中心がMIN_CONSTELLATION_ALTITUDE度以上にある星座(高い順にMAX_CONSTELLATIONS個まで)になる
+# 時差を省略した場合は経度から求める(日本なら+9時間)
+def get_astronomy_data(lat, lon, elevation=0, date=None, utc_offset_hours=None):
+    lat, lon = float(lat), float(lon)
+    offset = round(lon / 15) if utc_offset_hours is None else utc_offset_hours
+    tz = timezone(timedelta(hours=offset))
+    day = datetime.strptime(date, "%Y-%m-%d") if date else datetime.now(tz)
+    midnight = datetime(day.year, day.month, day.day, tzinfo=tz)
+    observed_at = midnight + timedelta(hours=OBSERVATION_HOUR)
+
+    phase = moon_phase(observed_at)
+    sunrise, sunset = rise_set(lambda t: sun_altitude(lat, lon, t), midnight, SUN_HORIZON)
+    moonrise, moonset = rise_set(lambda t: moon_altitude(lat, lon, t), midnight, MOON_HORIZON)
+    constellations = visible_constellations(lat, lon, observed_at)
+    return {
+        'moon_phase': phase['phase'],
+        'constellations': [item['name'] for item in constellations[:MAX_CONSTELLATIONS]],
+        'raw': {
+            'source': 'local',
+            'observer': {'latitude': lat, 'longitude': lon, 'elevation': elevation},
+            'observed_at': observed_at.isoformat(timespec='minutes'),
+            'moon': {**phase, 'altitude': round(moon_topocentric_altitude(lat, lon, observed_at), 1),
+                     'rise': _format(moonrise, tz), 'set': _format(moonset, tz)},
+            'sun': {'rise': _format(sunrise, tz), 'set': _format(sunset, tz)},
+            'constellations': constellations,
+        },
+    }
+
+# 記録したAstronomyAPIのレスポンスと計算結果を比べる
+# 月のフェーズ名・輝面比・離角と、各天体の時刻での月・太陽の高度の差を返す
+def compare_with_response(data):
+    table = data['data']['table']['rows']
+    observer = data['data']['observer']['location']
+    lat, lon = float(observer['latitude']), float(observer['longitude'])
+    result = {'latitude': lat, 'longitude': lon}
+    for row in table:
+        body = row.get('entry', {}).get('id')
+        if body not in ('moon', 'sun'):
+            continue
+        cell = row['cells'][0]
+        when = datetime.fromisoformat(cell['date'].replace('Z', '+00:00'))
+        result['date'] = when.isoformat(timespec='minutes')
+        api_altitude = float(cell['position']['horizontal']['altitude']['degrees'])
+        local_altitude = moon_topocentric_altitude(lat, lon, when) if body == 'moon' else sun_altitude(lat, lon, when)
+        result[f'{body}_altitude_error'] = round(local_altitude - api_altitude, 2)
+        if body == 'moon':
+            phase = moon_phase(when)
+            api_phase = cell['extraInfo']['phase']
+            result['phase_api'] = api_phase['string']
+            result['phase_local'] = phase['phase']
+            result['illumination_error'] = round(phase['illumination'] - float(api_phase['fraction']), 3)
+            if 'angel' in api_phase:  # AstronomyAPIの表記のまま
+                difference = (phase['angle'] - float(api_phase['angel']) + 180) % 360 - 180
+                result['phase_angle_error'] = round(difference, 2)
+    return result
+
+def load_responses(directory=None):
+    if directory:
+        for path in sorted(Path(directory).glob('*.json')):
+            with path.open(encoding='utf-8') as f:
+                yield json.load(f)
+        return
+    # 指定がなければfetch_astronomyのキャッシュに残っているレスポンスを使う
+    from fetch_astronomy import get_cache
+    for value in get_cache().values(include_expired=True):
+        if isinstance(value, dict) and 'raw' in value:
+            yield value['raw']
+
+def validate(directory=None):
+    results = [compare_with_response(data) for data in load_responses(directory)]
+    if not results:
+        print("No recorded AstronomyAPI responses found.")
+        return results
+    for result in results:
+        print(json.dumps(result, ensure_ascii=False))
+    phase_matches = sum(result.get('phase_api') == result.get('phase_local') for result in results)
+    worst = max(abs(result.get('moon_altitude_error', 0)) for result in results)
+    print(f"Moon phase matched {phase_matches}/{len(results)}, worst moon altitude error {worst}°")
+    return results
+
+if __name__ == "__main__":
+    # python ephemeris.py validate [--responses レスポンスのディレクトリ]
+    # python ephemeris.py 緯度 経度 [YYYY-MM-DD]
+    if len(sys.argv) > 1 and sys.argv[1] == 'validate':
+        args = [arg for arg in sys.argv[2:] if arg != '--responses']
+        validate(args[0] if args else None)
+    elif len(sys.argv) >= 3:
+        print(json.dumps(get_astronomy_data(sys.argv[1], sys.argv[2], date=sys.argv[3] if len(sys.argv) > 3 else None),
+                         ensure_ascii=False, indent=2))
+    else:
+        print("Usage: python ephemeris.py validate [--responses DIR] | python ephemeris.py LAT LON [YYYY-MM-DD]")
@@ -1,8 +1,9 @@
 import os
-import requests
+import http_client
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
+from cache_store import SQLiteCache, make_key
 
 # .envファイルを読み込む
 load_dotenv()
@@ -10,43 +11,78 @@ load_dotenv()
 # 環境変数からAPIキーを取得
 ASTRONOMY_APPLICATION_ID = os.getenv("ASTRONOMY_APPLICATION_ID")
 ASTRONOMY_APPLICATION_SEACRET = os.getenv("ASTRONOMY_APPLICATION_SEACRET")
+ASTRONOMY_API_BASE_URL = os.getenv("ASTRONOMY_API_BASE_URL", "https://api.astronomyapi.com")
 
-# AstronomyAPIを利用して月のフェーズを取得
-def get_moon_data(lat, lon):
-    today = datetime.now().strftime("%Y-%m-%d")
-    url = f"https://api.astronomyapi.com/api/v2/bodies/positions?latitude={lat}&longitude={lon}&elevation=0&from_date={today}&to_date={today}&time=00:00:00"
+# レスポンスのキャッシュの保存先
+ASTRONOMY_CACHE_PATH = os.getenv("ASTRONOMY_CACHE_PATH", "data/cache/astronomy_cache.sqlite3")
+
+_cache = None
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = SQLiteCache(ASTRONOMY_CACHE_PATH)
+    return _cache
+
+# その日の終わり(翌日0時)のUNIX時刻
+def end_of_day(date):
+    day = datetime.strptime(date, "%Y-%m-%d")
+    return (day + timedelta(days=1)).timestamp()
+
+# レスポンスから月のフェーズを取り出す
+def parse_moon_phase(data):
+    rows = data['data']['table']['rows']
+    for row in rows:
+        if row.get('entry', {}).get('id') == 'moon':
+            return row['cells'][0]['extraInfo']['phase']['string']
+    return rows[1]['cells'][0]['extraInfo']['phase']['string']
+
+# レスポンスから天体がある星座の一覧を取り出す
+def parse_constellations(data):
+    constellations = []
+    for row in data['data']['table']['rows']:
+        for cell in row['cells']:
+            if 'constellation' in cell['position']:
+                constellations.append(cell['position']['constellation']['name'])
+    return constellations
+
+# AstronomyAPIを利用して月のフェーズと観測できる星座の情報をまとめて取得
+# 同じ地点・日付の結果はその日の終わりまでキャッシュする
+def get_astronomy_data(lat, lon, elevation=0, date=None):
+    date = date or datetime.now().strftime("%Y-%m-%d")
+    cache = get_cache()
+    cache_key = make_key("bodies/positions", str(lat), str(lon), str(elevation), date)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    url = f"{ASTRONOMY_API_BASE_URL}/api/v2/bodies/positions?latitude={lat}&longitude={lon}&elevation={elevation}&from_date={date}&to_date={date}&time=00:00:00"
     userpass = f"{ASTRONOMY_APPLICATION_ID}:{ASTRONOMY_APPLICATION_SEACRET}"
     authString = base64.b64encode(userpass.encode()).decode()
     headers = {
         "Authorization": f"Basic {authString}"
     }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        return response.json()
-    else:
-        print(f"Failed to fetch moon data: {response.status_code}")
+    response = http_client.get(url, headers=headers)
+    if response.status_code != 200:
+        print(f"Failed to fetch astronomy data: {response.status_code}")
         print(f"Response content: {response.content.decode('utf-8')}")
         return None
 
+    data = response.json()
+    result = {
+        'moon_phase': parse_moon_phase(data),
+        'constellations': parse_constellations(data),
+        'raw': data,
+    }
+    cache.set(cache_key, result, expires_at=end_of_day(date))
+    return result
+
+# AstronomyAPIを利用して月のフェーズを取得
+def get_moon_data(lat, lon):
+    result = get_astronomy_data(lat, lon)
+    return result['raw'] if result else None
+
 # AstronomyAPIを利用して観測できる星座の情報を取得
 def get_visible_constellations(lat, lon):
-    today = datetime.now().strftime("%Y-%m-%d")
-    url = f"https://api.astronomyapi.com/api/v2/bodies/positions?latitude={lat}&longitude={lon}&elevation=0&from_date={today}&to_date={today}&time=00:00:00"
-    userpass = f"{ASTRONOMY_APPLICATION_ID}:{ASTRONOMY_APPLICATION_SEACRET}"
-    authString = base64.b64encode(userpass.encode()).decode()
-    headers = {
-        "Authorization": f"Basic {authString}"
-    }
-    response = requests.get(url, headers=headers)
-    if response.status_code == 200:
-        data = response.json()
-        constellations = []
-        for row in data['data']['table']['rows']:
-            for cell in row['cells']:
-                if 'constellation' in cell['position']:
-                    constellations.append(cell['position']['constellation']['name'])
-        return constellations
-    else:
-        print(f"Failed to fetch constellations data: {response.status_code}")
-        print(f"Response content: {response.content.decode('utf-8')}")
-        return None
\ No newline at end of file
+    result = get_astronomy_data(lat, lon)
+    return result['constellations'] if result else None
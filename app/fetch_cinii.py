@@ -1,6 +1,14 @@
 import os
-import requests
+import re
+import calendar
+import http_client
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from discord_notifier import DiscordNotifier
 from dotenv import load_dotenv
+from checkpoint import CheckpointStore
+from seen_index import SeenIndex
+import instrumentation
 
 # .envファイルを読み込む
 load_dotenv()
@@ -10,79 +18,149 @@ API_KEY = os.getenv("CINII_API_KEY")
 DISCORD_WEBHOOK_URL_SCHOLAR = os.getenv("DISCORD_WEBHOOK_URL_SCHOLAR")
 KEYWORDS = ['美学', '哲学', '詩学', '環境']
 
-def fetch_cinii_data(api_key, keywords):
-    results = []
-    base_url = "https://ci.nii.ac.jp/opensearch/search"
+# Discordへの通知はまとめてバックグラウンドで送信する
+notifier = DiscordNotifier(DISCORD_WEBHOOK_URL_SCHOLAR)
 
-    for keyword in keywords:
+# 検索のエンドポイントと、1ページの件数・最大ページ数
+CINII_BASE_URL = os.getenv("CINII_BASE_URL", "https://ci.nii.ac.jp")
+CINII_SEARCH_URL = f"{CINII_BASE_URL}/opensearch/search"
+CINII_PAGE_SIZE = int(os.getenv("CINII_PAGE_SIZE", "20"))
+CINII_MAX_PAGES = int(os.getenv("CINII_MAX_PAGES", "5"))
+# キーワードを同時に検索する数
+CINII_WORKERS = int(os.getenv("CINII_WORKERS", "4"))
+# この日数より前に出版されたものが出てきたら、それ以上のページは取得しない
+CINII_MAX_AGE_DAYS = int(os.getenv("CINII_MAX_AGE_DAYS", "365"))
+# キーワードごとに通知する最新の件数
+CINII_NOTIFY_COUNT = int(os.getenv("CINII_NOTIFY_COUNT", "3"))
+
+# 出版年月日は年のみ・年月のみの場合があるので、その期間の最後の日として比較する
+# (年のみの "2023" は 2023-12-31 とみなし、打ち切りの判定で早すぎて除かないようにする)
+def publication_end_date(value):
+    parts = re.findall(r'\d+', value or "")
+    if not parts:
+        return None
+    year = int(parts[0])
+    if len(parts) == 1:
+        return date(year, 12, 31)
+    month = min(max(int(parts[1]), 1), 12)
+    if len(parts) == 2:
+        return date(year, month, calendar.monthrange(year, month)[1])
+    return date(year, month, min(max(int(parts[2]), 1), calendar.monthrange(year, month)[1]))
+
+# 検索結果のアイテムを、通知に必要な項目だけの形にする
+def normalize_item(item, keyword):
+    link = (item.get('link') or {}).get('@id')
+    return {
+        'id': link,
+        'keyword': keyword,
+        'title': item.get('title'),
+        'link': link,
+        'publication_date': item.get('prism:publicationDate'),
+        'publisher': item.get('dc:publisher'),
+    }
+
+# 1つのキーワードについて、出版日の新しい順にページをたどって取得する
+# 前回通知したアイテム(last_link)か、打ち切りの日付より古いアイテムが出てきたらそこで止める
+def fetch_keyword(api_key, keyword, last_link=None, cutoff=None):
+    records = []
+    for page in range(CINII_MAX_PAGES):
         params = {
             'appid': api_key,
             'format': 'json',
             'q': keyword,
+            'sortorder': 1,  # 出版年の新しい順
+            'count': CINII_PAGE_SIZE,
+            'start': page * CINII_PAGE_SIZE + 1,
         }
-        response = requests.get(base_url, params=params)
-        if response.status_code == 200:
-            results.append({
-                'keyword': keyword,
-                'data': response.json()
-            })
-        else:
+        response = http_client.get(CINII_SEARCH_URL, params=params)
+        if response.status_code != 200:
             print(f"Error fetching data for keyword '{keyword}': {response.status_code}")
             response.raise_for_status()
+        data = response.json()
+        items = data.get('items', [])
+        for item in items:
+            record = normalize_item(item, keyword)
+            if last_link and record['link'] == last_link:
+                return records
+            published = publication_end_date(record['publication_date'])
+            if cutoff and published and published < cutoff:
+                return records
+            records.append(record)
+        total = int(data.get('opensearch:totalResults') or 0)
+        if len(items) < CINII_PAGE_SIZE or (page + 1) * CINII_PAGE_SIZE >= total:
+            break
+    return records
 
-    return results
+# キーワードごとの検索を並列に実行する
+# チェックポイント(キーワードごとの前回通知した最新のリンク)があれば、そこまでを取得する
+@instrumentation.span('cinii.fetch')
+def fetch_cinii_data(api_key, keywords, checkpoints=None):
+    cutoff = (datetime.now() - timedelta(days=CINII_MAX_AGE_DAYS)).date() if CINII_MAX_AGE_DAYS else None
+    with ThreadPoolExecutor(max_workers=max(1, min(CINII_WORKERS, len(keywords)))) as executor:
+        futures = [
+            executor.submit(fetch_keyword, api_key, keyword,
+                            checkpoints.get('cinii', keyword) if checkpoints else None, cutoff)
+            for keyword in keywords
+        ]
+        return [{'keyword': keyword, 'items': future.result()} for keyword, future in zip(keywords, futures)]
 
+# Discordに通知を送信
 def send_discord_notification(message):
-    if DISCORD_WEBHOOK_URL_SCHOLAR:
-        data = {"content": message}
-        response = requests.post(DISCORD_WEBHOOK_URL_SCHOLAR, json=data)
-        if response.status_code != 204:
-            print(f"Failed to send notification: {response.status_code}")
-            print(f"Response content: {response.content.decode('utf-8')}")
-    else:
-        print("Discord Webhook URL is not set.")
-
-def send_long_message(message):
-    max_length = 2000
-    for i in range(0, len(message), max_length):
-        send_discord_notification(message[i:i + max_length])
-
-# Ciniiは出版年月日が年のみ、月のみの場合があるので、
-# 最新n件を取得する
-if __name__ == "__main__":
+    notifier.send(message)
+
+# キーワードごとに、出版日の新しい順で未通知の最新n件を通知する
+def main():
     if not API_KEY:
         print("Error: CINII_API_KEY is not set in the .env file.")
         exit(1)
 
     try:
-        results = fetch_cinii_data(API_KEY, KEYWORDS)
+        checkpoints = CheckpointStore()
+        seen = SeenIndex()
+        results = fetch_cinii_data(API_KEY, KEYWORDS, checkpoints)
         for result in results:
             print(f"CiNii Search Results: {result['keyword']}")
+            # 以前に通知したアイテムは除く
+            items = [item for item in result['items'] if not seen.contains('cinii', item['id'])]
             messages = []
-            for i in range(min(3, len(result['data']['items']))):
-                item = result['data']['items'][i]
+            for item in items[:CINII_NOTIFY_COUNT]:
+                seen.mark('cinii', item['id'])
                 print(f"Title: {item['title']}")
-                print(f"Link: {item['link']['@id']}")
-                print(f"Publication Date: {item['prism:publicationDate']}")
-                print(f"Publisher: {item['dc:publisher']}")
+                print(f"Link: {item['link']}")
+                print(f"Publication Date: {item['publication_date']}")
+                print(f"Publisher: {item['publisher']}")
                 print()  # 空行を挿入して見やすくする
 
                 message = (
                     f"**Title:** {item['title']}\n"
-                    f"**Link:** {item['link']['@id']}\n"
-                    f"**Publication Date:** {item['prism:publicationDate']}\n"
-                    f"**Publisher:** {item['dc:publisher']}\n"
+                    f"**Link:** {item['link']}\n"
+                    f"**Publication Date:** {item['publication_date']}\n"
+                    f"**Publisher:** {item['publisher']}\n"
                 )
                 messages.append(message)
 
             if messages:
-                full_message = f"CiNii Search Results for {result['keyword']}:\n\n" + "\n\n".join(messages)
-                send_long_message(full_message)
+                header = f"CiNii Search Results for {result['keyword']}:"
+                with instrumentation.span('cinii.notify'):
+                    notifier.send_blocks([header] + messages)
+                # 通知した最新のアイテムのリンクをチェックポイントに記録する
+                checkpoints.set('cinii', result['keyword'], items[0]['link'])
 
         # 成功通知を送信
         # send_discord_notification("fetch_cinii.py ran successfully.")
+        with instrumentation.span('cinii.notify'):
+            delivered = notifier.flush()
+        # 送信できなかった通知があれば、次回の実行で同じアイテムを通知し直すように保存しない
+        if not delivered:
+            print(f"{notifier.failed_count} notifications failed; checkpoints and seen items were not saved.")
+            return
+        checkpoints.save()
+        seen.commit()
 
     except Exception as e:
         print(f"Error: {e}")
         # 失敗通知を送信
-        # send_discord_notification(f"fetch_cinii.py failed with error: {e}")
\ No newline at end of file
+        # send_discord_notification(f"fetch_cinii.py failed with error: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 import os
-import requests
+import http_client
 from dotenv import load_dotenv
 
 # .envファイルを読み込む
@@ -7,14 +7,28 @@ load_dotenv()
 
 # 環境変数からAPIキーを取得
 OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY")
+OPENWEATHER_BASE_URL = os.getenv("OPENWEATHER_BASE_URL", "http://api.openweathermap.org")
 
 # OpenWeather APIを利用して天気情報を取得
 def get_weather_data(lat, lon):
-    url = f"http://api.openweathermap.org/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric"
-    response = requests.get(url)
+    url = f"{OPENWEATHER_BASE_URL}/data/2.5/weather?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric"
+    response = http_client.get(url)
     if response.status_code == 200:
         return response.json()
     else:
         print(f"Failed to fetch weather data: {response.status_code}")
         print(f"Response content: {response.content.decode('utf-8')}")
-        return None
\ No newline at end of file
+        return None
+
+# OpenWeather APIを利用して5日間(3時間ごと)の天気予報を取得
+def get_forecast_data(lat, lon, count=None):
+    url = f"{OPENWEATHER_BASE_URL}/data/2.5/forecast?lat={lat}&lon={lon}&appid={OPENWEATHER_API_KEY}&units=metric"
+    if count:
+        url += f"&cnt={count}"
+    response = http_client.get(url)
+    if response.status_code == 200:
+        return response.json()
+    else:
+        print(f"Failed to fetch forecast data: {response.status_code}")
+        print(f"Response content: {response.content.decode('utf-8')}")
+        return None
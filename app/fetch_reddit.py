@@ -1,12 +1,20 @@
 import praw
 import os
-import json
+import queue
+from collections import deque
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from praw.models import MoreComments
 from dotenv import load_dotenv
-from pathlib import Path
 from datetime import datetime, timedelta
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from rate_limiter import RateLimiter
+from drive_uploader import create_drive_service, upload_file
+from record_writer import JsonlWriter
+from archive import ArchiveWriter
+import near_dup
+from checkpoint import CheckpointStore, resume_timestamp
+import http_client
+import instrumentation
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -17,108 +25,277 @@ client_secret = os.getenv('REDDIT_CLIENT_SECRET')
 google_drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
 google_credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 
-if not client_id or not client_secret:
-    print("Error: Reddit API credentials are not set in the .env file.")
-    exit(1)
-
-if not google_drive_folder_id:
-    print("Error: Google Drive folder ID is not set in the .env file.")
-    exit(1)
-
-if not google_credentials_path:
-    print("Error: Google Drive credentials path is not set in the .env file.")
-    exit(1)
-
-# Google Drive APIクライアントを作成
-def create_drive_service():
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = service_account.Credentials.from_service_account_file(
-        google_credentials_path, scopes=SCOPES)
-    return build('drive', 'v3', credentials=credentials)
-
-# Google Driveにファイルをアップロード
-def upload_to_drive(service, file_path, folder_id):
-    file_metadata = {
-        'name': file_path.name,
-        'parents': [folder_id]
-    }
-    media = MediaFileUpload(file_path, mimetype='application/json')
-    try:
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-        print(f"File ID: {file.get('id')}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        raise
+# コメント取得の並列数と上限
+# 「もっと見る」の展開1回がAPIリクエスト1回になるので、投稿ごと・全体でリクエスト数を制限する
+COMMENT_WORKERS = int(os.getenv('REDDIT_COMMENT_WORKERS', '4'))
+COMMENT_REQUESTS_PER_SUBMISSION = int(os.getenv('REDDIT_COMMENT_REQUESTS_PER_SUBMISSION', '20'))
+COMMENT_REQUEST_BUDGET = int(os.getenv('REDDIT_COMMENT_REQUEST_BUDGET', '300'))
+COMMENT_MAX_DEPTH = int(os.getenv('REDDIT_COMMENT_MAX_DEPTH', '0')) or None
+COMMENT_MAX_COUNT = int(os.getenv('REDDIT_COMMENT_MAX_COUNT', '0')) or None
+# RedditのOAuthクライアントは1分あたり100リクエストまで
+REDDIT_REQUESTS_PER_MINUTE = int(os.getenv('REDDIT_REQUESTS_PER_MINUTE', '90'))
+USER_AGENT = 'fetch_reddit/v1.0 (by asamiile)'
+# APIのURL(ベンチマークではローカルのスタンドインに向ける)
+REDDIT_OAUTH_URL = os.getenv('REDDIT_OAUTH_URL', 'https://oauth.reddit.com')
+REDDIT_URL = os.getenv('REDDIT_URL', 'https://www.reddit.com')
+
+reddit_limiter = RateLimiter(requests_per_minute=REDDIT_REQUESTS_PER_MINUTE)
+
+# 必要な環境変数が設定されているか確認
+def check_config():
+    if not client_id or not client_secret:
+        print("Error: Reddit API credentials are not set in the .env file.")
+        return False
+
+    if not google_drive_folder_id:
+        print("Error: Google Drive folder ID is not set in the .env file.")
+        return False
+
+    if not google_credentials_path:
+        print("Error: Google Drive credentials path is not set in the .env file.")
+        return False
+    return True
 
 # 前日の0時から23:59までのデータを取得するための時間範囲を計算
+# (チェックポイントがない場合の取得開始時刻に使う)
 def get_yesterday_time_range():
     end_time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     start_time = end_time - timedelta(days=1)
     return start_time, end_time
 
-# Redditからデータを検索して保存
-def search_reddit(keywords):
-    reddit = praw.Reddit(
+# Redditクライアントを作成
+def create_reddit():
+    return praw.Reddit(
         client_id=client_id,
         client_secret=client_secret,
-        user_agent='fetch_reddit/v1.0 (by asamiile)'
+        user_agent=USER_AGENT,
+        oauth_url=REDDIT_OAUTH_URL,
+        reddit_url=REDDIT_URL,
+        # PRAWはセッションのUser-Agentを書き換えるので、接続プールだけを共有する専用のセッションを渡す
+        requestor_kwargs={'session': http_client.create_session()}
     )
-    start_time, end_time = get_yesterday_time_range()
-    data = []
 
+# PRAWはスレッドセーフではないので、スレッドごとにクライアントを作る
+_thread_local = threading.local()
+
+def get_thread_reddit():
+    if not hasattr(_thread_local, 'reddit'):
+        _thread_local.reddit = create_reddit()
+    return _thread_local.reddit
+
+# 全体で使えるリクエスト数の残量を管理する
+class RequestBudget:
+    def __init__(self, limit):
+        self.remaining = limit
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+def format_comment(comment):
+    return {
+        'id': comment.id,
+        'body': comment.body,
+        'created_utc': datetime.utcfromtimestamp(comment.created_utc).strftime('%Y-%m-%d %H:%M:%S')
+    }
+
+# 1つの投稿のコメントを、取得できた順に少しずつ返す
+def iter_submission_comments(submission_id, budget,
+                             max_requests=COMMENT_REQUESTS_PER_SUBMISSION,
+                             max_depth=COMMENT_MAX_DEPTH,
+                             max_count=COMMENT_MAX_COUNT):
+    if not budget.acquire():
+        return
+    reddit = get_thread_reddit()
+    reddit_limiter.acquire()
+    submission = reddit.submission(id=submission_id)
+    with instrumentation.span('reddit.comments'):
+        comment_forest = submission.comments  # ここで最初のリクエストが発生する
+    requests_used = 1
+    seen_ids = set()
+    count = 0
+    # replace_moreは展開しなかった「もっと見る」をツリーから削除してしまうので、
+    # 1つずつcomments()で展開し、残りは展開を待つ列に積んでおく
+    pending = deque()
+    comments = comment_forest.list()
+
+    while True:
+        for comment in comments:
+            if isinstance(comment, MoreComments):
+                pending.append(comment)
+                continue
+            if comment.id in seen_ids:
+                continue
+            seen_ids.add(comment.id)
+            if max_depth is not None and getattr(comment, 'depth', 0) >= max_depth:
+                continue
+            yield format_comment(comment)
+            count += 1
+            if max_count is not None and count >= max_count:
+                return
+
+        # 上限に達したら残りは諦める
+        if not pending or requests_used >= max_requests or not budget.acquire():
+            break
+        more = pending.popleft()
+        reddit_limiter.acquire()
+        with instrumentation.span('reddit.more_comments'):
+            expanded = more.comments()
+        requests_used += 1
+        # 展開したコメントの返信(その中の「もっと見る」を含む)も辿る
+        comments = []
+        for comment in expanded:
+            comments.append(comment)
+            if not isinstance(comment, MoreComments):
+                comments.extend(comment.replies.list())
+
+# 複数の投稿のコメントを並列に取得し、届いたものから (投稿ID, コメント) の組で返す
+def stream_comments(submission_ids, budget=None, workers=COMMENT_WORKERS):
+    budget = budget or RequestBudget(COMMENT_REQUEST_BUDGET)
+    results = queue.Queue()
+    done = object()
+
+    def worker(submission_id):
+        try:
+            for comment_data in iter_submission_comments(submission_id, budget):
+                results.put((submission_id, comment_data))
+        except Exception as e:
+            print(f"Error fetching comments for {submission_id}: {e}")
+        finally:
+            results.put((submission_id, done))
+
+    submission_ids = list(submission_ids)
+    if not submission_ids:
+        return
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for submission_id in submission_ids:
+            executor.submit(worker, submission_id)
+        pending = len(submission_ids)
+        while pending:
+            submission_id, item = results.get()
+            if item is done:
+                pending -= 1
+                continue
+            yield submission_id, item
+
+# 検索クエリの最大長(Redditの検索は512文字まで)
+SEARCH_QUERY_MAX_LENGTH = 512
+
+# キーワードをOR検索のクエリにまとめる(長さの上限を超える場合は複数に分ける)
+# (クエリ, そのクエリに含まれるキーワード) の組のリストを返す
+def build_search_queries(keywords, max_length=SEARCH_QUERY_MAX_LENGTH):
+    queries = []
+    current = ""
+    group = []
     for keyword in keywords:
-        subreddit = reddit.subreddit('all')
-        results = subreddit.search(keyword, limit=100)  # 検索結果を増やす
+        term = f'"{keyword}"'
+        candidate = f"{current} OR {term}" if current else term
+        if current and len(candidate) > max_length:
+            queries.append((current, group))
+            current = term
+            group = [keyword]
+        else:
+            current = candidate
+            group.append(keyword)
+    if current:
+        queries.append((current, group))
+    return queries
+
+# 検索期間の開始時刻が収まる最小のtime_filterを選ぶ
+def choose_time_filter(start_time):
+    age = datetime.now() - start_time
+    for time_filter, limit in (('day', timedelta(days=1)), ('week', timedelta(days=7)),
+                               ('month', timedelta(days=31)), ('year', timedelta(days=365))):
+        if age <= limit:
+            return time_filter
+    return 'all'
+
+# Redditからデータを検索し、投稿とコメントを1件ずつレコードとして返す
+# 投稿は見つけた順に、コメントは投稿を集め終わってから並列に取得して届いた順に返す
+# キーワードごとのチェックポイント(取得済みの最新のcreated_utc)より新しい投稿だけを取得する
+# 他の取得元や別の投稿とほぼ同じ内容の投稿は、コメントも含めて取得・保存しない
+def search_reddit(keywords, checkpoints, near_dups=None):
+    reddit = create_reddit()
+    default_start, _ = get_yesterday_time_range()
+    submission_ids = []
+    seen_ids = set()
+
+    subreddit = reddit.subreddit('all')
+    for query, query_keywords in build_search_queries(keywords):
+        # まとめたキーワードのうち、最も古いチェックポイントから取得する
+        start_timestamp = min(
+            resume_timestamp(checkpoints.get('reddit', keyword), default_start.timestamp())
+            for keyword in query_keywords)
+        time_filter = choose_time_filter(datetime.fromtimestamp(start_timestamp))
+        newest = None
+
+        # 新しい順に取得し、開始時刻より古い投稿が出たらそれ以降のページは取得しない
+        results = instrumentation.timed(
+            subreddit.search(query, sort='new', time_filter=time_filter, limit=None), 'reddit.listing')
         for submission in results:
-            submission_time = datetime.utcfromtimestamp(submission.created_utc)
-            if not (start_time <= submission_time < end_time):
+            if submission.created_utc <= start_timestamp:
+                break
+            newest = max(newest or 0, submission.created_utc)
+            # 複数のキーワードに一致した投稿は1回だけ保存する
+            if submission.id in seen_ids:
+                continue
+            seen_ids.add(submission.id)
+            if near_dup.is_duplicate(near_dups, 'reddit', submission.id,
+                                     f"{submission.title}\n{submission.selftext}", submission.url):
                 continue
-            post_data = {
+            submission_ids.append(submission.id)
+            submission_time = datetime.utcfromtimestamp(submission.created_utc)
+            yield {
+                'type': 'submission',
+                'id': submission.id,
                 'title': submission.title,
                 'selftext': submission.selftext,
                 'created_utc': submission_time.strftime('%Y-%m-%d %H:%M:%S'),
                 'url': submission.url,
-                'comments': []
             }
-            submission.comments.replace_more(limit=None)
-            for comment in submission.comments.list():
-                comment_data = {
-                    'body': comment.body,
-                    'created_utc': datetime.utcfromtimestamp(comment.created_utc).strftime('%Y-%m-%d %H:%M:%S')
-                }
-                post_data['comments'].append(comment_data)
-            data.append(post_data)
-    if not data:
-        print("No data found, skipping save.")
-    return data
-
-# データをJSONファイルに保存
-def save_data_to_json(data, directory="data/reddit"):
-    if not data:  # データがない時は保存しない
-        return None
-
-    directory_path = Path(directory)
-    directory_path.mkdir(parents=True, exist_ok=True)
-
-    filename = directory_path / f"reddit_{datetime.now().strftime('%Y%m%d')}.json"
-    with filename.open('w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    print(f"Data saved to {filename}")
-    return filename
+
+        if newest is not None:
+            for keyword in query_keywords:
+                checkpoints.advance('reddit', keyword, newest)
+
+    for submission_id, comment_data in stream_comments(submission_ids):
+        yield {'type': 'comment', 'submission_id': submission_id, **comment_data}
+
+# 書き終わったファイルをGoogle Driveにアップロードしてから削除
+@instrumentation.span('reddit.upload')
+def upload_and_remove(path):
+    drive_service = create_drive_service(google_credentials_path)
+    upload_file(drive_service, path, google_drive_folder_id)
+    os.remove(path)
 
 # メインの処理
-if __name__ == '__main__':
+def main():
+    if not check_config():
+        exit(1)
+
     keywords = ["香椎浜", "Kashiihama", "かしいはま", "アイランドシティ", "照葉", "てりは"]
-    results = search_reddit(keywords)
-    file_path = save_data_to_json(results)
-
-    if file_path:  # 保存成功時のみアップロード
-        drive_service = create_drive_service()
-        upload_to_drive(drive_service, file_path, google_drive_folder_id)
-        os.remove(file_path)
-    else:
-        print("No data file created, nothing to upload.")
\ No newline at end of file
+    # 1件ずつファイルに追記し、ファイルを閉じるたびにアップロードする
+    # 途中で失敗しても、それまでに書いたファイルはアップロードされる
+    checkpoints = CheckpointStore()
+    # ほぼ同じ内容の投稿のリンクはnear_dupのインデックスに残る
+    near_dups = near_dup.open_index()
+    # 同じレコードをParquetのアーカイブ(data/archive/reddit)にも保存する
+    with JsonlWriter("data/reddit", f"reddit_{datetime.now().strftime('%Y%m%d')}", on_close=upload_and_remove) as writer, \
+            ArchiveWriter('reddit') as archive:
+        # アップロードはファイルを閉じるたびに行うので、fetchの時間にはアップロードの時間も含まれる
+        with instrumentation.span('reddit.fetch'):
+            writer.write_all(archive.tee(search_reddit(keywords, checkpoints, near_dups)))
+    # アップロードまで成功したらチェックポイントを保存する
+    checkpoints.save()
+    if near_dups:
+        near_dups.commit()
+
+    if not writer.record_count:
+        print("No data found, nothing to upload.")
+
+if __name__ == '__main__':
+    main()
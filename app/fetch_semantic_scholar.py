@@ -1,10 +1,20 @@
 import os
 from dotenv import load_dotenv
-import requests
+import http_client
 import urllib.parse
+import re
+from collections import Counter
 from datetime import datetime, timedelta
-import openai
-from openai import OpenAI
+from openai_client import get_openai_client
+from rate_limiter import RateLimiter
+from cache_store import get_llm_cache, make_key
+from discord_notifier import DiscordNotifier
+from checkpoint import CheckpointStore, CHECKPOINT_MAX_LOOKBACK_DAYS
+from seen_index import SeenIndex
+import near_dup
+import openai_batch
+from summary_packer import SummaryPacker
+import instrumentation
 
 # .envファイルを読み込む
 load_dotenv()
@@ -14,16 +24,149 @@ API_KEY = os.getenv("SEMANTIC_SCHOLAR_API_KEY")
 DISCORD_WEBHOOK_URL_SCHOLAR = os.getenv("DISCORD_WEBHOOK_URL_SCHOLAR")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
+# Discordへの通知はまとめてバックグラウンドで送信する
+notifier = DiscordNotifier(DISCORD_WEBHOOK_URL_SCHOLAR)
+
 # OpenAI APIキーを設定
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = get_openai_client()
+
+# 要約の同時実行数と、OpenAI APIのレート制限(1分あたりのリクエスト数・トークン数)
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))
+OPENAI_RPM = int(os.getenv("OPENAI_RPM", "500"))
+OPENAI_TPM = int(os.getenv("OPENAI_TPM", "200000"))
+openai_limiter = RateLimiter(requests_per_minute=OPENAI_RPM, tokens_per_minute=OPENAI_TPM)
+
+SUMMARY_MODEL = "gpt-4o-mini"
+SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that summarizes texts and keeps the summary concise, ideally within 300 characters."
+SUMMARY_MAX_TOKENS = 100
+SUMMARY_TEMPERATURE = 0.5
+
+# 要約の目安の長さと、LLMを使わずに抜粋で済ませるアブストラクトの長さの上限
+SUMMARY_TARGET_LENGTH = 300
+SHORT_ABSTRACT_LENGTH = int(os.getenv("SHORT_ABSTRACT_LENGTH", "600"))
+
+# 要約の方法(tldr / extractive / llm / none)ごとの件数
+summary_tiers = Counter()
+
+# Semantic Scholar APIのエンドポイント(ベンチマークではローカルのスタンドインに向ける)
+SEMANTIC_SCHOLAR_BASE_URL = os.getenv("SEMANTIC_SCHOLAR_BASE_URL", "https://api.semanticscholar.org")
+API_URL = f"{SEMANTIC_SCHOLAR_BASE_URL}/graph/v1/paper/search"
+# 検索APIで取得できる件数の上限
+MAX_SEARCH_RESULTS = 1000
+
+# 要約の方法。batchにするとBatch APIでまとめて要約する(結果が返るまで最大24時間かかる)
+SUMMARY_MODE = os.getenv("SUMMARY_MODE", "sync")
+SUMMARY_ERROR = "Error occurred while summarizing text."
+
+# 要約のリクエストの本文(同期の呼び出しとBatch APIで共通)
+def summary_request_body(text):
+    return {
+        "model": SUMMARY_MODEL,
+        "messages": [
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
+            {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
+        ],
+        "max_tokens": SUMMARY_MAX_TOKENS,
+        "temperature": SUMMARY_TEMPERATURE,
+    }
+
+def summary_cache_key(text):
+    return make_key(SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, text, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE)
 
-# Semantic Scholar APIのエンドポイント
-API_URL = "https://api.semanticscholar.org/graph/v1/paper/search"
+# 複数のテキストを要約する(結果は入力と同じ順序で返す)
+# トークン数の上限までアブストラクトを1回のリクエストにまとめ、まとめたリクエストを並列に送る
+def summarize_texts(texts):
+    if not texts:
+        return []
+    packer = SummaryPacker(client, SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE,
+                           use_cache=True, limiter=openai_limiter, concurrency=SUMMARY_CONCURRENCY)
+    try:
+        return packer.summarize(texts)
+    except Exception as e:
+        # 想定外の例外で通知まで止まらないように、ここで握りつぶす
+        print(f"Error while summarizing texts: {e}")
+        return [SUMMARY_ERROR] * len(texts)
+    finally:
+        print(f"Summarized {len(texts)} texts with {packer.request_count} requests.")
 
-def fetch_and_notify(query):
-    # publicationDateOrYearパラメータに前日の日付を設定
-    today = datetime.now()
-    one_day_ago = (today - timedelta(days=1)).strftime('%Y-%m-%d')
+# 論文を識別するID
+def paper_id(paper):
+    return paper.get('paperId') or paper.get('url')
+
+# 取得する出版日の範囲を決める
+# 前回取得した日の翌日から前日までで、チェックポイントがなければ前日のみ
+def publication_date_range(last_date):
+    yesterday = (datetime.now() - timedelta(days=1)).date()
+    start = yesterday
+    if last_date:
+        oldest = yesterday - timedelta(days=int(CHECKPOINT_MAX_LOOKBACK_DAYS))
+        start = max(datetime.strptime(last_date, '%Y-%m-%d').date() + timedelta(days=1), oldest)
+    if start > yesterday:
+        return None, yesterday
+    if start == yesterday:
+        return yesterday.strftime('%Y-%m-%d'), yesterday
+    return f"{start.strftime('%Y-%m-%d')}:{yesterday.strftime('%Y-%m-%d')}", yesterday
+
+# 文の区切りで切り詰めて、目安の長さに収まる抜粋を作る
+def extractive_summary(text, limit=SUMMARY_TARGET_LENGTH):
+    text = " ".join(text.split())
+    if len(text) <= limit:
+        return text
+    summary = ""
+    for sentence in re.split(r'(?<=[.!?。！？])\s*', text):
+        if not sentence:
+            continue
+        separator = "" if summary.endswith(('。', '！', '？')) else " "
+        candidate = f"{summary}{separator}{sentence}" if summary else sentence
+        if len(candidate) > limit:
+            break
+        summary = candidate
+    if summary:
+        return summary
+    # 最初の文が長すぎる場合は単語の区切りで切る
+    return text[:limit].rsplit(' ', 1)[0] + "…"
+
+# 論文ごとに要約の方法を決める
+# Semantic ScholarのTLDRがあればそれを使い、短いアブストラクトは抜粋で済ませる
+# LLMで要約する論文は要約をNoneにしたまま、そのインデックスを返す
+def plan_summaries(papers):
+    summaries = [None] * len(papers)
+    llm_indexes = []
+    for i, paper in enumerate(papers):
+        tldr = (paper.get('tldr') or {}).get('text')
+        abstract = paper.get('abstract')
+        if tldr:
+            summaries[i] = tldr
+            summary_tiers['tldr'] += 1
+        elif not abstract:
+            summaries[i] = "No abstract"
+            summary_tiers['none'] += 1
+        elif len(abstract) <= SHORT_ABSTRACT_LENGTH:
+            summaries[i] = extractive_summary(abstract)
+            summary_tiers['extractive'] += 1
+        else:
+            llm_indexes.append(i)
+    return summaries, llm_indexes
+
+# 論文ごとに要約を作る(LLMが必要なものはその場で並列に要約する)
+@instrumentation.span('semantic_scholar.summarize')
+def summarize_papers(papers):
+    summaries, llm_indexes = plan_summaries(papers)
+    llm_summaries = summarize_texts([papers[i]['abstract'] for i in llm_indexes])
+    for i, summary in zip(llm_indexes, llm_summaries):
+        summaries[i] = summary
+        summary_tiers['llm'] += 1
+    return summaries
+
+# 前回の取得以降に出版された論文のうち、まだ通知していないものを取得する
+# (論文のリスト, 取得した最後の日付の文字列) を返す。取得しなかった場合や失敗した場合は (None, None)
+@instrumentation.span('semantic_scholar.fetch')
+def fetch_papers(query, checkpoints, seen, near_dups=None):
+    # publicationDateOrYearパラメータに、前回の取得以降の日付を設定
+    date_range, last_day = publication_date_range(checkpoints.get('semantic_scholar', query))
+    if date_range is None:
+        print(f"No new publication dates to fetch for query '{query}'.")
+        return None, None
 
     # クエリをURLエンコードする
     encoded_query = urllib.parse.quote(query)
@@ -36,69 +179,43 @@ def fetch_and_notify(query):
     # パラメータの設定
     params = {
         "query": encoded_query,
-        "fields": "title,authors,tldr,abstract,fieldsOfStudy,venue,publicationDate,url",
+        "fields": "paperId,title,authors,tldr,abstract,fieldsOfStudy,venue,publicationDate,url",
         # "fieldsOfStudy": "Art,Computer Science,Geology,Psychology,Philosophy,Engineering,Education",
         "limit": 100,
-        "publicationDateOrYear": one_day_ago,
+        "publicationDateOrYear": date_range,
     }
 
-    # APIリクエストを送信
-    response = requests.get(API_URL, headers=headers, params=params)
-    if response.status_code != 200:
-        print(f"Error fetching data for query '{query}': {response.status_code}")
-        return
+    # APIリクエストを送信(複数日をさかのぼる場合に備えて、次のページがあれば続けて取得する)
+    papers = []
+    offset = 0
+    while True:
+        response = http_client.get(API_URL, headers=headers, params={**params, "offset": offset})
+        if response.status_code != 200:
+            print(f"Error fetching data for query '{query}': {response.status_code}")
+            return None, None
+        data = response.json()
+        papers.extend(data.get('data', []))
+        if 'next' not in data or data['next'] >= MAX_SEARCH_RESULTS:
+            break
+        offset = data['next']
 
-    data = response.json()
-
-    # OpenAI APIを使ってテキストを要約する
-    def summarize_text(text):
-        try:
-            response = client.chat.completions.create(model="gpt-4o-mini",
-            messages=[
-                {"role": "system", "content": "You are a helpful assistant that summarizes texts and keeps the summary concise, ideally within 300 characters."},
-                {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
-            ],
-            max_tokens=100,
-            temperature=0.5)
-            summary = response.choices[0].message.content.strip()
-            return summary
-        except openai.OpenAIError as e:
-            print(f"Error with OpenAI API: {e}")
-            return "Error occurred while summarizing text."
-
-    # Discordに通知を送信
-    def send_discord_notification(message):
-        if DISCORD_WEBHOOK_URL_SCHOLAR:
-            data = {"content": message}
-            response = requests.post(DISCORD_WEBHOOK_URL_SCHOLAR, json=data)
-            if response.status_code != 204:
-                print(f"Failed to send notification: {response.status_code}")
-                print(f"Response content: {response.content.decode('utf-8')}")
-        else:
-            print("Discord Webhook URL is not set.")
-
-    # メッセージを分割して送信
-    def send_long_message(messages):
-        max_length = 2000
-        current_message = ""
-        for message in messages:
-            if len(current_message) + len(message) + 2 > max_length:  # +2 for the "\n\n" separator
-                send_discord_notification(current_message)
-                current_message = message
-            else:
-                if current_message:
-                    current_message += "\n\n" + message
-                else:
-                    current_message = message
-        if current_message:
-            send_discord_notification(current_message)
-
-    # 結果を処理して1つのメッセージにまとめる
+    # 過去の実行や別のクエリで通知済みの論文は、要約・通知の前に除く
+    papers = [paper for paper in papers if not seen.contains('semantic_scholar', paper_id(paper))]
+    for paper in papers:
+        seen.mark('semantic_scholar', paper_id(paper))
+    # 版違いなどでIDが異なる同じ論文は、最初に見つけたものだけを要約・通知する
+    papers = list(near_dup.unique_records(
+        papers, near_dups, 'semantic_scholar', key=paper_id,
+        text=lambda paper: f"{paper.get('title') or ''}\n{paper.get('abstract') or ''}",
+        link=lambda paper: paper.get('url')))
+    return papers, last_day.strftime('%Y-%m-%d')
+
+# 結果を処理して1つのメッセージにまとめて送信する
+@instrumentation.span('semantic_scholar.notify')
+def notify_papers(query, papers, summaries):
     messages = []
-    for paper in data.get('data', []):
+    for paper, summary in zip(papers, summaries):
         title = paper.get('title', 'No title')
-        abstract = paper.get('abstract', 'No abstract')
-        summary = summarize_text(abstract)
         message = (
             f"**Title:** {title}\n"
             f"**Summary:** {summary}\n"
@@ -108,12 +225,133 @@ def fetch_and_notify(query):
         )
         messages.append(message)
 
-    # まとめたメッセージを送信
     if messages:
         header = f"Semantic Scholar Search Results for {query}:\n"
-        send_long_message([header] + messages)
+        notifier.send_blocks([header] + messages)
 
-if __name__ == "__main__":
-    queries = ["Large Language Model", "Machine Learning", "Generative Art"]
+# 要約できた論文を通知して通知済みにする
+# 要約できなかった論文は通知済みにせず、チェックポイントも進めないので、次回の実行で取得・要約し直す
+def notify_and_record(query, papers, summaries, last_day, checkpoints, seen):
+    done = [(paper, summary) for paper, summary in zip(papers, summaries) if summary != SUMMARY_ERROR]
+    notify_papers(query, [paper for paper, _ in done], [summary for _, summary in done])
+    for paper, summary in zip(papers, summaries):
+        if summary == SUMMARY_ERROR:
+            seen.unmark('semantic_scholar', paper_id(paper))
+        else:
+            seen.mark('semantic_scholar', paper_id(paper))
+    failed = len(papers) - len(done)
+    if failed:
+        print(f"{failed} papers for query '{query}' could not be summarized and will be retried next run.")
+        return
+    # 取得した最後の日付をチェックポイントに記録する
+    checkpoints.advance('semantic_scholar', query, last_day)
+
+def fetch_and_notify(query, checkpoints, seen, near_dups=None):
+    papers, last_day = fetch_papers(query, checkpoints, seen, near_dups)
+    if papers is None:
+        return
+    notify_and_record(query, papers, summarize_papers(papers), last_day, checkpoints, seen)
+
+# 通知に使う項目だけを残す(Batch APIの状態ファイルに保存するため)
+def compact_paper(paper):
+    return {key: paper.get(key) for key in ('paperId', 'title', 'url', 'publicationDate', 'venue') if key in paper}
+
+# 全クエリの論文を取得し、LLMが必要な要約をまとめてBatch APIに投入する
+def submit_summary_batch(queries, checkpoints, seen, near_dups=None):
+    cache = get_llm_cache()
+    context = []
+    lines = []
     for query in queries:
-        fetch_and_notify(query)
+        papers, last_day = fetch_papers(query, checkpoints, seen, near_dups)
+        if papers is None:
+            continue
+        summaries, llm_indexes = plan_summaries(papers)
+        pending = {}
+        for i in llm_indexes:
+            abstract = papers[i]['abstract']
+            cached = cache.get(summary_cache_key(abstract))
+            if cached is not None:
+                summaries[i] = cached
+                summary_tiers['llm'] += 1
+                continue
+            # custom_idから結果をクエリと論文に戻せるようにする
+            custom_id = f"{len(context)}-{i}"
+            lines.append(openai_batch.chat_request_line(custom_id, summary_request_body(abstract)))
+            pending[custom_id] = abstract
+        context.append({
+            'query': query,
+            'last_day': last_day,
+            'papers': [compact_paper(paper) for paper in papers],
+            'summaries': summaries,
+            'pending': pending,
+        })
+
+    if not lines:
+        return {'batch_id': None, 'context': context}
+    return openai_batch.submit_batch(client, lines, context)
+
+# バッチの結果を論文に戻して通知する
+# 状態ファイルに保存した内容だけで処理するので、再起動後にポーリングから再開しても同じ結果になる
+def complete_summary_batch(state, checkpoints, seen):
+    results = {}
+    if state['batch_id']:
+        with instrumentation.span('semantic_scholar.summarize'):
+            batch = openai_batch.wait_for_batch(client, state['batch_id'])
+            results = openai_batch.read_results(client, batch)
+
+    cache = get_llm_cache()
+    for entry in state['context']:
+        summaries = entry['summaries']
+        for custom_id, abstract in entry['pending'].items():
+            summary = results.get(custom_id)
+            if summary is None:
+                summary = SUMMARY_ERROR
+            else:
+                cache.set(summary_cache_key(abstract), summary)
+            summaries[int(custom_id.split('-')[1])] = summary
+            summary_tiers['llm'] += 1
+
+        notify_and_record(entry['query'], entry['papers'], summaries, entry['last_day'], checkpoints, seen)
+
+def run_batch_mode(queries, checkpoints, seen, near_dups=None):
+    state = openai_batch.load_state()
+    if state is None:
+        state = submit_summary_batch(queries, checkpoints, seen, near_dups)
+    else:
+        # 前回の実行で投入したバッチが残っていれば、新たに取得せずにその結果を待つ
+        print(f"Resuming batch {state['batch_id']} submitted at {state.get('submitted_at')}.")
+    try:
+        complete_summary_batch(state, checkpoints, seen)
+    except TimeoutError as e:
+        # 状態ファイルは残したまま終了し、次回の実行でポーリングを再開する
+        print(e)
+        exit(1)
+
+def main():
+    queries = ["Large Language Model", "Machine Learning", "Generative Art"]
+    checkpoints = CheckpointStore()
+    seen = SeenIndex()
+    near_dups = near_dup.open_index()
+    if SUMMARY_MODE == "batch":
+        run_batch_mode(queries, checkpoints, seen, near_dups)
+    else:
+        for query in queries:
+            fetch_and_notify(query, checkpoints, seen, near_dups)
+    with instrumentation.span('semantic_scholar.notify'):
+        delivered = notifier.flush()
+    # 通知まで終わったらチェックポイントと通知済みの論文を保存する
+    # 送信できなかった通知があれば、次回の実行で同じ論文を通知し直すように保存しない(要約はキャッシュから再利用される)
+    if delivered:
+        checkpoints.save()
+        seen.commit()
+        if near_dups:
+            near_dups.commit()
+    else:
+        print(f"{notifier.failed_count} notifications failed; checkpoints and seen papers were not saved.")
+    if SUMMARY_MODE == "batch":
+        openai_batch.clear_state()
+    print(f"Summary tiers: {dict(summary_tiers)}")
+    print(f"LLM cache: {get_llm_cache().stats()}")
+
+if __name__ == "__main__":
+    main()
@@ -1,12 +1,15 @@
 import os
-import json
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 import pytumblr
 from dotenv import load_dotenv
-from pathlib import Path
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from rate_limiter import RateLimiter
+from drive_uploader import create_drive_service, upload_file
+from record_writer import JsonlWriter
+from archive import ArchiveWriter
+import near_dup
+from checkpoint import CheckpointStore, resume_timestamp
+import instrumentation
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -16,95 +19,156 @@ api_key = os.getenv('TUMBLR_API_KEY')
 google_drive_folder_id = os.getenv('GOOGLE_DRIVE_FOLDER_ID')
 google_credentials_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
 
-if not api_key:
-    print("Error: Tumblr API key is not set in the .env file.")
-    exit(1)
-
-if not google_drive_folder_id:
-    print("Error: Google Drive folder ID is not set in the .env file.")
-    exit(1)
-
-if not google_credentials_path:
-    print("Error: Google Drive credentials path is not set in the .env file.")
-    exit(1)
-
-# Google Drive APIクライアントを作成
-def create_drive_service():
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = service_account.Credentials.from_service_account_file(
-        google_credentials_path, scopes=SCOPES)
-    return build('drive', 'v3', credentials=credentials)
-
-# Google Driveにファイルをアップロード
-def upload_to_drive(service, file_path, folder_id):
-    file_metadata = {
-        'name': file_path.name,
-        'parents': [folder_id]
-    }
-    media = MediaFileUpload(file_path, mimetype='application/json')
-    try:
-        file = service.files().create(
-            body=file_metadata,
-            media_body=media,
-            fields='id'
-        ).execute()
-        print(f"File ID: {file.get('id')}")
-    except Exception as e:
-        print(f"An error occurred: {e}")
-        raise
+# キーワードの並列数と、全キーワードで共有するリクエスト数の上限
+TUMBLR_WORKERS = int(os.getenv('TUMBLR_WORKERS', '6'))
+TUMBLR_REQUESTS_PER_MINUTE = int(os.getenv('TUMBLR_REQUESTS_PER_MINUTE', '60'))
+# 1キーワード・1期間あたりに辿る最大ページ数
+TUMBLR_MAX_PAGES = int(os.getenv('TUMBLR_MAX_PAGES', '50'))
+# APIのホスト(ベンチマークではローカルのスタンドインに向ける)
+TUMBLR_API_HOST = os.getenv('TUMBLR_API_HOST', 'https://api.tumblr.com')
+
+tumblr_limiter = RateLimiter(requests_per_minute=TUMBLR_REQUESTS_PER_MINUTE)
+
+# 必要な環境変数が設定されているか確認
+def check_config():
+    if not api_key:
+        print("Error: Tumblr API key is not set in the .env file.")
+        return False
+
+    if not google_drive_folder_id:
+        print("Error: Google Drive folder ID is not set in the .env file.")
+        return False
+
+    if not google_credentials_path:
+        print("Error: Google Drive credentials path is not set in the .env file.")
+        return False
+    return True
 
 # 前日の0時から23:59までのデータを取得するための時間範囲を計算
+# (チェックポイントがない場合の取得開始時刻に使う)
 def get_yesterday_time_range():
     end_time = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
     start_time = end_time - timedelta(days=1)
     return start_time, end_time
 
-# Tumblrからデータを検索して保存
-def search_tumblr(client, keywords):
-    start_time, end_time = get_yesterday_time_range()
-    data = []
-    for keyword in keywords:
-        posts = client.tagged(keyword, before=end_time.timestamp(), filter='text')
-        for post in posts:
-            post_time = datetime.fromtimestamp(post['timestamp'])
-            if start_time <= post_time <= end_time:
-                data.append({
-                    'blog_name': post['blog_name'],
-                    'id': post['id'],
-                    'post_url': post['post_url'],
-                    'type': post['type'],
-                    'timestamp': post['timestamp'],
-                    'date': post['date'],
-                    'tags': post['tags'],
-                    'note_count': post['note_count'],
-                })
-    return data
-
-# データをJSONファイルに保存
-def save_data_to_json(data, directory="data/tumblr"):
-    if not data:  # データが空の時は保存しない
-        print("No data found, skipping save.")
-        return None
-
-    directory_path = Path(directory)
-    directory_path.mkdir(parents=True, exist_ok=True)
-
-    filename = directory_path / f"tumblr_{datetime.now().strftime('%Y%m%d')}.json"
-    with filename.open('w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
-    print(f"Data saved to {filename}")
-    return filename
+# 1つのタグについて、beforeカーソルを過去へ進めながら期間内(開始時刻は含まない)の投稿を取得する
+# (投稿のリスト, 続きのカーソル) を返す。期間の開始まで辿れた場合のカーソルはNone
+def fetch_tagged_posts(client, keyword, start_timestamp, end_timestamp, max_pages=TUMBLR_MAX_PAGES):
+    results = []
+    before = int(end_timestamp)
+    for _ in range(max_pages):
+        tumblr_limiter.acquire()
+        # 通信エラーなどの例外はこのタグだけの失敗として、エラーの辞書と同じく取得できた分までを返す
+        # (並列に取得している他のタグは止めない)
+        try:
+            with instrumentation.span('tumblr.tagged'):
+                posts = client.tagged(keyword, before=before, filter='text')
+        except Exception as e:
+            print(f"Error fetching posts for tag '{keyword}': {e}")
+            return results, before
+        # エラー時はメタ情報を含む辞書が返ってくる
+        if isinstance(posts, dict):
+            print(f"Error fetching posts for tag '{keyword}': {posts.get('meta')}")
+            return results, before
+        if not posts:
+            return results, None
+        results.extend(post for post in posts if start_timestamp < post['timestamp'] <= end_timestamp)
+        oldest = min(post['timestamp'] for post in posts)
+        # 期間の開始より前まで辿ったか、カーソルが進まなくなったら終了
+        if oldest <= start_timestamp or oldest >= before:
+            return results, None
+        before = oldest
+    print(f"Reached TUMBLR_MAX_PAGES for tag '{keyword}'; the rest is backfilled next run.")
+    return results, before
+
+def format_post(post):
+    return {
+        'blog_name': post['blog_name'],
+        'id': post['id'],
+        'post_url': post['post_url'],
+        'type': post['type'],
+        'timestamp': post['timestamp'],
+        'date': post['date'],
+        'tags': post['tags'],
+        'note_count': post['note_count'],
+        # 重複の判定に使う本文の要約
+        'summary': post.get('summary', ''),
+    }
+
+# Tumblrからデータを検索し、投稿を1件ずつレコードとして返す
+# キーワードごとのチェックポイント(取得済みの最新のtimestamp)より新しい投稿だけを取得する
+def search_tumblr(client, keywords, checkpoints):
+    default_start, _ = get_yesterday_time_range()
+    end_timestamp = datetime.now().timestamp()
+
+    # TUMBLR_MAX_PAGESで打ち切った場合は、取得できなかった期間(開始時刻〜辿れたカーソル)をtumblr_backfillに記録し、
+    # 次回はその続きから取得する(埋め終わるまでは新しい投稿は取得しない)
+    def crawl(keyword):
+        posts = []
+        gap = checkpoints.get('tumblr_backfill', keyword)
+        if gap:
+            after = resume_timestamp(gap['after'], gap['after'])
+            posts, cursor = fetch_tagged_posts(client, keyword, after, gap['before'])
+            if cursor is not None:
+                checkpoints.set('tumblr_backfill', keyword, {**gap, 'before': cursor})
+                return posts
+            checkpoints.set('tumblr_backfill', keyword, None)
+            checkpoints.advance('tumblr', keyword, gap['newest'])
+
+        start_timestamp = resume_timestamp(checkpoints.get('tumblr', keyword), default_start.timestamp())
+        new_posts, cursor = fetch_tagged_posts(client, keyword, start_timestamp, end_timestamp)
+        if new_posts:
+            newest = max(post['timestamp'] for post in new_posts)
+            if cursor is None:
+                checkpoints.advance('tumblr', keyword, newest)
+            else:
+                checkpoints.set('tumblr_backfill', keyword, {'after': start_timestamp, 'before': cursor, 'newest': newest})
+        return posts + new_posts
+
+    # キーワードごとに並列で取得し、複数のタグに付いた投稿はIDで重複を除く
+    seen_ids = set()
+    with ThreadPoolExecutor(max_workers=max(1, TUMBLR_WORKERS)) as executor:
+        for posts in executor.map(crawl, keywords):
+            for post in posts:
+                if post['id'] in seen_ids:
+                    continue
+                seen_ids.add(post['id'])
+                yield format_post(post)
+
+# 書き終わったファイルをGoogle Driveにアップロードしてから削除
+@instrumentation.span('tumblr.upload')
+def upload_and_remove(path):
+    drive_service = create_drive_service(google_credentials_path)
+    upload_file(drive_service, path, google_drive_folder_id)
+    os.remove(path)
 
 # メインの処理
-if __name__ == "__main__":
-    client = pytumblr.TumblrRestClient(api_key)
+def main():
+    if not check_config():
+        exit(1)
+
+    client = pytumblr.TumblrRestClient(api_key, host=TUMBLR_API_HOST)
     keywords = ["香椎浜", "Kashiihama", "かしいはま", "アイランドシティ", "照葉", "てりは"]
-    results = search_tumblr(client, keywords)
-    file_path = save_data_to_json(results)
-
-    if file_path:  # 保存成功時のみアップロード
-        drive_service = create_drive_service()
-        upload_to_drive(drive_service, file_path, google_drive_folder_id)
-        os.remove(file_path)
-    else:
-        print("No data file created, nothing to upload.")
\ No newline at end of file
+    # 1件ずつファイルに追記し、ファイルを閉じるたびにアップロードする
+    checkpoints = CheckpointStore()
+    # 他の取得元や別の投稿とほぼ同じ内容の投稿は保存しない(リンクはnear_dupのインデックスに残る)
+    near_dups = near_dup.open_index()
+    records = near_dup.unique_records(search_tumblr(client, keywords, checkpoints), near_dups, 'tumblr',
+                                      key=lambda record: record['id'], text=lambda record: record['summary'],
+                                      link=lambda record: record['post_url'])
+    # 同じレコードをParquetのアーカイブ(data/archive/tumblr)にも保存する
+    with JsonlWriter("data/tumblr", f"tumblr_{datetime.now().strftime('%Y%m%d')}", on_close=upload_and_remove) as writer, \
+            ArchiveWriter('tumblr') as archive:
+        # アップロードはファイルを閉じるたびに行うので、fetchの時間にはアップロードの時間も含まれる
+        with instrumentation.span('tumblr.fetch'):
+            writer.write_all(archive.tee(records))
+    # アップロードまで成功したらチェックポイントを保存する
+    checkpoints.save()
+    if near_dups:
+        near_dups.commit()
+
+    if not writer.record_count:
+        print("No data found, nothing to upload.")
+
+if __name__ == "__main__":
+    main()
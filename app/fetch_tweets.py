@@ -1,8 +1,11 @@
-import requests
+import http_client
 import os
-import json
-import pandas as pd
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+from checkpoint import CheckpointStore
+from record_writer import JsonlWriter
+from archive import ArchiveWriter
+import near_dup
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
@@ -10,39 +13,167 @@ load_dotenv()
 # 認証情報の設定
 X_BEARER_TOKEN = os.getenv("X_BEARER_TOKEN")
 
-if not X_BEARER_TOKEN:
-    print("Error: X_BEARER_TOKEN is not set in the .env file.")
-    exit(1)
+KEYWORDS = ["香椎浜", "Kashiihama", "かしいはま", "アイランドシティ", "照葉", "てりは"]
+
+X_API_BASE_URL = os.getenv("X_API_BASE_URL", "https://api.twitter.com")
+SEARCH_URL = f"{X_API_BASE_URL}/2/tweets/search/recent"  # X APIのエンドポイント
+# クエリの最大長(Basicプランは512文字)と、1ページの件数・最大ページ数
+X_QUERY_MAX_LENGTH = int(os.getenv("X_QUERY_MAX_LENGTH", "512"))
+X_MAX_RESULTS = 100
+X_MAX_PAGES = int(os.getenv("X_MAX_PAGES", "10"))
+# recent searchで取得できる期間(これより古いsince_idを指定するとエラーになる)
+X_RECENT_SEARCH_DAYS = 7
+# ツイートIDに含まれる時刻の基準(ミリ秒)
+TWEET_ID_EPOCH_MS = 1288834974657
 
 def create_headers(X_BEARER_TOKEN):
     headers = {"Authorization": f"Bearer {X_BEARER_TOKEN}"}
     return headers
 
-def create_url(keyword, max_results=10):
-    search_url = "https://api.twitter.com/2/tweets/search/recent"  # X APIのエンドポイント
+def format_query(keywords):
+    terms = [f'"{keyword}"' for keyword in keywords]
+    return terms[0] if len(terms) == 1 else f"({' OR '.join(terms)})"
+
+# キーワードをOR検索のクエリにまとめる(長さの上限を超える場合は複数に分ける)
+# (クエリ, そのクエリに含まれるキーワード) の組のリストを返す
+def build_queries(keywords, max_length=X_QUERY_MAX_LENGTH):
+    queries = []
+    group = []
+    for keyword in keywords:
+        candidate = group + [keyword]
+        if group and len(format_query(candidate)) > max_length:
+            queries.append((format_query(group), group))
+            candidate = [keyword]
+        group = candidate
+    if group:
+        queries.append((format_query(group), group))
+    return queries
+
+def create_url(query, max_results=X_MAX_RESULTS, since_id=None, until_id=None, next_token=None):
     query_params = {
-        'query': keyword,  # 検索キーワード
+        'query': query,  # 検索キーワード
         'max_results': max_results,  # 取得するツイート数
         'tweet.fields': 'created_at,author_id,text',  # 必要なフィールド
     }
-    return search_url, query_params
+    if since_id:
+        query_params['since_id'] = since_id
+    if until_id:
+        query_params['until_id'] = until_id
+    if next_token:
+        query_params['next_token'] = next_token
+    return SEARCH_URL, query_params
 
+# レート制限の残数が0になった場合は、http_clientがx-rate-limit-resetの時刻まで次のリクエストを待たせる
 def connect_to_endpoint(url, headers, params):
-    response = requests.get(url, headers=headers, params=params)
+    response = http_client.get(url, headers=headers, params=params)
     if response.status_code != 200:
         raise Exception(f"Request returned an error: {response.status_code} {response.text}")
     return response.json()
 
-def save_to_json(data, filename):
-    with open(filename, 'w', encoding='utf-8') as f:
-        json.dump(data, f, ensure_ascii=False, indent=4)
+def is_newer_id(a, b):
+    return int(a) > int(b)
 
-def main():
-    keyword = "香椎浜"  # 検索したいキーワード
+# ツイートIDから投稿時刻を求める
+def tweet_id_time(tweet_id):
+    return datetime.fromtimestamp(((int(tweet_id) >> 22) + TWEET_ID_EPOCH_MS) / 1000, tz=timezone.utc)
+
+# recent searchの期間より古いIDか(余裕を持たせて、期間の終わり1時間以内のものも古いとみなす)
+def is_outside_window(tweet_id):
+    oldest = datetime.now(timezone.utc) - timedelta(days=X_RECENT_SEARCH_DAYS) + timedelta(hours=1)
+    return tweet_id_time(tweet_id) < oldest
+
+# recent searchの期間より古いsince_idは使えないので、指定せずに期間全体を取得する
+def usable_since_id(since_id):
+    if since_id is None:
+        return None
+    if is_outside_window(since_id):
+        print(f"Checkpoint {since_id} is older than the recent search window; searching the whole window instead.")
+        return None
+    return since_id
+
+# since_idより新しく、until_idより古いツイートをnext_tokenでページをたどって1件ずつ返す
+# 取得した範囲はprogressに記録する(newest_id: 最新のID, oldest_id: 最も古いID, complete: since_idまで辿れたか)
+def iter_range(query, headers, since_id, until_id, seen_ids, progress):
+    progress.update({'newest_id': None, 'oldest_id': None, 'complete': False})
+    next_token = None
+    for _ in range(X_MAX_PAGES):
+        url, params = create_url(query, since_id=since_id, until_id=until_id, next_token=next_token)
+        response_data = connect_to_endpoint(url, headers, params)
+        meta = response_data.get('meta', {})
+        if meta.get('newest_id') and (progress['newest_id'] is None or is_newer_id(meta['newest_id'], progress['newest_id'])):
+            progress['newest_id'] = meta['newest_id']
+        if meta.get('oldest_id') and (progress['oldest_id'] is None or is_newer_id(progress['oldest_id'], meta['oldest_id'])):
+            progress['oldest_id'] = meta['oldest_id']
+        for tweet in response_data.get('data', []):
+            # 複数のクエリに一致したツイートは1回だけ保存する
+            if tweet['id'] in seen_ids:
+                continue
+            seen_ids.add(tweet['id'])
+            yield {**tweet, 'query': query}
+        next_token = meta.get('next_token')
+        if not next_token:
+            progress['complete'] = True
+            return
+
+# キーワードをまとめたクエリごとに、ツイートを1件ずつ返す
+# キーワードごとのチェックポイント(取得済みの最新のID)より新しいツイートだけを取得する
+# X_MAX_PAGESで打ち切った場合は、取得できなかった範囲(since_id〜辿れた最も古いID)をx_backfillに記録し、
+# 次回はその続きから取得する(埋め終わるまでは新しいツイートは取得しない)
+def search_tweets(keywords, checkpoints):
     headers = create_headers(X_BEARER_TOKEN)
-    url, params = create_url(keyword)
-    response_data = connect_to_endpoint(url, headers, params)
-    save_to_json(response_data, "tweets.json")
+    seen_ids = set()
+    for query, query_keywords in build_queries(keywords):
+        progress = {}
+        gap = checkpoints.get('x_backfill', query)
+        if gap and is_outside_window(gap['until_id']):
+            print(f"Backfill for query {query} is older than the recent search window and is dropped.")
+            checkpoints.set('x_backfill', query, None)
+            gap = None
+        if gap:
+            yield from iter_range(query, headers, usable_since_id(gap['since_id']), gap['until_id'], seen_ids, progress)
+            if not progress['complete']:
+                if progress['oldest_id']:
+                    checkpoints.set('x_backfill', query, {**gap, 'until_id': progress['oldest_id']})
+                print(f"Reached X_MAX_PAGES while backfilling query {query}; continuing next run.")
+                continue
+            checkpoints.set('x_backfill', query, None)
+            for keyword in query_keywords:
+                checkpoints.advance('x', keyword, gap['newest_id'], newer=is_newer_id)
+
+        # まとめたキーワードのうち、最も古いチェックポイントから取得する
+        since_ids = [checkpoints.get('x', keyword) for keyword in query_keywords]
+        since_id = None if None in since_ids else usable_since_id(min(since_ids, key=int))
+        yield from iter_range(query, headers, since_id, None, seen_ids, progress)
+        if not progress['newest_id']:
+            continue
+        if progress['complete']:
+            for keyword in query_keywords:
+                checkpoints.advance('x', keyword, progress['newest_id'], newer=is_newer_id)
+        else:
+            print(f"Reached X_MAX_PAGES for query {query}; the rest is backfilled next run.")
+            checkpoints.set('x_backfill', query, {'since_id': since_id, 'until_id': progress['oldest_id'],
+                                                  'newest_id': progress['newest_id']})
+
+def main():
+    if not X_BEARER_TOKEN:
+        print("Error: X_BEARER_TOKEN is not set in the .env file.")
+        exit(1)
+
+    checkpoints = CheckpointStore()
+    # 他の取得元や別のツイートとほぼ同じ内容のツイートは保存しない(リンクはnear_dupのインデックスに残る)
+    near_dups = near_dup.open_index()
+    records = near_dup.unique_records(search_tweets(KEYWORDS, checkpoints), near_dups, 'tweets',
+                                      key=lambda tweet: tweet['id'], text=lambda tweet: tweet.get('text'),
+                                      link=lambda tweet: f"https://x.com/i/web/status/{tweet['id']}")
+    # 取得したツイートはメモリに溜めず、1件ずつファイルに追記する
+    # 同じレコードをParquetのアーカイブ(data/archive/tweets)にも保存する
+    with JsonlWriter("data/tweets", f"tweets_{datetime.now().strftime('%Y%m%d')}") as writer, \
+            ArchiveWriter('tweets') as archive:
+        writer.write_all(archive.tee(records))
+    checkpoints.save()
+    if near_dups:
+        near_dups.commit()
+    print(f"Saved {writer.record_count} tweets.")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,176 @@
+import os
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+import instrumentation
+
+# 通信の設定(環境変数で変更可能)
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "1"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "60"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+
+# リトライ対象のステータスコード
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# 同じリクエストを送り直しても結果が変わらないメソッド
+# それ以外(POSTなど)は、受け付けられた後の5xxで二重に送らないように、429と送信前の接続エラーだけリトライする
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+
+# レート制限の残数・リセット時刻を表すヘッダー(サービスごとに名前が異なる)
+RATE_LIMIT_HEADERS = [
+    ("x-rate-limit-remaining", "x-rate-limit-reset"),      # X (Twitter)
+    ("x-ratelimit-remaining", "x-ratelimit-reset-after"),  # Discord
+    ("x-ratelimit-remaining", "x-ratelimit-reset"),        # Reddit など
+    ("ratelimit-remaining", "ratelimit-reset"),
+]
+
+# セッションで送受信したリクエストを計測する(PRAWなどセッションを直接使う通信も含む)
+def record_response(response, *args, **kwargs):
+    host = urlsplit(response.url).netloc
+    instrumentation.incr('http_requests_total', host=host, status=response.status_code)
+    body = response.request.body or b''
+    instrumentation.incr('http_sent_bytes_total', len(body if isinstance(body, bytes) else str(body).encode('utf-8')), host=host)
+    # ストリーミングの場合は本文を読み込まずにContent-Lengthで数える
+    received = int(response.headers.get('Content-Length') or 0) if kwargs.get('stream') else len(response.content)
+    instrumentation.incr('http_received_bytes_total', received, host=host)
+
+# ホストごとにKeep-Aliveの接続プールを持つアダプター(すべてのセッションで共有する)
+adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+
+# 共有の接続プールを使うセッションを作成
+# PRAWのようにセッションのヘッダー(User-Agentなど)を書き換えるライブラリには、専用のセッションを渡す
+def create_session():
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.hooks['response'].append(record_response)
+    return session
+
+session = create_session()
+
+# リセットまでの秒数を求める(UNIX時刻と秒数のどちらの形式にも対応)
+def _seconds_until(value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        return None
+    if value > 1e9:
+        return max(0.0, value - time.time())
+    return max(0.0, value)
+
+# Retry-Afterヘッダー(秒数または日時)から待ち時間を求める(HTTP_BACKOFF_MAXまで)
+def retry_after_seconds(response):
+    seconds = _retry_after(response)
+    return None if seconds is None else min(seconds, HTTP_BACKOFF_MAX)
+
+def _retry_after(response):
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    seconds = _seconds_until(value)
+    if seconds is not None:
+        return seconds
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+# レスポンスヘッダーをもとに、ホスト(またはキー)ごとの次回リクエスト可能時刻を管理する
+class Throttle:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._next_allowed = {}
+
+    def wait(self, key):
+        while True:
+            with self._lock:
+                delay = self._next_allowed.get(key, 0) - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def delay(self, key, seconds):
+        with self._lock:
+            until = time.monotonic() + seconds
+            self._next_allowed[key] = max(self._next_allowed.get(key, 0), until)
+
+    def update(self, key, response):
+        headers = response.headers
+        for remaining_header, reset_header in RATE_LIMIT_HEADERS:
+            remaining = headers.get(remaining_header)
+            reset = headers.get(reset_header)
+            if remaining is None or reset is None:
+                continue
+            try:
+                remaining = float(remaining)
+            except ValueError:
+                break
+            # 残数がなくなったらリセットまで同じホストへのリクエストを止める
+            if remaining < 1:
+                seconds = _seconds_until(reset)
+                if seconds:
+                    self.delay(key, seconds)
+            break
+        if response.status_code == 429:
+            seconds = retry_after_seconds(response)
+            if seconds:
+                self.delay(key, seconds)
+
+throttle = Throttle()
+
+# 指数バックオフ(ジッター付き)の待ち時間
+def backoff_seconds(attempt):
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+# リクエストを送信する前(接続の確立中)に失敗したかどうか
+def _failed_before_send(error):
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, ConnectTimeoutError)
+
+# 共有セッションでリクエストを送信し、429/5xxや通信エラーの場合はリトライする
+# リトライしても失敗した場合は最後のレスポンスを返す(通信エラーの場合は例外を送出する)
+def request(method, url, retries=None, throttle_key=None, **kwargs):
+    retries = HTTP_MAX_RETRIES if retries is None else retries
+    kwargs.setdefault("timeout", HTTP_TIMEOUT)
+    key = throttle_key or urlsplit(url).netloc
+    idempotent = method.upper() in IDEMPOTENT_METHODS
+
+    for attempt in range(retries + 1):
+        throttle.wait(key)
+        try:
+            response = session.request(method, url, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            instrumentation.incr('http_errors_total', host=urlsplit(url).netloc)
+            if attempt >= retries or not (idempotent or _failed_before_send(e)):
+                raise
+            instrumentation.incr('http_retries_total', host=urlsplit(url).netloc)
+            delay = backoff_seconds(attempt)
+            print(f"Request to {key} failed ({e}), retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+
+        throttle.update(key, response)
+        retryable = response.status_code in RETRY_STATUS_CODES if idempotent else response.status_code == 429
+        if retryable and attempt < retries:
+            delay = retry_after_seconds(response)
+            if delay is None:
+                delay = backoff_seconds(attempt)
+            instrumentation.incr('http_retries_total', host=urlsplit(url).netloc)
+            print(f"Request to {key} returned {response.status_code}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+            continue
+        return response
+
+def get(url, **kwargs):
+    return request("GET", url, **kwargs)
+
+def post(url, **kwargs):
+    return request("POST", url, **kwargs)
@@ -0,0 +1,145 @@
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from pathlib import Path
+
+# 実行ごとの計測結果の出力先(METRICS_ENABLED=0で無効にできる)
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_DIR = os.getenv("METRICS_DIR", "data/metrics")
+# ジョブ名(省略時は実行したスクリプトの名前)
+METRICS_JOB = os.getenv("METRICS_JOB") or Path(sys.argv[0] or "python").stem
+if METRICS_JOB == "__main__":
+    METRICS_JOB = Path(sys.argv[0]).parent.name or "app"
+METRIC_PREFIX = "collector"
+
+_lock = threading.Lock()
+_started_at = datetime.now()
+_started = time.monotonic()
+# 処理段階ごとの回数・合計時間・最大時間
+_spans = {}
+# (名前, ラベル) ごとの値
+_counters = {}
+
+def _record_span(name, elapsed):
+    with _lock:
+        stats = _spans.setdefault(name, {'count': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+        stats['count'] += 1
+        stats['seconds'] += elapsed
+        stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+
+# 処理段階の時間を計測する(withでもデコレーターでも使える)
+@contextmanager
+def span(name):
+    started = time.monotonic()
+    try:
+        yield
+    finally:
+        _record_span(name, time.monotonic() - started)
+
+# イテレーターから要素を取り出すのにかかった時間だけを計測する(ページングするAPIの一覧取得など)
+# 取り出した要素を使う側の処理時間は含まない
+def timed(iterable, name):
+    iterator = iter(iterable)
+    elapsed = 0.0
+    try:
+        while True:
+            started = time.monotonic()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.monotonic() - started
+            yield item
+    finally:
+        _record_span(name, elapsed)
+
+def incr(name, value=1, **labels):
+    key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+# OpenAIのレスポンスのトークン数を記録する
+def record_llm_usage(response, model=None):
+    model = model or getattr(response, 'model', None) or 'unknown'
+    incr('llm_requests_total', model=model)
+    usage = getattr(response, 'usage', None)
+    if usage is None:
+        return
+    incr('llm_prompt_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, model=model)
+    incr('llm_completion_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, model=model)
+
+def snapshot():
+    with _lock:
+        return {
+            'job': METRICS_JOB,
+            'started_at': _started_at.isoformat(timespec='seconds'),
+            'duration_seconds': round(time.monotonic() - _started, 3),
+            'spans': {name: {**stats, 'seconds': round(stats['seconds'], 3),
+                             'max_seconds': round(stats['max_seconds'], 3)}
+                      for name, stats in sorted(_spans.items())},
+            'counters': [{'name': name, 'labels': dict(labels), 'value': value}
+                         for (name, labels), value in sorted(_counters.items())],
+        }
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels.items()) + "}"
+
+# Prometheusのtextfile collector形式に変換する
+def to_prometheus(report):
+    job = {'job': report['job']}
+    lines = [
+        f"# TYPE {METRIC_PREFIX}_run_duration_seconds gauge",
+        f"{METRIC_PREFIX}_run_duration_seconds{_labels(job)} {report['duration_seconds']}",
+        f"# TYPE {METRIC_PREFIX}_stage_seconds summary",
+    ]
+    for name, stats in report['spans'].items():
+        labels = _labels({**job, 'stage': name})
+        lines.append(f"{METRIC_PREFIX}_stage_seconds_sum{labels} {stats['seconds']}")
+        lines.append(f"{METRIC_PREFIX}_stage_seconds_count{labels} {stats['count']}")
+    lines.append(f"# TYPE {METRIC_PREFIX}_stage_max_seconds gauge")
+    for name, stats in report['spans'].items():
+        lines.append(f"{METRIC_PREFIX}_stage_max_seconds{_labels({**job, 'stage': name})} {stats['max_seconds']}")
+    typed = set()
+    for counter in report['counters']:
+        metric = f"{METRIC_PREFIX}_{counter['name']}"
+        if metric not in typed:
+            lines.append(f"# TYPE {metric} counter")
+            typed.add(metric)
+        lines.append(f"{metric}{_labels({**job, **counter['labels']})} {counter['value']}")
+    return "\n".join(lines) + "\n"
+
+def _write_atomic(path, text):
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_text(text, encoding='utf-8')
+    os.replace(tmp_path, path)
+
+# JSONの実行レポートとPrometheusのtextfileを書き出す
+# JSONは実行ごとに別のファイルに、textfileはジョブごとに最新の内容で上書きする
+def write_report(directory=METRICS_DIR):
+    if not METRICS_ENABLED:
+        return None
+    report = snapshot()
+    directory = Path(directory)
+    try:
+        directory.mkdir(parents=True, exist_ok=True)
+        report_path = directory / f"{report['job']}_{_started_at.strftime('%Y%m%d_%H%M%S')}.json"
+        _write_atomic(report_path, json.dumps(report, ensure_ascii=False, indent=2))
+        _write_atomic(directory / f"{report['job']}.prom", to_prometheus(report))
+    except OSError as e:
+        print(f"Failed to write metrics: {e}")
+        return None
+    return report_path
+
+if METRICS_ENABLED:
+    atexit.register(write_report)
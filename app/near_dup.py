@@ -0,0 +1,303 @@
+import os
+import sys
+import time
+import random
+import sqlite3
+import hashlib
+import argparse
+import threading
+import unicodedata
+from array import array
+from pathlib import Path
+import instrumentation
+
+# 別の取得元に転載された投稿や、版違いの論文などのほぼ同じ内容を見つけるためのインデックス
+# 正規化したテキストの文字n-gramからMinHashの署名を作り、LSHで候補を絞り込んでから類似度を比べる
+# 重複と判定したものは最初に登録したレコード(代表)のグループにまとめ、取得元とリンクだけを記録する
+
+NEAR_DUP_PATH = os.getenv("NEAR_DUP_PATH", "data/state/near_dup.sqlite3")
+# 推定Jaccard類似度がこの値以上なら同じ内容とみなす
+NEAR_DUP_THRESHOLD = float(os.getenv("NEAR_DUP_THRESHOLD", "0.8"))
+# 署名の長さとLSHのバンド数(1バンドあたりの行数 = 署名の長さ / バンド数)
+NEAR_DUP_NUM_PERM = int(os.getenv("NEAR_DUP_NUM_PERM", "64"))
+NEAR_DUP_BANDS = int(os.getenv("NEAR_DUP_BANDS", "16"))
+NEAR_DUP_SHINGLE = int(os.getenv("NEAR_DUP_SHINGLE", "4"))
+# n-gramがこれより少ない短いテキストは判定しない(誤判定が多いため)
+NEAR_DUP_MIN_SHINGLES = int(os.getenv("NEAR_DUP_MIN_SHINGLES", "8"))
+NEAR_DUP_MAX_AGE_DAYS = float(os.getenv("NEAR_DUP_MAX_AGE_DAYS", "180"))
+NEAR_DUP_ENABLED = os.getenv("NEAR_DUP_ENABLED", "1") == "1"
+
+# ひらがなのローマ字表記(ヘボン式)
+ROMAJI = {
+    'あ': 'a', 'い': 'i', 'う': 'u', 'え': 'e', 'お': 'o',
+    'か': 'ka', 'き': 'ki', 'く': 'ku', 'け': 'ke', 'こ': 'ko',
+    'さ': 'sa', 'し': 'shi', 'す': 'su', 'せ': 'se', 'そ': 'so',
+    'た': 'ta', 'ち': 'chi', 'つ': 'tsu', 'て': 'te', 'と': 'to',
+    'な': 'na', 'に': 'ni', 'ぬ': 'nu', 'ね': 'ne', 'の': 'no',
+    'は': 'ha', 'ひ': 'hi', 'ふ': 'fu', 'へ': 'he', 'ほ': 'ho',
+    'ま': 'ma', 'み': 'mi', 'む': 'mu', 'め': 'me', 'も': 'mo',
+    'や': 'ya', 'ゆ': 'yu', 'よ': 'yo',
+    'ら': 'ra', 'り': 'ri', 'る': 'ru', 'れ': 're', 'ろ': 'ro',
+    'わ': 'wa', 'ゐ': 'i', 'ゑ': 'e', 'を': 'o', 'ん': 'n',
+    'が': 'ga', 'ぎ': 'gi', 'ぐ': 'gu', 'げ': 'ge', 'ご': 'go',
+    'ざ': 'za', 'じ': 'ji', 'ず': 'zu', 'ぜ': 'ze', 'ぞ': 'zo',
+    'だ': 'da', 'ぢ': 'ji', 'づ': 'zu', 'で': 'de', 'ど': 'do',
+    'ば': 'ba', 'び': 'bi', 'ぶ': 'bu', 'べ': 'be', 'ぼ': 'bo',
+    'ぱ': 'pa', 'ぴ': 'pi', 'ぷ': 'pu', 'ぺ': 'pe', 'ぽ': 'po',
+    'ゔ': 'vu', 'ぁ': 'a', 'ぃ': 'i', 'ぅ': 'u', 'ぇ': 'e', 'ぉ': 'o', 'ゎ': 'wa',
+}
+# 拗音(きゃ・しゅ など)
+YOUON = {'ゃ': 'ya', 'ゅ': 'yu', 'ょ': 'yo'}
+YOUON_SPECIAL = {'し': 'sh', 'ち': 'ch', 'じ': 'j', 'ぢ': 'j'}
+
+# カタカナをひらがなにする(NFKCで半角カナは全角になっている前提)
+def katakana_to_hiragana(text):
+    return "".join(chr(ord(char) - 0x60) if 'ァ' <= char <= 'ヶ' else char for char in text)
+
+# ひらがなをローマ字にする(漢字などはそのまま残す)
+def hiragana_to_romaji(text):
+    result = []
+    double_next = False
+    i = 0
+    while i < len(text):
+        char = text[i]
+        if char == 'っ':
+            double_next = True
+            i += 1
+            continue
+        if char == 'ー':
+            # 長音は直前の母音と同じとみなして省く(「はまー」と「はま」を同じにする)
+            i += 1
+            continue
+        romaji = ROMAJI.get(char)
+        if romaji and len(romaji) > 1 and romaji.endswith('i') and i + 1 < len(text) and text[i + 1] in YOUON:
+            small = YOUON[text[i + 1]]
+            romaji = YOUON_SPECIAL[char] + small[1:] if char in YOUON_SPECIAL else romaji[:-1] + small
+            i += 1
+        if romaji is None:
+            result.append(char)
+        else:
+            if double_next:
+                romaji = ('t' if romaji.startswith('ch') else romaji[0]) + romaji
+            result.append(romaji)
+        double_next = False
+        i += 1
+    return "".join(result)
+
+# 全角・半角、カタカナ・ひらがな・ローマ字、大文字・小文字の違いをなくし、
+# URLと記号・空白を除いた文字列にする
+#   normalize('かしいはま') == normalize('Kashiihama') == 'kashiihama'
+def normalize(text):
+    text = unicodedata.normalize('NFKC', text or "")
+    text = " ".join(word for word in text.split() if not word.startswith(('http://', 'https://')))
+    text = hiragana_to_romaji(katakana_to_hiragana(text)).casefold()
+    return "".join(char for char in text if char.isalnum())
+
+def shingles(text, size=NEAR_DUP_SHINGLE):
+    text = normalize(text)
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# 署名の計算に使うハッシュ関数の係数(署名を保存するので、乱数は固定する)
+def _permutations(num_perm):
+    rng = random.Random(num_perm)
+    return [(rng.randrange(1, _MERSENNE_PRIME), rng.randrange(0, _MERSENNE_PRIME)) for _ in range(num_perm)]
+
+def _shingle_hash(shingle):
+    return int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little')
+
+def minhash(shingle_set, permutations):
+    hashes = [_shingle_hash(shingle) for shingle in shingle_set]
+    return array('Q', (min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in permutations))
+
+# 2つの署名から推定したJaccard類似度
+def similarity(a, b):
+    return sum(x == y for x, y in zip(a, b)) / len(a)
+
+# 取得元をまたいで、ほぼ同じ内容のレコードをまとめるインデックス
+# add()した内容はcommit()するまで保存しない(SeenIndexと同じく、処理が失敗した場合は記録しない)
+# ただしopen_index()のインデックスは1つの接続を取得元で共有するので、commit()はどの取得元が呼んでも
+# それまでに全取得元がadd()した内容をまとめて保存する(取得元ごとのトランザクションにはならない)
+# 失敗した取得元のレコードが保存されても、次回同じキーをadd()すると記録済みの代表を返すだけなので判定は変わらない
+class NearDupIndex:
+    def __init__(self, path=NEAR_DUP_PATH, threshold=NEAR_DUP_THRESHOLD, num_perm=NEAR_DUP_NUM_PERM,
+                 bands=NEAR_DUP_BANDS, max_age_days=NEAR_DUP_MAX_AGE_DAYS):
+        if num_perm % bands:
+            raise ValueError("NEAR_DUP_NUM_PERM must be a multiple of NEAR_DUP_BANDS.")
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.max_age_days = max_age_days
+        self._permutations = _permutations(num_perm)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS records ("
+            " key TEXT PRIMARY KEY,"
+            " source TEXT NOT NULL,"
+            " link TEXT,"
+            " signature BLOB NOT NULL,"
+            " canonical TEXT NOT NULL,"
+            " added_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS records_canonical ON records (canonical)")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS buckets ("
+            " band INTEGER NOT NULL,"
+            " bucket TEXT NOT NULL,"
+            " key TEXT NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS buckets_lookup ON buckets (band, bucket)")
+        self._conn.commit()
+        self.prune()
+
+    def _buckets(self, signature):
+        for band in range(self.bands):
+            values = signature[band * self.rows:(band + 1) * self.rows]
+            yield band, hashlib.blake2b(values.tobytes(), digest_size=8).hexdigest()
+
+    def _candidates(self, signature):
+        keys = set()
+        for band, bucket in self._buckets(signature):
+            rows = self._conn.execute("SELECT key FROM buckets WHERE band = ? AND bucket = ?", (band, bucket))
+            keys.update(key for key, in rows)
+        return keys
+
+    # レコードを登録し、属するグループの代表のキーを返す(重複でなければ自分自身のキー)
+    # 短すぎて判定できないテキストは登録せずに自分自身のキーを返す
+    def add(self, key, text, source, link=None):
+        shingle_set = shingles(text)
+        if len(shingle_set) < NEAR_DUP_MIN_SHINGLES:
+            return key
+        signature = minhash(shingle_set, self._permutations)
+        with self._lock:
+            row = self._conn.execute("SELECT canonical FROM records WHERE key = ?", (key,)).fetchone()
+            if row:
+                return row[0]
+
+            # 類似度が閾値以上のレコードが属するグループの代表を集める(古い順)
+            roots = {}
+            for candidate in self._candidates(signature):
+                found = self._conn.execute(
+                    "SELECT signature, canonical FROM records WHERE key = ?", (candidate,)).fetchone()
+                if not found:
+                    continue
+                other = array('Q')
+                other.frombytes(found[0])
+                if similarity(signature, other) >= self.threshold:
+                    roots[found[1]] = None
+            canonical = key
+            if roots:
+                ordered = [root for root, in self._conn.execute(
+                    f"SELECT key FROM records WHERE key IN ({','.join('?' * len(roots))}) ORDER BY added_at",
+                    list(roots))]
+                canonical = ordered[0] if ordered else next(iter(roots))
+                # 複数のグループにまたがる場合は、最も古い代表のグループにまとめる
+                others = [root for root in roots if root != canonical]
+                if others:
+                    self._conn.execute(
+                        f"UPDATE records SET canonical = ? WHERE canonical IN ({','.join('?' * len(others))})",
+                        [canonical, *others])
+
+            self._conn.execute(
+                "INSERT INTO records (key, source, link, signature, canonical, added_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (key, source, link, signature.tobytes(), canonical, time.time()))
+            self._conn.executemany(
+                "INSERT INTO buckets (band, bucket, key) VALUES (?, ?, ?)",
+                [(band, bucket, key) for band, bucket in self._buckets(signature)])
+        return canonical
+
+    # グループに属するレコードの (取得元, キー, リンク) の一覧(代表が先頭)
+    def links(self, canonical):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT source, key, link FROM records WHERE canonical = ? ORDER BY added_at", (canonical,))
+            return rows.fetchall()
+
+    # 2件以上のレコードを含むグループの代表の一覧
+    def clusters(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT canonical, COUNT(*) FROM records GROUP BY canonical HAVING COUNT(*) > 1 ORDER BY 2 DESC")
+            return rows.fetchall()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    # 保持期間を過ぎたものを削除する
+    def prune(self):
+        if not self.max_age_days:
+            return
+        cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM buckets WHERE key IN (SELECT key FROM records WHERE added_at < ?)", (cutoff,))
+            self._conn.execute("DELETE FROM records WHERE added_at < ?", (cutoff,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+# レコードを登録し、他のレコードの重複ならTrueを返す(インデックスがなければ常にFalse)
+# 重複したレコードの取得元とリンクはインデックスに記録され、links()で代表から辿れる
+def is_duplicate(index, source, key, text, link=None):
+    if index is None or not text:
+        return False
+    record_key = f"{source}:{key}"
+    canonical = index.add(record_key, text, source, link)
+    if canonical == record_key:
+        return False
+    instrumentation.incr('near_duplicates_total', source=source)
+    print(f"Skipping {record_key}, a near-duplicate of {canonical}.")
+    return True
+
+# 重複と判定したレコードを除き、代表のレコードだけを返す
+# textがNoneや空文字を返すレコードは判定せずにそのまま返す
+def unique_records(records, index, source, key, text, link=None):
+    for record in records:
+        if not is_duplicate(index, source, key(record), text(record), link(record) if link else None):
+            yield record
+
+_index = None
+_index_lock = threading.Lock()
+
+# 取得元で共有するインデックスを取得する
+# python -m app runで複数の取得元を並列に実行しても、1つの接続で書き込むのでロックを待たない
+# (取得元ごとに接続を分けると、最初のadd()からcommit()までDBの書き込みロックを持ち続けて他の取得元が待たされる)
+# そのためcommit()は取得元ごとではなく、呼んだ時点の全取得元のadd()を保存する
+# NEAR_DUP_ENABLED=0の場合はNoneを返し、unique_recordsは何も除かない
+def open_index():
+    global _index
+    if not NEAR_DUP_ENABLED:
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = NearDupIndex()
+        return _index
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='取得元をまたいだ重複のグループ')
+    commands = parser.add_subparsers(dest='command', required=True)
+    commands.add_parser('clusters', help='重複のグループと取得元のリンクを表示する')
+    normalize_parser = commands.add_parser('normalize', help='正規化した結果を表示する')
+    normalize_parser.add_argument('text')
+    args = parser.parse_args(argv)
+
+    if args.command == 'normalize':
+        print(normalize(args.text))
+        return
+    index = NearDupIndex()
+    for canonical, count in index.clusters():
+        print(f"{canonical} ({count})")
+        for source, key, link in index.links(canonical):
+            print(f"    {source:<18}{key:<40}{link or ''}")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,17 @@
 import os
-import requests
-from openai import OpenAI
+import time
+import threading
+import openai
+from concurrent.futures import Future, TimeoutError
+from openai_client import get_openai_client
 from dotenv import load_dotenv
 from datetime import datetime
 import base64
-from fetch_astronomy import get_moon_data, get_visible_constellations  # fetch_astronomy.pyから関数をインポート
+from fetch_astronomy import get_astronomy_data  # fetch_astronomy.pyから関数をインポート
+import ephemeris
+from discord_notifier import DiscordNotifier
 from fetch_open_weather import get_weather_data  # fetch_open_weather.pyから関数をインポート
+import instrumentation
 
 # .envファイルを読み込む
 load_dotenv()
@@ -14,19 +20,35 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 DISCORD_WEBHOOK_URL_ART = os.getenv("DISCORD_WEBHOOK_URL_ART")
 
+# Discordへの通知はまとめてバックグラウンドで送信する
+notifier = DiscordNotifier(DISCORD_WEBHOOK_URL_ART)
+
 # OpenAI APIキーを設定
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = get_openai_client()
 
 # 指定された緯度と経度
 LATITUDE = os.getenv("LATITUDE")
 LONGTITUDE = os.getenv("LONGTITUDE")
 
+# データ取得元ごとのタイムアウト(秒)
+SOURCE_TIMEOUT = float(os.getenv("SOURCE_TIMEOUT", "30"))
+
+# forecastにすると、複数の候補地・数日先までの予報から撮影に適した時間帯を探す(sky_forecast.py)
+ASTRONOMY_MODE = os.getenv("ASTRONOMY_MODE", "today")
+
+# 月のフェーズと星座の取得元
+#   local: ephemeris.pyでローカルに計算する(APIを呼ばない)
+#   api:   AstronomyAPIを使い、失敗した場合はローカルの計算に切り替える
+#   both:  ローカルの計算を使い、AstronomyAPIの結果との違いを表示する
+ASTRONOMY_SOURCE = os.getenv("ASTRONOMY_SOURCE", "local")
+
 # 天気や天体情報を含むシステムメッセージを設定
 system_message = """
 You are a knowledgeable assistant in astronomy and weather forecasting. You have access to the latest weather data and astronomical information.
 """
 
 # OpenAI APIを利用して質問を送信し、回答を取得
+@instrumentation.span('astronomy.summarize')
 def ask_openai(question):
     try:
         response = client.chat.completions.create(
@@ -38,71 +60,137 @@ def ask_openai(question):
             max_tokens=600,
             temperature=0.3
         )
+        instrumentation.record_llm_usage(response, "gpt-4o")
         return response.choices[0].message.content.strip()
     except openai.OpenAIError as e:
         return f"Error: {e}"
 
-# Discordに通知を送信
-def send_discord_notification(message):
-    if DISCORD_WEBHOOK_URL_ART:
-        data = {"content": message}
-        response = requests.post(DISCORD_WEBHOOK_URL_ART, json=data)
-        if response.status_code != 204:
-            print(f"Failed to send notification: {response.status_code}")
-            print(f"Response content: {response.content.decode('utf-8')}")
-    else:
-        print("Discord Webhook URL is not set.")
+# 関数をデーモンスレッドで実行する
+# ThreadPoolExecutorのスレッドは終了時に完了を待たれるので、応答のないリクエストがあるとプロセスが終わらない
+def run_in_daemon(func):
+    future = Future()
 
-# メッセージを分割して送信
-def send_long_message(message):
-    max_length = 2000
-    for i in range(0, len(message), max_length):
-        send_discord_notification(message[i:i + max_length])
+    def target():
+        future.set_running_or_notify_cancel()
+        try:
+            future.set_result(func())
+        except BaseException as e:
+            future.set_exception(e)
 
-if __name__ == "__main__":
-    # 天気情報を取得
-    weather_data = get_weather_data(LATITUDE, LONGTITUDE)
-    # 月のデータを取得
-    moon_data = get_moon_data(LATITUDE, LONGTITUDE)
-    # 観測できる星座の情報を取得
-    constellations = get_visible_constellations(LATITUDE, LONGTITUDE)
-
-    # 天気情報、月のデータ、星座のデータが取得できた場合
-    if weather_data and moon_data and constellations:
-        weather_description = weather_data['weather'][0]['description']
-        temperature = weather_data['main']['temp']
-        humidity = weather_data['main']['humidity']
-        wind_speed = weather_data['wind']['speed']
-        cloudiness = weather_data['clouds']['all']
-
-        moon_phase = moon_data['data']['table']['rows'][1]['cells'][0]['extraInfo']['phase']['string']
-        moonlight = "有り" if moon_phase not in ["New Moon", "Waning Crescent"] else "無し"
+    threading.Thread(target=target, daemon=True).start()
+    return future
 
-        # 観測できる星座のリストを作成
-        constellations_list = ", ".join(constellations)
+# 天気情報と天体情報を並列に取得する
+# timeoutsで取得元ごとのタイムアウトを指定でき、タイムアウトや失敗した取得元はNoneになる
+# タイムアウトしたリクエストの完了は待たない(デーモンスレッドなのでプロセスの終了も妨げない)
+def gather_sources(sources, timeouts=None):
+    timeouts = timeouts or {}
+    results = {}
+    started = time.monotonic()
+    futures = {name: run_in_daemon(func) for name, func in sources.items()}
+    for name, future in futures.items():
+        deadline = started + timeouts.get(name, SOURCE_TIMEOUT)
+        try:
+            results[name] = future.result(timeout=max(0, deadline - time.monotonic()))
+        except TimeoutError:
+            print(f"Timed out fetching {name} data.")
+            results[name] = None
+        except Exception as e:
+            print(f"Error fetching {name} data: {e}")
+            results[name] = None
+    return results
 
-        # 質問を設定
-        question = f"""
-        本日、緯度: {LATITUDE}, 経度: {LONGTITUDE}の地点で夜空を撮影するのに適しているか知りたいです。以下の点について教えてください:
-        1. 天気情報:
-            - 天気: {weather_description}
-            - 気温: {temperature}°C
-            - 湿度: {humidity}%
-            - 風速: {wind_speed} m/s
-            - 雲量: {cloudiness}%
-        2. 天体情報:
+# 取得できたデータだけで質問を作成する
+def build_question(weather_data, astronomy_data):
+    if weather_data:
+        weather_section = f"""1. 天気情報:
+            - 天気: {weather_data['weather'][0]['description']}
+            - 気温: {weather_data['main']['temp']}°C
+            - 湿度: {weather_data['main']['humidity']}%
+            - 風速: {weather_data['wind']['speed']} m/s
+            - 雲量: {weather_data['clouds']['all']}%"""
+    else:
+        weather_section = """1. 天気情報:
+            - 取得できませんでした"""
+
+    if astronomy_data:
+        moon_phase = astronomy_data['moon_phase']
+        moonlight = "有り" if moon_phase not in ["New Moon", "Waning Crescent"] else "無し"
+        # 観測できる星座のリストを作成
+        constellations_list = ", ".join(astronomy_data['constellations']) or "不明"
+        astronomy_section = f"""2. 天体情報:
             - 月のフェーズ: {moon_phase}
             - 月明かりの有無: {moonlight}
-            - 観測できる星座: {constellations_list}
+            - 観測できる星座: {constellations_list}"""
+    else:
+        astronomy_section = """2. 天体情報:
+            - 取得できませんでした"""
+
+    return f"""
+        本日、緯度: {LATITUDE}, 経度: {LONGTITUDE}の地点で夜空を撮影するのに適しているか知りたいです。以下の点について教えてください:
+        {weather_section}
+        {astronomy_section}
         3. 夜空撮影に適しているかどうかの総合評価
         """
 
+# AstronomyAPIから取得する(接続エラーやレスポンスの形が違う場合もNoneを返す)
+def get_api_astronomy_data(lat, lon):
+    try:
+        return get_astronomy_data(lat, lon)
+    except Exception as e:
+        print(f"Error fetching AstronomyAPI data: {e!r}")
+        return None
+
+# ASTRONOMY_SOURCEに応じて月のフェーズと観測できる星座を取得する
+def get_sky_data(lat, lon):
+    if ASTRONOMY_SOURCE == "api":
+        data = get_api_astronomy_data(lat, lon)
+        if data:
+            return data
+        print("Falling back to the local ephemeris.")
+        return ephemeris.get_astronomy_data(lat, lon)
+
+    data = ephemeris.get_astronomy_data(lat, lon)
+    if ASTRONOMY_SOURCE == "both":
+        # 照合は補助的なものなので、失敗してもローカルの結果を使う
+        api_data = get_api_astronomy_data(lat, lon)
+        try:
+            if api_data:
+                print(f"Cross-check with AstronomyAPI: {ephemeris.compare_with_response(api_data['raw'])}")
+        except (KeyError, TypeError, ValueError) as e:
+            print(f"Could not cross-check with AstronomyAPI: {e!r}")
+    return data
+
+def main():
+    if ASTRONOMY_MODE == "forecast":
+        import sky_forecast
+        sky_forecast.main()
+        return
+
+    # 天気情報と、月のデータ・観測できる星座の情報を並列に取得
+    with instrumentation.span('astronomy.fetch'):
+        sources = gather_sources({
+            'weather': lambda: get_weather_data(LATITUDE, LONGTITUDE),
+            'astronomy': lambda: get_sky_data(LATITUDE, LONGTITUDE),
+        })
+    weather_data = sources['weather']
+    astronomy_data = sources['astronomy']
+
+    # どちらかのデータが取得できていれば、取得できた情報だけで質問する
+    if weather_data or astronomy_data:
+        question = build_question(weather_data, astronomy_data)
+
         # OpenAI APIを利用して質問を送信し、回答を取得
         answer = ask_openai(question)
         message = f"本日の天体情報:\n{answer}"
         print(message)
         # メッセージを分割して送信
-        send_long_message(message)
+        with instrumentation.span('astronomy.notify'):
+            notifier.send(message)
+            notifier.flush()
     else:
         # 天気情報、月のデータ、星座のデータを取得できなかった場合のエラーメッセージ
-        print("天気情報、月のデータ、または星座のデータを取得できませんでした。")
\ No newline at end of file
+        print("天気情報、月のデータ、または星座のデータを取得できませんでした。")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import os
+import json
+import time
+from datetime import datetime
+from pathlib import Path
+
+# バッチの状態の保存先(プロセスが再起動しても、ここからポーリングを再開する)
+BATCH_STATE_PATH = os.getenv("OPENAI_BATCH_STATE_PATH", "data/state/openai_batch.json")
+BATCH_POLL_INTERVAL = float(os.getenv("OPENAI_BATCH_POLL_INTERVAL", "30"))
+# 1回の実行で完了を待つ最大時間(秒)。過ぎた場合は次回の実行で再開する
+BATCH_MAX_WAIT = float(os.getenv("OPENAI_BATCH_MAX_WAIT", str(5 * 60 * 60)))
+
+CHAT_COMPLETIONS_ENDPOINT = "/v1/chat/completions"
+TERMINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+# Batch APIの入力ファイルの1行分を作成
+def chat_request_line(custom_id, body):
+    return {"custom_id": custom_id, "method": "POST", "url": CHAT_COMPLETIONS_ENDPOINT, "body": body}
+
+def load_state(path=BATCH_STATE_PATH):
+    path = Path(path)
+    if not path.exists():
+        return None
+    with path.open(encoding='utf-8') as f:
+        return json.load(f)
+
+def save_state(state, path=BATCH_STATE_PATH):
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w', encoding='utf-8') as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+def clear_state(path=BATCH_STATE_PATH):
+    path = Path(path)
+    if path.exists():
+        path.unlink()
+
+# リクエストをJSONLファイルに書き出してバッチを作成し、結果の突き合わせに必要な情報と一緒に状態を保存する
+def submit_batch(client, lines, context, path=BATCH_STATE_PATH):
+    input_path = Path(path).with_name('openai_batch_input.jsonl')
+    input_path.parent.mkdir(parents=True, exist_ok=True)
+    with input_path.open('w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(json.dumps(line, ensure_ascii=False) + '\n')
+
+    with input_path.open('rb') as f:
+        input_file = client.files.create(file=f, purpose='batch')
+    batch = client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=CHAT_COMPLETIONS_ENDPOINT,
+        completion_window='24h')
+    print(f"Submitted batch {batch.id} with {len(lines)} requests.")
+
+    state = {
+        'batch_id': batch.id,
+        'input_file_id': input_file.id,
+        'submitted_at': datetime.now().isoformat(timespec='seconds'),
+        'context': context,
+    }
+    save_state(state, path)
+    return state
+
+# バッチが終わるまでポーリングする
+def wait_for_batch(client, batch_id, poll_interval=BATCH_POLL_INTERVAL, max_wait=BATCH_MAX_WAIT):
+    deadline = time.monotonic() + max_wait
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        counts = batch.request_counts
+        progress = f" ({counts.completed}/{counts.total})" if counts else ""
+        print(f"Batch {batch_id}: {batch.status}{progress}")
+        if batch.status in TERMINAL_STATUSES:
+            return batch
+        if time.monotonic() + poll_interval > deadline:
+            raise TimeoutError(f"Batch {batch_id} is still {batch.status}; run again to resume polling.")
+        time.sleep(poll_interval)
+
+# 結果ファイルを読み込み、custom_idごとの応答テキストを返す(失敗したリクエストは含まない)
+def read_results(client, batch):
+    results = {}
+    if batch.output_file_id:
+        content = client.files.content(batch.output_file_id).text
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            item = json.loads(line)
+            response = item.get('response') or {}
+            if response.get('status_code') != 200:
+                continue
+            results[item['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+    if batch.error_file_id:
+        errors = client.files.content(batch.error_file_id).text.splitlines()
+        print(f"Batch {batch.id}: {len(errors)} requests failed.")
+    return results
@@ -0,0 +1,12 @@
+import os
+from functools import lru_cache
+from openai import OpenAI
+from dotenv import load_dotenv
+
+# .envファイルを読み込む
+load_dotenv()
+
+# 同じプロセス内の各処理でOpenAIクライアント(と接続プール)を共有する
+@lru_cache(maxsize=None)
+def get_openai_client():
+    return OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
@@ -1,6 +1,9 @@
 import os
-from openai import OpenAI
+from openai_client import get_openai_client
 from dotenv import load_dotenv
+from cache_store import get_llm_cache, make_key
+from summary_packer import SummaryPacker
+import instrumentation
 
 # .envファイルを読み込む
 load_dotenv()
@@ -8,29 +11,54 @@ load_dotenv()
 # 環境変数からAPIキーを取得
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 
-client = OpenAI(api_key=OPENAI_API_KEY)
+client = get_openai_client()
+
+SUMMARY_MODEL = "gpt-4"
+SUMMARY_SYSTEM_PROMPT = "You are a helpful assistant that summarizes texts."
+SUMMARY_MAX_TOKENS = 100
+SUMMARY_TEMPERATURE = 0.5
+
+def summary_cache_key(text):
+    return make_key(SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, text, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE)
 
 def summarize_text(text):
     """与えられたテキストを要約する関数"""
+    # 同じ入力の要約はキャッシュから返す
+    cache = get_llm_cache()
+    cache_key = summary_cache_key(text)
+    cached = cache.get(cache_key)
+    if cached is not None:
+        return cached
+
     try:
         # OpenAIのChat APIを使用して要約を作成
-        response = client.chat.completions.create(model="gpt-4",
+        response = client.chat.completions.create(model=SUMMARY_MODEL,
         messages=[
-            {"role": "system", "content": "You are a helpful assistant that summarizes texts."},
+            {"role": "system", "content": SUMMARY_SYSTEM_PROMPT},
             {"role": "user", "content": f"Summarize the following text:\n\n{text}"}
         ],
-        max_tokens=100,
-        temperature=0.5)
+        max_tokens=SUMMARY_MAX_TOKENS,
+        temperature=SUMMARY_TEMPERATURE)
 
+        instrumentation.record_llm_usage(response, SUMMARY_MODEL)
         # 要約を取得
         summary = response.choices[0].message.content.strip()
+        cache.set(cache_key, summary)
         return summary
 
     except Exception as e:
         print(f"Error with OpenAI API: {e}")
         return "Error occurred while summarizing text."
 
-# 要約したいテキスト
-text_to_summarize = "This is a test text to summarize."
-# 要約を出力
-print(summarize_text(text_to_summarize))
\ No newline at end of file
+def summarize_texts(texts):
+    """複数のテキストをまとめて要約する関数(結果は入力と同じ順序で返す)"""
+    # gpt-4はresponse_formatに対応していないので、JSONはプロンプトで指示して検証する
+    packer = SummaryPacker(client, SUMMARY_MODEL, SUMMARY_SYSTEM_PROMPT, SUMMARY_MAX_TOKENS, SUMMARY_TEMPERATURE,
+                           use_cache=True, json_mode=False)
+    return packer.summarize(texts)
+
+if __name__ == "__main__":
+    # 要約したいテキスト
+    text_to_summarize = "This is a test text to summarize."
+    # 要約を出力
+    print(summarize_text(text_to_summarize))
@@ -0,0 +1,103 @@
+import os
+import gzip
+import json
+import time
+from pathlib import Path
+
+# 書き出しの設定(環境変数で変更可能)
+RECORD_COMPRESSION = os.getenv('RECORD_COMPRESSION', 'gzip') or None  # gzip / zstd / 空文字(圧縮なし)
+RECORD_ROTATE_BYTES = int(os.getenv('RECORD_ROTATE_BYTES', str(64 * 1024 * 1024)))
+RECORD_FLUSH_INTERVAL = float(os.getenv('RECORD_FLUSH_INTERVAL', '5'))
+
+EXTENSIONS = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+# 圧縮形式に応じて、書き込み用のストリームを作成
+def _open_stream(raw, compression):
+    if compression is None:
+        return raw
+    if compression == 'gzip':
+        return gzip.GzipFile(fileobj=raw, mode='wb')
+    if compression == 'zstd':
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError("zstd圧縮を使うには 'zstandard' パッケージをインストールしてください。")
+        return zstandard.ZstdCompressor().stream_writer(raw, closefd=False)
+    raise ValueError(f"Unsupported compression: {compression}")
+
+# レコードを1行ずつJSONLファイルに追記していくライター
+# 指定サイズを超えたら次のファイルに切り替え、一定間隔でディスクに書き出すので
+# 途中で処理が落ちてもそれまでに書いたレコードは残る
+class JsonlWriter:
+    def __init__(self, directory, prefix, compression=RECORD_COMPRESSION,
+                 rotate_bytes=RECORD_ROTATE_BYTES, flush_interval=RECORD_FLUSH_INTERVAL,
+                 on_close=None):
+        if compression not in EXTENSIONS:
+            raise ValueError(f"Unsupported compression: {compression}")
+        self.directory = Path(directory)
+        self.prefix = prefix
+        self.compression = compression
+        self.rotate_bytes = rotate_bytes
+        self.flush_interval = flush_interval
+        self.on_close = on_close  # ファイルを閉じるたびにパスを渡して呼ばれる
+        self.paths = []
+        self.record_count = 0
+        self._raw = None
+        self._stream = None
+        self._last_flush = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _open_next(self):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        part = len(self.paths) + 1
+        path = self.directory / f"{self.prefix}.part{part:03d}.jsonl{EXTENSIONS[self.compression]}"
+        self._raw = path.open('wb')
+        self._stream = _open_stream(self._raw, self.compression)
+        self.paths.append(path)
+
+    def _close_current(self):
+        if self._stream is None:
+            return
+        if self._stream is not self._raw:
+            self._stream.close()
+        self._raw.close()
+        path = self.paths[-1]
+        self._raw = None
+        self._stream = None
+        if self.on_close:
+            self.on_close(path)
+
+    # 圧縮途中のデータも含めてディスクに書き出す
+    def flush(self):
+        if self._stream is None:
+            return
+        self._stream.flush()
+        if self._stream is not self._raw:
+            self._raw.flush()
+        os.fsync(self._raw.fileno())
+        self._last_flush = time.monotonic()
+
+    def write(self, record):
+        if self._stream is None:
+            self._open_next()
+        line = json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n'
+        self._stream.write(line.encode('utf-8'))
+        self.record_count += 1
+
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+        if self.rotate_bytes and self._raw.tell() >= self.rotate_bytes:
+            self._close_current()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+        return self.record_count
+
+    def close(self):
+        self._close_current()
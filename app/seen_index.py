@@ -0,0 +1,109 @@
+import os
+import time
+import math
+import sqlite3
+import hashlib
+import threading
+from pathlib import Path
+
+# 既出アイテムの保存先と保持期間
+SEEN_INDEX_PATH = os.getenv("SEEN_INDEX_PATH", "data/state/seen_index.sqlite3")
+SEEN_MAX_AGE_DAYS = float(os.getenv("SEEN_MAX_AGE_DAYS", "180"))
+
+# 「含まれていない」ことを高速に判定するためのBloomフィルター
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(capacity, 1024)
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self._bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value):
+        digest = hashlib.blake2b(value.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return ((h1 + i * h2) % self.size for i in range(self.hash_count))
+
+    def add(self, value):
+        for position in self._positions(value):
+            self._bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, value):
+        return all(self._bits[position >> 3] & (1 << (position & 7)) for position in self._positions(value))
+
+# 一度通知・要約したアイテムのIDを記録し、次回以降の重複を除くためのインデックス
+# mark()した内容はcommit()するまでメモリ上にだけ保持する(通知が失敗した場合は記録しない)
+class SeenIndex:
+    def __init__(self, path=SEEN_INDEX_PATH, max_age_days=SEEN_MAX_AGE_DAYS):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_age_days = max_age_days
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._conn = sqlite3.connect(str(self.path), timeout=30, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS seen ("
+            " namespace TEXT NOT NULL,"
+            " item_id TEXT NOT NULL,"
+            " first_seen REAL NOT NULL,"
+            " PRIMARY KEY (namespace, item_id))"
+        )
+        self.prune()
+        count = self._conn.execute("SELECT COUNT(*) FROM seen").fetchone()[0]
+        self._bloom = BloomFilter(count * 2)
+        for namespace, item_id in self._conn.execute("SELECT namespace, item_id FROM seen"):
+            self._bloom.add(self._bloom_key(namespace, item_id))
+
+    @staticmethod
+    def _bloom_key(namespace, item_id):
+        return f"{namespace}\x00{item_id}"
+
+    def __contains__(self, key):
+        namespace, item_id = key
+        return self.contains(namespace, item_id)
+
+    def contains(self, namespace, item_id):
+        item_id = str(item_id)
+        with self._lock:
+            if (namespace, item_id) in self._pending:
+                return True
+            # Bloomフィルターに無ければ確実に未登録なので、DBを引かずに済む
+            if self._bloom_key(namespace, item_id) not in self._bloom:
+                return False
+            row = self._conn.execute(
+                "SELECT 1 FROM seen WHERE namespace = ? AND item_id = ?", (namespace, item_id)).fetchone()
+        return row is not None
+
+    def mark(self, namespace, item_id):
+        with self._lock:
+            self._pending.add((namespace, str(item_id)))
+
+    # まだ保存していないmark()を取り消す
+    def unmark(self, namespace, item_id):
+        with self._lock:
+            self._pending.discard((namespace, str(item_id)))
+
+    # mark()した内容を保存する
+    def commit(self):
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO seen (namespace, item_id, first_seen) VALUES (?, ?, ?)",
+                [(namespace, item_id, now) for namespace, item_id in self._pending])
+            self._conn.commit()
+            for namespace, item_id in self._pending:
+                self._bloom.add(self._bloom_key(namespace, item_id))
+            self._pending.clear()
+
+    # 保持期間を過ぎたものを削除する
+    def prune(self):
+        if not self.max_age_days:
+            return
+        cutoff = time.time() - self.max_age_days * 24 * 60 * 60
+        with self._lock:
+            self._conn.execute("DELETE FROM seen WHERE first_seen < ?", (cutoff,))
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
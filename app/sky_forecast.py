@@ -0,0 +1,211 @@
+import os
+import json
+import openai
+import numpy as np
+from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+from openai_client import get_openai_client
+from discord_notifier import DiscordNotifier
+from fetch_open_weather import get_forecast_data
+import instrumentation
+from ephemeris import (days_since_j2000, sun_position, moon_position, horizontal,
+                       moon_illumination, topocentric_moon_altitude)
+
+# .envファイルを読み込む
+load_dotenv()
+
+DISCORD_WEBHOOK_URL_ART = os.getenv("DISCORD_WEBHOOK_URL_ART")
+
+# Discordへの通知はまとめてバックグラウンドで送信する
+notifier = DiscordNotifier(DISCORD_WEBHOOK_URL_ART)
+
+client = get_openai_client()
+
+# 候補地点。"名前:緯度:経度" をカンマ区切りで指定するか、JSONファイル([{"name", "lat", "lon"}])を指定する
+# どちらもなければLATITUDE/LONGTITUDEの1地点
+SKY_FORECAST_SITES = os.getenv("SKY_FORECAST_SITES", "")
+SKY_FORECAST_SITES_FILE = os.getenv("SKY_FORECAST_SITES_FILE")
+# 予報を見る日数(OpenWeatherの無料の予報は5日先まで)と、同時に取得する地点数
+SKY_FORECAST_DAYS = int(os.getenv("SKY_FORECAST_DAYS", "5"))
+SKY_FORECAST_WORKERS = int(os.getenv("SKY_FORECAST_WORKERS", "8"))
+# LLMに説明させる上位の枠の数と、最低スコア
+SKY_FORECAST_TOP = int(os.getenv("SKY_FORECAST_TOP", "5"))
+SKY_FORECAST_MIN_SCORE = float(os.getenv("SKY_FORECAST_MIN_SCORE", "10"))
+
+FORECAST_MODEL = "gpt-4o"
+FORECAST_STEP_SECONDS = 3 * 60 * 60
+HOUR = 60 * 60
+
+system_message = """
+You are a knowledgeable assistant in astronomy and weather forecasting. You help plan night sky photography from forecast data.
+"""
+
+def load_sites():
+    if SKY_FORECAST_SITES_FILE:
+        with open(SKY_FORECAST_SITES_FILE, encoding='utf-8') as f:
+            return [{'name': site['name'], 'lat': float(site['lat']), 'lon': float(site['lon'])} for site in json.load(f)]
+    sites = []
+    for item in filter(None, (value.strip() for value in SKY_FORECAST_SITES.split(','))):
+        name, lat, lon = item.rsplit(':', 2)
+        sites.append({'name': name, 'lat': float(lat), 'lon': float(lon)})
+    if not sites and os.getenv("LATITUDE") and os.getenv("LONGTITUDE"):
+        sites.append({'name': 'default', 'lat': float(os.getenv("LATITUDE")), 'lon': float(os.getenv("LONGTITUDE"))})
+    return sites
+
+# 全地点の予報を並列に取得する(取得できなかった地点はNone)
+@instrumentation.span('sky_forecast.fetch')
+def fetch_forecasts(sites, days=SKY_FORECAST_DAYS):
+    count = days * 24 * HOUR // FORECAST_STEP_SECONDS
+
+    def fetch(site):
+        try:
+            return get_forecast_data(site['lat'], site['lon'], count)
+        except Exception as e:
+            print(f"Error fetching forecast for {site['name']}: {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(SKY_FORECAST_WORKERS, len(sites)))) as executor:
+        return list(executor.map(fetch, sites))
+
+# 予報を1時間ごとの (地点, 時刻) の配列にする
+# 3時間ごとの予報を線形補間し、予報の範囲外や取得できなかった地点はNaNにする
+def forecast_grid(forecasts, hours):
+    shape = (len(forecasts), len(hours))
+    grid = {name: np.full(shape, np.nan) for name in ('clouds', 'humidity', 'wind')}
+    utc_offsets = np.zeros(len(forecasts))
+    for i, forecast in enumerate(forecasts):
+        if not forecast or not forecast.get('list'):
+            continue
+        utc_offsets[i] = (forecast.get('city') or {}).get('timezone', 0)
+        entries = forecast['list']
+        times = np.array([entry['dt'] for entry in entries], dtype=float)
+        values = {
+            'clouds': [entry['clouds']['all'] for entry in entries],
+            'humidity': [entry['main']['humidity'] for entry in entries],
+            'wind': [entry['wind']['speed'] for entry in entries],
+        }
+        inside = (hours >= times[0]) & (hours <= times[-1])
+        for name, series in values.items():
+            grid[name][i, inside] = np.interp(hours[inside], times, np.asarray(series, dtype=float))
+    return grid, utc_offsets
+
+# 地点(緯度・経度は度の配列)と時刻の組ごとの高度(度)。ra/decは時刻ごとの配列
+def altitude(lat, lon, d, ra, dec):
+    return horizontal(lat[:, None], lon[:, None], d[None, :], ra[None, :], dec[None, :])[0]
+
+# すべての (地点, 時刻) の撮影条件を0〜100で評価する
+# 暗さ(太陽高度)・雲量・湿度・風速・月明かり(月の高度と輝面比)を掛け合わせる
+def score_cells(sites, hours, grid):
+    lat = np.array([site['lat'] for site in sites])
+    lon = np.array([site['lon'] for site in sites])
+    d = days_since_j2000(hours)
+    sun_longitude, sun_ra, sun_dec = sun_position(d)
+    moon_longitude, moon_latitude, moon_ra, moon_dec = moon_position(d)
+    sun_alt = altitude(lat, lon, d, sun_ra, sun_dec)
+    moon_alt = topocentric_moon_altitude(altitude(lat, lon, d, moon_ra, moon_dec))
+    illumination = moon_illumination(sun_longitude, moon_longitude, moon_latitude)
+
+    # 太陽高度-6度(市民薄明の終わり)で0、-18度(天文薄明の終わり)で1
+    darkness = np.clip((-sun_alt - 6) / 12, 0, 1)
+    clouds = (1 - np.clip(grid['clouds'], 0, 100) / 100) ** 1.5
+    humidity = np.clip(1 - (grid['humidity'] - 60) / 80, 0.5, 1)
+    wind = np.clip(1 - (grid['wind'] - 5) / 10, 0.3, 1)
+    # 地平線の下の月は影響しない。高く明るい月ほど暗い天体が見えにくい
+    moonlight = 1 - 0.8 * illumination[None, :] * np.sqrt(np.clip(np.sin(np.radians(moon_alt)), 0, 1))
+    scores = 100 * darkness * clouds * humidity * wind * moonlight
+    return np.nan_to_num(scores, nan=0.0), {
+        'sun_alt': sun_alt, 'moon_alt': moon_alt, 'illumination': illumination,
+    }
+
+# スコアの高い枠を選ぶ(同じ地点の同じ夜からは最も良い1時間だけ)
+def top_slots(sites, hours, scores, grid, astro, utc_offsets, count=SKY_FORECAST_TOP, min_score=SKY_FORECAST_MIN_SCORE):
+    # 現地時刻の正午を区切りに、どの夜に属するかを決める
+    nights = np.floor((hours[None, :] + utc_offsets[:, None] - 12 * HOUR) / 86400)
+    slots = []
+    used = set()
+    for index in np.argsort(scores, axis=None)[::-1]:
+        site_index, hour_index = np.unravel_index(index, scores.shape)
+        if scores[site_index, hour_index] < min_score or len(slots) >= count:
+            break
+        night = (site_index, nights[site_index, hour_index])
+        if night in used:
+            continue
+        used.add(night)
+        local_time = datetime.fromtimestamp(hours[hour_index], timezone(timedelta(seconds=int(utc_offsets[site_index]))))
+        slots.append({
+            'site': sites[site_index]['name'],
+            'lat': sites[site_index]['lat'],
+            'lon': sites[site_index]['lon'],
+            'time': local_time.strftime('%Y-%m-%d %H:%M %z'),
+            'score': round(float(scores[site_index, hour_index]), 1),
+            'clouds': round(float(grid['clouds'][site_index, hour_index])),
+            'humidity': round(float(grid['humidity'][site_index, hour_index])),
+            'wind': round(float(grid['wind'][site_index, hour_index]), 1),
+            'sun_altitude': round(float(astro['sun_alt'][site_index, hour_index]), 1),
+            'moon_altitude': round(float(astro['moon_alt'][site_index, hour_index]), 1),
+            'moon_illumination': round(float(astro['illumination'][hour_index]), 2),
+        })
+    return slots
+
+def build_question(slots, site_count, days):
+    lines = "\n".join(
+        f"- {slot['site']} ({slot['lat']}, {slot['lon']}) {slot['time']}: スコア {slot['score']}, "
+        f"雲量 {slot['clouds']}%, 湿度 {slot['humidity']}%, 風速 {slot['wind']} m/s, "
+        f"月の高度 {slot['moon_altitude']}°, 月の輝面比 {slot['moon_illumination']}"
+        for slot in slots)
+    return f"""
+        {site_count}か所の候補地の今後{days}日間の予報から、夜空の撮影に適した時間帯を評価しました。
+        スコアの高い順の候補は次のとおりです:
+        {lines}
+        それぞれの候補について、撮影に向いている理由と注意点を簡潔に説明し、最もおすすめの候補を教えてください。
+        """
+
+@instrumentation.span('sky_forecast.summarize')
+def ask_openai(question):
+    try:
+        response = client.chat.completions.create(
+            model=FORECAST_MODEL,
+            messages=[
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": question}
+            ],
+            max_tokens=800,
+            temperature=0.3
+        )
+        instrumentation.record_llm_usage(response, FORECAST_MODEL)
+        return response.choices[0].message.content.strip()
+    except openai.OpenAIError as e:
+        return f"Error: {e}"
+
+# 全地点・全時刻を評価し、上位の枠だけをLLMで説明して通知する
+def forecast(sites, days=SKY_FORECAST_DAYS):
+    forecasts = fetch_forecasts(sites, days)
+    with instrumentation.span('sky_forecast.score'):
+        start = (int(datetime.now().timestamp()) // HOUR + 1) * HOUR
+        hours = start + np.arange(days * 24, dtype=float) * HOUR
+        grid, utc_offsets = forecast_grid(forecasts, hours)
+        scores, astro = score_cells(sites, hours, grid)
+        slots = top_slots(sites, hours, scores, grid, astro, utc_offsets)
+    return slots
+
+def main():
+    sites = load_sites()
+    if not sites:
+        print("Error: set SKY_FORECAST_SITES, SKY_FORECAST_SITES_FILE or LATITUDE/LONGTITUDE.")
+        exit(1)
+
+    slots = forecast(sites)
+    if not slots:
+        print("撮影に適した時間帯が見つかりませんでした。")
+        return
+
+    answer = ask_openai(build_question(slots, len(sites), SKY_FORECAST_DAYS))
+    message = f"今後{SKY_FORECAST_DAYS}日間の星空撮影の候補:\n{answer}"
+    print(message)
+    with instrumentation.span('sky_forecast.notify'):
+        notifier.send(message)
+        notifier.flush()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import os
+import json
+import re
+import threading
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+import openai
+from cache_store import get_llm_cache, make_key
+import instrumentation
+
+# tiktokenがあれば正確にトークン数を数え、なければ文字数から見積もる
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# 1回のリクエストにまとめる入力トークン数の上限と、まとめる件数の上限
+PACK_TOKEN_BUDGET = int(os.getenv("SUMMARY_PACK_TOKEN_BUDGET", "6000"))
+PACK_MAX_ITEMS = int(os.getenv("SUMMARY_PACK_MAX_ITEMS", "20"))
+# 文書1件ごとに付く区切りタグなどのトークン数
+DOCUMENT_OVERHEAD_TOKENS = 12
+
+ERROR_SUMMARY = "Error occurred while summarizing text."
+
+PACKED_INSTRUCTIONS = (
+    "You will receive several documents, each wrapped in a <document id=\"...\"> tag. "
+    "Summarize every document separately. "
+    "Respond with only a JSON object of the form "
+    "{\"summaries\": [{\"id\": \"<document id>\", \"summary\": \"<summary>\"}]} "
+    "containing exactly one summary for every id."
+)
+
+@lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_tokens(text, model):
+    if tiktoken is None:
+        return len(text or "") // 4 + 1
+    return len(_encoding(model).encode(text or ""))
+
+# (id, テキスト) のリストを、トークン数の上限に収まるグループに分ける
+# 1件で上限を超えるものは単独のグループにする
+def pack_items(items, model, budget=PACK_TOKEN_BUDGET, max_items=PACK_MAX_ITEMS):
+    groups = []
+    group = []
+    group_tokens = 0
+    for item_id, text in items:
+        tokens = count_tokens(text, model) + DOCUMENT_OVERHEAD_TOKENS
+        if group and (group_tokens + tokens > budget or len(group) >= max_items):
+            groups.append(group)
+            group = []
+            group_tokens = 0
+        group.append((item_id, text))
+        group_tokens += tokens
+    if group:
+        groups.append(group)
+    return groups
+
+def build_documents(group):
+    return "\n\n".join(f"<document id=\"{item_id}\">\n{text}\n</document>" for item_id, text in group)
+
+# 応答のJSONを読み込み、idごとの要約を返す(要求していないidや空の要約は無視する)
+# JSONとして読めても {"summaries": [...]} の形でなければValueErrorにして、グループを分けてやり直させる
+def parse_summaries(content, ids):
+    content = content.strip()
+    # ```json ... ``` で囲まれて返ってくる場合に備える
+    fenced = re.match(r"^```(?:json)?\s*(.*?)\s*```$", content, re.DOTALL)
+    if fenced:
+        content = fenced.group(1)
+    data = json.loads(content)
+    if not isinstance(data, dict) or not isinstance(data.get('summaries'), list):
+        raise ValueError(f"Unexpected summaries format: {content[:200]}")
+    summaries = {}
+    for entry in data['summaries']:
+        if not isinstance(entry, dict):
+            continue
+        item_id = str(entry.get('id'))
+        summary = entry.get('summary')
+        if item_id in ids and isinstance(summary, str) and summary.strip():
+            summaries[item_id] = summary.strip()
+    return summaries
+
+# 複数のテキストを1回のリクエストにまとめて要約する
+# 応答が壊れていたり一部の要約が欠けていた場合は、欠けた分を半分ずつに分けてやり直す
+# use_cacheを指定すると、要約をLLMキャッシュに保存する
+# キーは実際に送るリクエスト(まとめる指示を加えたシステムプロンプト)から作るので、1件ずつの要約とは共有しない
+class SummaryPacker:
+    def __init__(self, client, model, system_prompt, max_tokens_per_item, temperature,
+                 use_cache=False, limiter=None, concurrency=1, json_mode=True,
+                 budget=PACK_TOKEN_BUDGET, max_items=PACK_MAX_ITEMS):
+        self.client = client
+        self.model = model
+        self.system_prompt = f"{system_prompt}\n{PACKED_INSTRUCTIONS}"
+        self.max_tokens_per_item = max_tokens_per_item
+        self.temperature = temperature
+        self.use_cache = use_cache
+        self.limiter = limiter
+        self.concurrency = concurrency
+        # response_formatでJSONを強制する(対応していないモデルではFalseにする)
+        self.json_mode = json_mode
+        self.budget = budget
+        self.max_items = max_items
+        self.request_count = 0
+        self._count_lock = threading.Lock()
+
+    def cache_key(self, text):
+        return make_key('packed', self.model, self.system_prompt, text, self.max_tokens_per_item, self.temperature)
+
+    # テキストのリストを要約し、入力と同じ順序で返す
+    def summarize(self, texts):
+        results = [None] * len(texts)
+        cache = get_llm_cache() if self.use_cache else None
+        items = []
+        for i, text in enumerate(texts):
+            if cache is not None:
+                cached = cache.get(self.cache_key(text))
+                if cached is not None:
+                    results[i] = cached
+                    continue
+            items.append((str(i), text))
+
+        groups = pack_items(items, self.model, self.budget, self.max_items)
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            for summaries in executor.map(self._summarize_group, groups):
+                for item_id, summary in summaries.items():
+                    results[int(item_id)] = summary
+                    if cache is not None and summary != ERROR_SUMMARY:
+                        cache.set(self.cache_key(texts[int(item_id)]), summary)
+        return results
+
+    def _request(self, group):
+        documents = build_documents(group)
+        max_tokens = self.max_tokens_per_item * len(group) + 20 * len(group)
+        if self.limiter:
+            self.limiter.acquire(count_tokens(self.system_prompt, self.model)
+                                 + count_tokens(documents, self.model) + max_tokens)
+        kwargs = {"response_format": {"type": "json_object"}} if self.json_mode else {}
+        # 失敗した分のやり直しは並列に動くワーカーから呼ばれる
+        with self._count_lock:
+            self.request_count += 1
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": self.system_prompt},
+                {"role": "user", "content": documents},
+            ],
+            max_tokens=max_tokens,
+            temperature=self.temperature,
+            **kwargs)
+        instrumentation.record_llm_usage(response, self.model)
+        return response.choices[0].message.content or ""
+
+    def _summarize_group(self, group):
+        try:
+            content = self._request(group)
+        except openai.OpenAIError as e:
+            print(f"Error with OpenAI API: {e}")
+            return {item_id: ERROR_SUMMARY for item_id, _ in group}
+
+        ids = {item_id for item_id, _ in group}
+        try:
+            summaries = parse_summaries(content, ids)
+        except ValueError:
+            summaries = {}
+        missing = [(item_id, text) for item_id, text in group if item_id not in summaries]
+        if not missing:
+            return summaries
+        if len(missing) == 1 and len(group) == 1:
+            print(f"Could not parse the summary for document {missing[0][0]}.")
+            summaries[missing[0][0]] = ERROR_SUMMARY
+            return summaries
+        # 欠けた分を半分に分けて再度リクエストする
+        half = (len(missing) + 1) // 2
+        for part in (missing[:half], missing[half:]):
+            if part:
+                summaries.update(self._summarize_group(part))
+        return summaries
@@ -1,31 +1,16 @@
 import os
-import json
 from dotenv import load_dotenv
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
-from googleapiclient.http import MediaFileUpload
+from drive_uploader import create_drive_service, upload_file
 
 # .envファイルから環境変数を読み込む
 load_dotenv()
 
 def upload_to_drive(file_path, folder_id):
-    # 環境変数からサービスアカウント情報を取得
-    service_account_info = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
+    # 環境変数のサービスアカウント情報からGoogle Drive APIのクライアントを作成
+    drive_service = create_drive_service(os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
 
-    if not service_account_info:
-        raise ValueError("環境変数 'GOOGLE_APPLICATION_CREDENTIALS' が設定されていません。")
-
-    # Google Drive APIのクライアントを作成
-    SCOPES = ['https://www.googleapis.com/auth/drive.file']
-    credentials = service_account.Credentials.from_service_account_info(
-        json.loads(service_account_info), scopes=SCOPES)
-    drive_service = build('drive', 'v3', credentials=credentials)
-
-    # ファイルをアップロード
-    file_metadata = {'name': os.path.basename(file_path), 'parents': [folder_id]}
-    media = MediaFileUpload(file_path, resumable=True)
-    file = drive_service.files().create(body=file_metadata, media_body=media, fields='id').execute()
-    print(f"File ID: {file.get('id')}")
+    # ファイルをチャンクごとにレジューム可能な形式でアップロード
+    upload_file(drive_service, file_path, folder_id)
 
 if __name__ == '__main__':
     file_path = 'data/test/test.json'
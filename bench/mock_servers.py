@@ -0,0 +1,461 @@
+import re
+import json
+import zlib
+import time
+import random
+import threading
+import urllib.parse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import openai_stub
+
+# ベンチマーク用に、各APIの代わりにローカルで動かすモックサーバー
+# レスポンスは件数・本文の長さを指定して決定的に生成し、遅延と429の発生率も指定できる
+
+class MockConfig:
+    def __init__(self, latency=0.0, items=100, text_bytes=400, rate_limit=0.0, retry_after=1, seed=0):
+        self.latency = latency          # 1リクエストごとの遅延(秒)
+        self.items = items              # 1つの検索で返す件数
+        self.text_bytes = text_bytes    # 本文・アブストラクトの長さ
+        self.rate_limit = rate_limit    # 429を返す割合(0〜1)
+        self.retry_after = retry_after  # 429のRetry-After(秒)
+        self.seed = seed
+
+WORDS = ("sky star moon island beach light night model language learning art data shore wave "
+         "香椎浜 アイランドシティ 照葉 夜空 星座 研究 美学 哲学").split()
+
+def make_text(rng, length):
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word.encode('utf-8')) + 1
+    text = " ".join(words)
+    return text[:1].upper() + text[1:] + "."
+
+# 実行ごとに変わらないハッシュ値(組み込みのhashは文字列でプロセスごとに変わる)
+def stable_hash(*parts):
+    return zlib.crc32(repr(parts).encode('utf-8'))
+
+def json_response(data, status=200, headers=None):
+    return status, headers or {}, data
+
+# 1つのAPIのモック。routesは (メソッド, パスの正規表現, 処理) のリスト
+class MockService:
+    def __init__(self, name, config):
+        self.name = name
+        self.config = config
+        self.routes = []
+        self._lock = threading.Lock()
+        self._rng = random.Random(config.seed)
+        self.reset()
+        self.server = None
+
+    def reset(self):
+        with self._lock:
+            self.counters = {'requests': 0, 'bytes_in': 0, 'bytes_out': 0, 'throttled': 0}
+
+    def count(self, **values):
+        with self._lock:
+            for key, value in values.items():
+                self.counters[key] += value
+
+    def route(self, method, pattern):
+        def register(func):
+            self.routes.append((method, re.compile(pattern), func))
+            return func
+        return register
+
+    def should_throttle(self):
+        with self._lock:
+            return self.config.rate_limit > 0 and self._rng.random() < self.config.rate_limit
+
+    def dispatch(self, method, path, query, headers, body):
+        for route_method, pattern, func in self.routes:
+            match = pattern.match(path)
+            if route_method == method and match:
+                return func(match, query, headers, body)
+        return json_response({'error': f"{self.name}: no route for {method} {path}"}, status=404)
+
+    def start(self, host='127.0.0.1', port=0):
+        self.server = ThreadingHTTPServer((host, port), make_handler(self))
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+def make_handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def respond(self):
+            body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+            time.sleep(service.config.latency)
+            parsed = urllib.parse.urlsplit(self.path)
+            query = dict(urllib.parse.parse_qsl(parsed.query, keep_blank_values=True))
+            if service.should_throttle():
+                status, headers, data = json_response(
+                    {'message': 'Too Many Requests', 'retry_after': service.config.retry_after},
+                    status=429, headers={'Retry-After': str(service.config.retry_after)})
+                service.count(throttled=1)
+            else:
+                status, headers, data = service.dispatch(self.command, parsed.path, query, self.headers, body)
+
+            content_type = headers.pop('Content-Type', 'application/json')
+            if data is None:
+                payload = b''
+            elif isinstance(data, bytes):
+                payload = data
+            else:
+                payload = json.dumps(data, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            for key, value in headers.items():
+                self.send_header(key, value)
+            if payload or status != 204:
+                self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+            service.count(requests=1, bytes_in=len(body), bytes_out=len(payload))
+
+        do_GET = do_POST = do_PUT = do_PATCH = do_DELETE = respond
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+def reddit_service(config):
+    service = MockService('reddit', config)
+    now = time.time()
+
+    @service.route('POST', r'^/api/v1/access_token')
+    def access_token(match, query, headers, body):
+        return json_response({'access_token': 'bench', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*'})
+
+    def submission(i):
+        rng = random.Random(config.seed * 7919 + i)
+        return {'kind': 't3', 'data': {
+            'id': f"s{i:05d}", 'name': f"t3_s{i:05d}", 'title': make_text(rng, 60),
+            'selftext': make_text(rng, config.text_bytes), 'created_utc': now - 60 * (i + 1),
+            'url': f"https://example.com/{i}", 'permalink': f"/r/bench/comments/s{i:05d}/",
+            'subreddit': 'bench', 'author': 'bench', 'num_comments': 5}}
+
+    @service.route('GET', r'^/r/all/search')
+    def search(match, query, headers, body):
+        limit = int(query.get('limit', 25))
+        after = query.get('after')
+        start = int(after[4:]) + 1 if after else 0
+        end = min(start + limit, config.items)
+        children = [submission(i) for i in range(start, end)]
+        return json_response({'kind': 'Listing', 'data': {
+            'children': children, 'after': f"t3_s{end - 1:05d}" if end < config.items else None, 'before': None}})
+
+    # 1つの投稿のコメントは、最初のページに5件、残りは「もっと見る」(more)の先に5件ずつ置く
+    more_pages = 3
+    page_size = 5
+
+    def comment(submission_id, j, rng):
+        return {'kind': 't1', 'data': {
+            'id': f"{submission_id}c{j}", 'name': f"t1_{submission_id}c{j}", 'body': make_text(rng, config.text_bytes // 2),
+            'created_utc': now - 30 * j, 'depth': 0, 'replies': '', 'parent_id': f"t3_{submission_id}",
+            'link_id': f"t3_{submission_id}", 'author': 'bench'}}
+
+    def comment_rng(submission_id, j):
+        index = int(submission_id[1:]) if submission_id[1:].isdigit() else 0
+        return random.Random((config.seed * 104729 + index) * 1000 + j)
+
+    @service.route('GET', r'^/comments/(\w+)')
+    def comments(match, query, headers, body):
+        submission_id = match.group(1)
+        index = int(submission_id[1:]) if submission_id[1:].isdigit() else 0
+        children = [comment(submission_id, j, comment_rng(submission_id, j)) for j in range(page_size)]
+        # ページごとに別々のmoreを返すので、1つ展開しても他のmoreはツリーに残る必要がある
+        for page in range(1, more_pages + 1):
+            ids = [f"{submission_id}c{j}" for j in range(page * page_size, (page + 1) * page_size)]
+            children.append({'kind': 'more', 'data': {
+                'id': f"{submission_id}m{page}", 'name': f"t1_{submission_id}m{page}", 'count': len(ids),
+                'children': ids, 'depth': 0, 'parent_id': f"t3_{submission_id}"}})
+        return json_response([
+            {'kind': 'Listing', 'data': {'children': [submission(index)], 'after': None, 'before': None}},
+            {'kind': 'Listing', 'data': {'children': children, 'after': None, 'before': None}},
+        ])
+
+    @service.route('POST', r'^/api/morechildren')
+    def morechildren(match, query, headers, body):
+        form = dict(urllib.parse.parse_qsl(body.decode('utf-8'), keep_blank_values=True))
+        things = []
+        for comment_id in filter(None, form.get('children', '').split(',')):
+            submission_id, j = comment_id.rsplit('c', 1)
+            things.append(comment(submission_id, int(j), comment_rng(submission_id, int(j))))
+        return json_response({'json': {'errors': [], 'data': {'things': things}}})
+
+    return service
+
+def tumblr_service(config):
+    service = MockService('tumblr', config)
+    now = int(time.time())
+    page_size = 20
+
+    @service.route('GET', r'^/v2/tagged')
+    def tagged(match, query, headers, body):
+        tag = query.get('tag', '')
+        before = int(query.get('before') or now)
+        # タグごとに、現在時刻から1分おきに過去へさかのぼる投稿があるものとする
+        first = max(0, (now - before) // 60)
+        posts = []
+        for i in range(first, min(first + page_size, config.items)):
+            rng = random.Random(stable_hash(config.seed, tag, i))
+            timestamp = now - 60 * (i + 1)
+            posts.append({
+                'blog_name': f"bench{i % 10}", 'id': i * 100 + len(tag), 'post_url': f"https://bench.tumblr.com/post/{i}",
+                'type': 'text', 'timestamp': timestamp,
+                'date': datetime.utcfromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S GMT'),
+                'tags': [tag, rng.choice(WORDS)], 'note_count': rng.randint(0, 500),
+                'body': make_text(rng, config.text_bytes)})
+        return json_response({'meta': {'status': 200, 'msg': 'OK'}, 'response': posts})
+
+    return service
+
+def semantic_scholar_service(config):
+    service = MockService('semantic_scholar', config)
+    yesterday = (datetime.now() - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    @service.route('GET', r'^/graph/v1/paper/search')
+    def search(match, query, headers, body):
+        offset = int(query.get('offset', 0))
+        limit = int(query.get('limit', 100))
+        end = min(offset + limit, config.items)
+        papers = []
+        for i in range(offset, end):
+            rng = random.Random(stable_hash(config.seed, query.get('query'), i))
+            # TLDRあり・短いアブストラクト・長いアブストラクト・なしが混ざるようにする
+            kind = i % 4
+            papers.append({
+                'paperId': f"{stable_hash(query.get('query'), i):040x}",
+                'title': make_text(rng, 80),
+                'authors': [{'authorId': str(i), 'name': 'Bench Author'}],
+                'tldr': {'model': 'tldr@v2', 'text': make_text(rng, 150)} if kind == 0 else None,
+                'abstract': None if kind == 3 else make_text(rng, 300 if kind == 1 else config.text_bytes * 3),
+                'fieldsOfStudy': ['Computer Science'],
+                'venue': 'Bench', 'publicationDate': yesterday, 'url': f"https://example.org/paper/{i}"})
+        data = {'total': config.items, 'offset': offset, 'data': papers}
+        if end < config.items:
+            data['next'] = end
+        return json_response(data)
+
+    return service
+
+def cinii_service(config):
+    service = MockService('cinii', config)
+    today = datetime.now().date()
+
+    @service.route('GET', r'^/opensearch/search')
+    def search(match, query, headers, body):
+        start = int(query.get('start', 1))
+        count = int(query.get('count', 20))
+        keyword = query.get('q', '')
+        items = []
+        for i in range(start - 1, min(start - 1 + count, config.items)):
+            rng = random.Random(stable_hash(config.seed, keyword, i))
+            items.append({
+                'title': make_text(rng, 60),
+                'link': {'@id': f"https://ci.nii.ac.jp/naid/{stable_hash(keyword, i) % 10**12}"},
+                'prism:publicationDate': (today - timedelta(days=i * 3)).strftime('%Y-%m-%d'),
+                'dc:publisher': 'Bench Publisher',
+                'description': make_text(rng, config.text_bytes)})
+        return json_response({'opensearch:totalResults': str(config.items), 'opensearch:startIndex': str(start),
+                              'opensearch:itemsPerPage': str(count), 'items': items})
+
+    return service
+
+def openweather_service(config):
+    service = MockService('openweather', config)
+
+    def conditions(rng, timestamp):
+        return {
+            'dt': int(timestamp),
+            'weather': [{'id': 800, 'main': 'Clear', 'description': rng.choice(['clear sky', 'few clouds', 'overcast clouds'])}],
+            'main': {'temp': round(rng.uniform(5, 30), 1), 'humidity': rng.randint(30, 95), 'pressure': 1013},
+            'wind': {'speed': round(rng.uniform(0, 10), 1), 'deg': rng.randint(0, 359)},
+            'clouds': {'all': rng.randint(0, 100)},
+            'visibility': 10000,
+        }
+
+    @service.route('GET', r'^/data/2\.5/weather')
+    def weather(match, query, headers, body):
+        rng = random.Random(stable_hash(config.seed, query.get('lat'), query.get('lon')))
+        return json_response({**conditions(rng, time.time()), 'name': 'Bench',
+                              'coord': {'lat': float(query.get('lat') or 0), 'lon': float(query.get('lon') or 0)}})
+
+    # 5日間・3時間ごとの予報
+    @service.route('GET', r'^/data/2\.5/forecast')
+    def forecast(match, query, headers, body):
+        rng = random.Random(stable_hash(config.seed, query.get('lat'), query.get('lon'), 'forecast'))
+        start = (int(time.time()) // 10800 + 1) * 10800
+        count = int(query.get('cnt') or 40)
+        return json_response({'cod': '200', 'cnt': count,
+                              'list': [conditions(rng, start + i * 10800) for i in range(count)],
+                              'city': {'coord': {'lat': float(query.get('lat') or 0), 'lon': float(query.get('lon') or 0)}}})
+
+    return service
+
+def astronomy_service(config):
+    service = MockService('astronomy', config)
+    bodies = ['sun', 'moon', 'mercury', 'venus', 'mars', 'jupiter', 'saturn', 'uranus', 'neptune', 'pluto']
+    constellations = ['Leo', 'Virgo', 'Libra', 'Scorpius', 'Sagittarius', 'Capricornus', 'Aquarius', 'Pisces', 'Aries', 'Taurus']
+
+    @service.route('GET', r'^/api/v2/bodies/positions')
+    def positions(match, query, headers, body):
+        rng = random.Random(stable_hash(config.seed, query.get('from_date')))
+        rows = []
+        for name in bodies:
+            cell = {'date': f"{query.get('from_date')}T00:00:00.000+00:00", 'id': name, 'name': name.title(),
+                    'distance': {'fromEarth': {'au': str(rng.uniform(0.002, 40))}},
+                    'position': {'horizontal': {'altitude': {'degrees': str(rng.uniform(-90, 90))},
+                                                'azimuth': {'degrees': str(rng.uniform(0, 360))}},
+                                 'constellation': {'id': 'x', 'short': 'X', 'name': rng.choice(constellations)}},
+                    'extraInfo': {'elongation': rng.uniform(0, 180), 'magnitude': rng.uniform(-4, 10)}}
+            if name == 'moon':
+                cell['extraInfo']['phase'] = {'angel': str(rng.uniform(0, 360)), 'fraction': str(rng.random()),
+                                              'string': rng.choice(['New Moon', 'Waxing Crescent', 'First Quarter', 'Full Moon'])}
+            rows.append({'entry': {'id': name, 'name': name.title()}, 'cells': [cell]})
+        return json_response({'data': {'dates': {'from': query.get('from_date'), 'to': query.get('to_date')},
+                                       'observer': {'location': {'latitude': query.get('latitude'),
+                                                                 'longitude': query.get('longitude')}},
+                                       'table': {'header': [], 'rows': rows}}})
+
+    return service
+
+def openai_service(config):
+    service = MockService('openai', config)
+
+    def api(method):
+        def handle(match, query, headers, body):
+            status, data = openai_stub.handle_request(method, match.string, headers, body)
+            if isinstance(data, bytes):
+                return status, {'Content-Type': 'application/octet-stream'}, data
+            return json_response(data, status=status)
+        return handle
+
+    service.route('GET', r'^/v1/')(api('GET'))
+    service.route('POST', r'^/v1/')(api('POST'))
+
+    return service
+
+def discord_service(config):
+    service = MockService('discord', config)
+
+    @service.route('POST', r'^/api/webhooks/')
+    def webhook(match, query, headers, body):
+        return 204, {}, None
+
+    return service
+
+# Google Driveのレジューム可能アップロードと、アップロードしたファイルの一覧・ダウンロード
+def drive_service(config):
+    service = MockService('drive', config)
+    uploads = {}
+    files = {}
+    lock = threading.Lock()
+
+    @service.route('POST', r'^/upload/drive/v3/files')
+    def start_upload(match, query, headers, body):
+        upload_id = f"u{len(uploads) + 1}"
+        with lock:
+            uploads[upload_id] = {'metadata': json.loads(body or b'{}'), 'content': bytearray()}
+        location = f"http://{headers['Host']}/upload/drive/v3/files?uploadType=resumable&upload_id={upload_id}"
+        return 200, {'Location': location}, {}
+
+    @service.route('PUT', r'^/upload/drive/v3/files')
+    def upload_chunk(match, query, headers, body):
+        with lock:
+            upload = uploads.get(query.get('upload_id'))
+            if upload is None:
+                return json_response({'error': 'unknown upload'}, status=404)
+            upload['content'] += body
+            received = len(upload['content'])
+            # Content-Range: bytes 0-1023/* (サイズ不明) または bytes 0-1023/4096
+            total = (headers.get('Content-Range') or '').rsplit('/', 1)[-1]
+            if total != '*' and total and received >= int(total):
+                file_id = f"file-{query.get('upload_id')}"
+                files[file_id] = {'name': upload['metadata'].get('name'), 'content': bytes(upload['content'])}
+                return json_response({'id': file_id, 'name': upload['metadata'].get('name')})
+            return 308, {'Range': f"bytes=0-{received - 1}"}, None
+
+    @service.route('POST', r'^/drive/v3/files')
+    def create(match, query, headers, body):
+        return json_response({'id': f"file-{len(uploads) + 1}", **json.loads(body or b'{}')})
+
+    # api_endpointを差し替えたクライアントは /drive/v3 を付けずにリクエストする
+    # qは "name contains '...'" だけを見る(ページングはしない)
+    @service.route('GET', r'^(?:/drive/v3)?/files$')
+    def list_files(match, query, headers, body):
+        contains = re.search(r"name contains '([^']*)'", query.get('q', ''))
+        with lock:
+            items = [{'id': file_id, 'name': item['name']} for file_id, item in files.items()
+                     if not contains or contains.group(1) in (item['name'] or '')]
+        return json_response({'files': items})
+
+    # alt=media のダウンロード(Range: bytes=start-end に対応)
+    @service.route('GET', r'^(?:/drive/v3)?/files/([\w-]+)$')
+    def get_media(match, query, headers, body):
+        with lock:
+            item = files.get(match.group(1))
+        if item is None:
+            return json_response({'error': 'file not found'}, status=404)
+        content = item['content']
+        ranged = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range') or '')
+        if not ranged:
+            return 200, {'Content-Type': 'application/octet-stream'}, content
+        start = int(ranged.group(1))
+        end = min(int(ranged.group(2) or len(content) - 1), len(content) - 1)
+        return 206, {'Content-Type': 'application/octet-stream',
+                     'Content-Range': f"bytes {start}-{end}/{len(content)}"}, content[start:end + 1]
+
+    return service
+
+SERVICE_FACTORIES = {
+    'reddit': reddit_service,
+    'tumblr': tumblr_service,
+    'semantic_scholar': semantic_scholar_service,
+    'cinii': cinii_service,
+    'openweather': openweather_service,
+    'astronomy': astronomy_service,
+    'openai': openai_service,
+    'discord': discord_service,
+    'drive': drive_service,
+}
+
+def start_services(config, names=None):
+    return {name: SERVICE_FACTORIES[name](config).start() for name in (names or SERVICE_FACTORIES)}
+
+# 各スクリプトをモックサーバーに向けるための環境変数
+def service_env(services):
+    urls = {name: service.url for name, service in services.items()}
+    return {
+        'REDDIT_CLIENT_ID': 'bench', 'REDDIT_CLIENT_SECRET': 'bench',
+        'REDDIT_URL': urls['reddit'], 'REDDIT_OAUTH_URL': urls['reddit'],
+        'TUMBLR_API_KEY': 'bench', 'TUMBLR_API_HOST': urls['tumblr'],
+        'SEMANTIC_SCHOLAR_API_KEY': 'bench', 'SEMANTIC_SCHOLAR_BASE_URL': urls['semantic_scholar'],
+        'CINII_API_KEY': 'bench', 'CINII_BASE_URL': urls['cinii'],
+        'OPENWEATHER_API_KEY': 'bench', 'OPENWEATHER_BASE_URL': urls['openweather'],
+        'ASTRONOMY_APPLICATION_ID': 'bench', 'ASTRONOMY_APPLICATION_SEACRET': 'bench',
+        'ASTRONOMY_API_BASE_URL': urls['astronomy'],
+        'OPENAI_API_KEY': 'bench', 'OPENAI_BASE_URL': f"{urls['openai']}/v1",
+        'DISCORD_WEBHOOK_URL_SCHOLAR': f"{urls['discord']}/api/webhooks/1/scholar",
+        'DISCORD_WEBHOOK_URL_ART': f"{urls['discord']}/api/webhooks/2/art",
+        'GOOGLE_DRIVE_FOLDER_ID': 'bench', 'GOOGLE_APPLICATION_CREDENTIALS': 'bench',
+        'DRIVE_API_ENDPOINT': urls['drive'],
+        'LATITUDE': '33.66', 'LONGTITUDE': '130.42',
+    }
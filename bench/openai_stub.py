@@ -0,0 +1,172 @@
+import os
+import re
+import json
+import time
+import uuid
+import argparse
+import threading
+from email.parser import BytesParser
+from email.policy import default as default_policy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# OpenAI APIの代わりにローカルで動かすスタブサーバー
+# OPENAI_BASE_URL=http://127.0.0.1:8100/v1 を設定して、要約やBatch APIの動作を確認する
+#   python bench/openai_stub.py --port 8100 --batch-delay 5
+
+files = {}
+batches = {}
+lock = threading.Lock()
+
+def new_id(prefix):
+    return f"{prefix}-{uuid.uuid4().hex[:24]}"
+
+# リクエストの内容から決まった要約を返す(同じ入力には同じ応答になる)
+# 複数の文書をまとめたリクエストには、文書のidごとの要約をJSONで返す
+def fake_completion(body):
+    text = body.get('messages', [{}])[-1].get('content', '')
+    documents = re.findall(r'<document id="([^"]*)">\s*(.*?)\s*</document>', text, re.DOTALL)
+    if documents:
+        content = json.dumps({'summaries': [
+            {'id': doc_id, 'summary': f"[stub] {' '.join(doc.split())[:200]}"} for doc_id, doc in documents]})
+    else:
+        text = " ".join(text.split("\n\n", 1)[-1].split())
+        content = f"[stub] {text[:200]}"
+    return {
+        'id': new_id('chatcmpl'),
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'stub'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop',
+        }],
+        'usage': {'prompt_tokens': len(text) // 4, 'completion_tokens': len(content) // 4,
+                  'total_tokens': (len(text) + len(content)) // 4},
+    }
+
+def store_file(content, filename, purpose):
+    file_id = new_id('file')
+    files[file_id] = {
+        'id': file_id,
+        'object': 'file',
+        'bytes': len(content),
+        'created_at': int(time.time()),
+        'filename': filename,
+        'purpose': purpose,
+        'status': 'processed',
+        'content': content,
+    }
+    return file_id
+
+def public_file(file):
+    return {key: value for key, value in file.items() if key != 'content'}
+
+# 入力ファイルの各行を処理し、結果ファイルを作る
+def run_batch(batch):
+    lines = files[batch['input_file_id']]['content'].decode('utf-8').splitlines()
+    output = []
+    for line in filter(None, lines):
+        item = json.loads(line)
+        output.append(json.dumps({
+            'id': new_id('batch_req'),
+            'custom_id': item['custom_id'],
+            'response': {'status_code': 200, 'request_id': new_id('req'), 'body': fake_completion(item['body'])},
+            'error': None,
+        }))
+    batch['output_file_id'] = store_file(("\n".join(output) + "\n").encode('utf-8'), 'batch_output.jsonl', 'batch_output')
+    batch['request_counts'] = {'total': len(output), 'completed': len(output), 'failed': 0}
+    batch['status'] = 'completed'
+    batch['completed_at'] = int(time.time())
+
+def error(status, message):
+    return status, {'error': {'message': message, 'type': 'invalid_request_error'}}
+
+# リクエストを処理して (ステータス, 応答) を返す
+# 応答は辞書ならJSONとして、bytesならそのまま返す(ベンチマークのモックサーバーからも使う)
+def handle_request(method, path, headers, body, batch_delay=0.0):
+    path = path.split('?', 1)[0].rstrip('/')
+    parts = path.split('/')
+    with lock:
+        if method == 'POST' and path.endswith('/chat/completions'):
+            return 200, fake_completion(json.loads(body))
+        if method == 'POST' and path.endswith('/files'):
+            # multipart/form-data をメールのパーサーで分解する
+            message = BytesParser(policy=default_policy).parsebytes(
+                f"Content-Type: {headers['Content-Type']}\r\n\r\n".encode('utf-8') + body)
+            fields = {}
+            filename = 'upload.jsonl'
+            for part in message.iter_parts():
+                name = part.get_param('name', header='content-disposition')
+                if part.get_filename():
+                    filename = part.get_filename()
+                fields[name] = part.get_payload(decode=True)
+            file_id = store_file(fields.get('file', b''), filename, (fields.get('purpose') or b'').decode('utf-8'))
+            return 200, public_file(files[file_id])
+        if method == 'POST' and path.endswith('/batches'):
+            request = json.loads(body)
+            if request.get('input_file_id') not in files:
+                return error(400, 'input file not found')
+            batch_id = new_id('batch')
+            batches[batch_id] = {
+                'id': batch_id,
+                'object': 'batch',
+                'endpoint': request.get('endpoint'),
+                'input_file_id': request['input_file_id'],
+                'completion_window': request.get('completion_window', '24h'),
+                'status': 'in_progress',
+                'created_at': int(time.time()),
+                'output_file_id': None,
+                'error_file_id': None,
+                'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            }
+            return 200, batches[batch_id]
+        if method == 'GET' and len(parts) >= 2 and parts[-2] == 'batches' and parts[-1] in batches:
+            batch = batches[parts[-1]]
+            # 作成から指定の秒数が経ったら完了にする
+            if batch['status'] == 'in_progress' and time.time() - batch['created_at'] >= batch_delay:
+                run_batch(batch)
+            return 200, batch
+        if method == 'GET' and len(parts) >= 3 and parts[-1] == 'content' and parts[-2] in files:
+            return 200, files[parts[-2]]['content']
+        if method == 'GET' and len(parts) >= 2 and parts[-2] == 'files' and parts[-1] in files:
+            return 200, public_file(files[parts[-1]])
+    return error(404, f"Unknown path {path}")
+
+class Handler(BaseHTTPRequestHandler):
+    batch_delay = 0.0
+
+    def respond(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        status, data = handle_request(self.command, self.path, self.headers, body, self.batch_delay)
+        content_type = 'application/octet-stream'
+        if not isinstance(data, bytes):
+            data = json.dumps(data).encode('utf-8')
+            content_type = 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = respond
+    do_POST = respond
+
+    def log_message(self, format, *args):
+        if os.getenv("STUB_VERBOSE"):
+            super().log_message(format, *args)
+
+def main():
+    parser = argparse.ArgumentParser(description='OpenAI APIのスタブサーバー')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8100)
+    parser.add_argument('--batch-delay', type=float, default=0.0, help='バッチが完了するまでの秒数')
+    args = parser.parse_args()
+
+    Handler.batch_delay = args.batch_delay
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"OpenAI stub listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
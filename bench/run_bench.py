@@ -0,0 +1,185 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from pathlib import Path
+from mock_servers import MockConfig, start_services, service_env
+
+# 各スクリプトをローカルのモックサーバーに向けて実行し、
+# 実行時間・リクエスト数・転送量・最大メモリ使用量を記録する
+#   python bench/run_bench.py --latency 0.05 --items 200 --rate-limit 0.05
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+APP_DIR = REPO_ROOT / 'app'
+RESULTS_PATH = REPO_ROOT / 'data' / 'bench' / 'results.jsonl'
+
+ENTRY_POINTS = ['fetch_reddit', 'fetch_tumblr', 'fetch_semantic_scholar', 'fetch_cinii', 'openai_ask_astronomy']
+
+# スクリプト側のレート制限で待たされる時間を計測に含めないように、上限を十分に大きくする
+BENCH_ENV = {
+    'REDDIT_REQUESTS_PER_MINUTE': '100000',
+    'TUMBLR_REQUESTS_PER_MINUTE': '100000',
+    'OPENAI_RPM': '100000',
+    'OPENAI_TPM': '100000000',
+    'DRIVE_UPLOAD_CHUNK_SIZE': str(256 * 1024),
+}
+
+def git_revision():
+    def git(*args):
+        return subprocess.run(['git', *args], cwd=REPO_ROOT, capture_output=True, text=True).stdout.strip()
+    commit = git('rev-parse', '--short', 'HEAD') or 'unknown'
+    dirty = bool(git('status', '--porcelain', '--untracked-files=no'))
+    return commit, dirty
+
+# 1つのスクリプトを作業用ディレクトリで実行する
+# チェックポイントやキャッシュは実行ごとに空の状態から始める
+def run_entry(entry, env, timeout):
+    with tempfile.TemporaryDirectory(prefix=f"bench-{entry}-") as workdir:
+        log_path = Path(workdir) / 'output.log'
+        started = time.monotonic()
+        with log_path.open('wb') as log:
+            process = subprocess.Popen([sys.executable, str(APP_DIR / f"{entry}.py")],
+                                       cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            deadline = started + timeout
+            status = None
+            while status is None:
+                pid, wait_status, rusage = os.wait4(process.pid, os.WNOHANG)
+                if pid:
+                    status = os.waitstatus_to_exitcode(wait_status)
+                    break
+                if time.monotonic() > deadline:
+                    process.kill()
+                    pid, wait_status, rusage = os.wait4(process.pid, 0)
+                    status = 'timeout'
+                    break
+                time.sleep(0.01)
+            # wait4で回収済みなので、Popenにも終了したことを伝える
+            process.returncode = status if isinstance(status, int) else -9
+        elapsed = time.monotonic() - started
+        output = log_path.read_text(encoding='utf-8', errors='replace')
+    return {
+        'status': 'ok' if status == 0 else ('timeout' if status == 'timeout' else f"exit {status}"),
+        'wall_seconds': round(elapsed, 3),
+        'cpu_seconds': round(rusage.ru_utime + rusage.ru_stime, 3),
+        # Linuxのru_maxrssはKB単位
+        'peak_rss_kb': rusage.ru_maxrss,
+        'output_tail': output[-2000:] if status != 0 else '',
+    }
+
+def run(entries, config, timeout, repeat):
+    services = start_services(config)
+    env = {**os.environ, **service_env(services), **BENCH_ENV}
+    commit, dirty = git_revision()
+    results = []
+    try:
+        for entry in entries:
+            for run_index in range(repeat):
+                for service in services.values():
+                    service.reset()
+                result = run_entry(entry, env, timeout)
+                counters = {name: dict(service.counters) for name, service in services.items()
+                            if service.counters['requests']}
+                results.append({
+                    'commit': commit,
+                    'dirty': dirty,
+                    'recorded_at': datetime.now().isoformat(timespec='seconds'),
+                    'entry': entry,
+                    'run': run_index,
+                    'config': vars(config),
+                    **result,
+                    'requests': sum(c['requests'] for c in counters.values()),
+                    'bytes_in': sum(c['bytes_in'] for c in counters.values()),
+                    'bytes_out': sum(c['bytes_out'] for c in counters.values()),
+                    'throttled': sum(c['throttled'] for c in counters.values()),
+                    'services': counters,
+                })
+                print_result(results[-1])
+    finally:
+        for service in services.values():
+            service.stop()
+    return results
+
+def print_result(result):
+    print(f"{result['entry']:<24}{result['status']:<10}{result['wall_seconds']:>9.2f}s"
+          f"{result['peak_rss_kb'] / 1024:>9.1f}MB{result['requests']:>8} req"
+          f"{(result['bytes_in'] + result['bytes_out']) / 1024:>10.1f}KB{result['throttled']:>6} 429")
+    if result['output_tail']:
+        print("    " + result['output_tail'].strip().replace("\n", "\n    "))
+
+def save_results(results, path=RESULTS_PATH):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open('a', encoding='utf-8') as f:
+        for result in results:
+            f.write(json.dumps(result, ensure_ascii=False) + '\n')
+
+def load_results(path=RESULTS_PATH):
+    if not path.exists():
+        return []
+    with path.open(encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+# 同じ条件での別のコミットの最新の結果と比べる(複数回実行した場合は中央値)
+def compare(results, history, baseline=None):
+    def median(values):
+        values = sorted(values)
+        return values[len(values) // 2] if values else None
+
+    def summarize(rows):
+        return {key: median([row[key] for row in rows])
+                for key in ('wall_seconds', 'peak_rss_kb', 'requests', 'bytes_in', 'bytes_out')}
+
+    if not results:
+        return
+    commit = results[0]['commit']
+    config = results[0]['config']
+    print()
+    print(f"{'entry':<24}{'metric':<14}{'baseline':>12}{'current':>12}{'change':>9}")
+    for entry in dict.fromkeys(result['entry'] for result in results):
+        candidates = [row for row in history if row['entry'] == entry and row['config'] == config
+                      and row['commit'] != commit and (baseline is None or row['commit'].startswith(baseline))]
+        if not candidates:
+            continue
+        base_commit = candidates[-1]['commit']
+        base = summarize([row for row in candidates if row['commit'] == base_commit])
+        current = summarize([row for row in results if row['entry'] == entry])
+        for metric, value in current.items():
+            before = base[metric]
+            change = f"{(value - before) / before * 100:+.1f}%" if before else ''
+            print(f"{entry:<24}{metric:<14}{before:>12}{value:>12}{change:>9}")
+        print(f"{'':<24}(baseline {base_commit})")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='モックサーバーを使ったベンチマーク')
+    parser.add_argument('--entries', default=','.join(ENTRY_POINTS), help='カンマ区切りの実行するスクリプト')
+    parser.add_argument('--latency', type=float, default=0.02, help='1リクエストごとの遅延(秒)')
+    parser.add_argument('--items', type=int, default=100, help='1つの検索で返す件数')
+    parser.add_argument('--text-bytes', type=int, default=400, help='本文・アブストラクトの長さ')
+    parser.add_argument('--rate-limit', type=float, default=0.0, help='429を返す割合(0〜1)')
+    parser.add_argument('--retry-after', type=int, default=1, help='429のRetry-After(秒)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=1, help='スクリプトごとの実行回数')
+    parser.add_argument('--timeout', type=float, default=600, help='スクリプトごとのタイムアウト(秒)')
+    parser.add_argument('--baseline', help='比較するコミット(省略時は同じ条件の直前の別のコミット)')
+    parser.add_argument('--no-save', action='store_true', help='結果を保存しない')
+    args = parser.parse_args(argv)
+
+    entries = [entry.strip() for entry in args.entries.split(',') if entry.strip()]
+    unknown = [entry for entry in entries if entry not in ENTRY_POINTS]
+    if unknown:
+        parser.error(f"unknown entries: {', '.join(unknown)}")
+
+    config = MockConfig(latency=args.latency, items=args.items, text_bytes=args.text_bytes,
+                        rate_limit=args.rate_limit, retry_after=args.retry_after, seed=args.seed)
+    history = load_results()
+    results = run(entries, config, args.timeout, args.repeat)
+    compare(results, history, args.baseline)
+    if not args.no_save:
+        save_results(results)
+    return 0 if all(result['status'] == 'ok' for result in results) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / 'app'))
+
+import ephemeris
+
+# PyEphemで計算した位置をAstronomyAPIのレスポンスと同じ形にしたもの(APIのレスポンスそのものではない)
+FIXTURES = Path(__file__).resolve().parent / 'fixtures' / 'reference_positions'
+
+# 基準値との差の許容範囲(度・輝面比)
+MAX_ALTITUDE_ERROR = 0.5
+MAX_PHASE_ANGLE_ERROR = 1.0
+MAX_ILLUMINATION_ERROR = 0.02
+
+def test_fixtures_exist():
+    assert list(FIXTURES.glob('*.json'))
+
+# 基準値と比べて、月の離角・輝面比と月・太陽の高度の差が許容範囲に収まること
+# (フェーズ名は基準値を作るときに同じ規則で付けたので比べない)
+def test_matches_reference_positions():
+    for data in ephemeris.load_responses(FIXTURES):
+        result = ephemeris.compare_with_response(data)
+        assert abs(result['phase_angle_error']) <= MAX_PHASE_ANGLE_ERROR, result
+        assert abs(result['illumination_error']) <= MAX_ILLUMINATION_ERROR, result
+        assert abs(result['moon_altitude_error']) <= MAX_ALTITUDE_ERROR, result
+        assert abs(result['sun_altitude_error']) <= MAX_ALTITUDE_ERROR, result
+
+def test_constellations_are_capped():
+    data = ephemeris.get_astronomy_data(33.66, 130.42, date='2024-01-25')
+    assert 0 < len(data['constellations']) <= ephemeris.MAX_CONSTELLATIONS
+    names = [item['name'] for item in data['raw']['constellations']]
+    assert data['constellations'] == names[:ephemeris.MAX_CONSTELLATIONS]